@@ -1,23 +1,62 @@
 import collections
+import cProfile
+import heapq
+import json
+import multiprocessing
+import os
+import pstats
 import re
-import bz2
+import signal
+import sys
+import threading
+import time
 
 from lxml import etree
 
 import wikitextparser
 import wiktlangs
+import dumpreader
+import pagestore
+import sinks as sinkutils
 from wikiutils import *
 import definitions # LF: local file
 
 
-def parseEtymology(word, data, text):
+def isEtymologyTemplate(name):
+    """Returns True if ``name`` (a stripped template name) is one of the
+    etymology templates we extract, possibly through a shortcut."""
+    return etymologyShortcuts.get(name, name) in etymologyTemplates
+
+
+def parseEtymology(word, data, text, ctx=None):
     """From the etymology section we parse "compound", "affix", and
     "suffix" templates.  These may suggest that the word is a compound
-    word.  They are stored under "compound"."""
+    word.  They are stored under "compound".  If the parsing context
+    ``ctx`` is given, the time spent finding the templates and cleaning
+    their values is added to its "etymology" and "clean_value" stages."""
 
-    wordEtymology = wikitextparser.parse(text)
+    # Only the etymology templates are needed, and they can usually be
+    # found without building a full parse tree.
+    start = time.perf_counter()
+    if ctx is not None:
+        ctx.stage = "etymology"
+    templates = scan_templates(text, isEtymologyTemplate)
+    if templates is None:
+        templates = wikitextparser.parse(text).templates
+    if ctx is not None:
+        start = ctx.timeStage("etymology", start)
+        ctx.stage = "clean_value"
+    addEtymologyTemplates(data, templates)
+    if ctx is not None:
+        ctx.timeStage("clean_value", start)
+        ctx.stage = "parse_page"
 
-    for t in wordEtymology.templates:
+
+def addEtymologyTemplates(data, templates):
+    """Adds the records of the etymology templates among ``templates`` (a
+    list of wikitextparser templates or ``scan_templates`` results) to
+    ``data``."""
+    for t in templates:
         name = t.name.strip()
         if name in etymologyShortcuts:
             name = etymologyShortcuts[name]
@@ -37,13 +76,57 @@ def parseEtymology(word, data, text):
                 data_append(data, "etymology", template_args_to_dict(t))
 
 
+# The stages of parsePage() whose time is recorded for each slow page.
+page_stages = ("split_subsections", "etymology", "clean_value")
+
+
+class PageTimeout(Exception):
+    """Raised in parsePage() when a page takes longer than the
+    ``page_timeout`` of parseWiktionary()."""
+    pass
+
+
+# True while parsePage() is timing a page.  The timer can expire just after
+# the page is done; the exception is then not raised.
+_page_timer_armed = False
+
+def _pageTimeoutHandler(signum, frame):
+    """Handler of SIGALRM while pages are parsed with a time budget."""
+    if _page_timer_armed:
+        raise PageTimeout()
+
+def _startPageTimer(seconds):
+    """Makes SIGALRM raise PageTimeout in parsePage() after a page has taken
+    ``seconds``.  Returns the previous handler, for _stopPageTimer().
+    This must be called in the main thread."""
+    if not hasattr(signal, "setitimer"):
+        raise ValueError("page_timeout is not supported on this platform")
+    if threading.current_thread() is not threading.main_thread():
+        raise ValueError("page_timeout can only be used in the main thread")
+    return signal.signal(signal.SIGALRM, _pageTimeoutHandler)
+
+def _stopPageTimer(handler):
+    """Restores the SIGALRM ``handler`` returned by _startPageTimer()."""
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    if handler is None:
+        handler = signal.SIG_DFL
+    signal.signal(signal.SIGALRM, handler)
+
+
+# A checkpoint that has not been written yet: the ``state`` to save, and the
+# mark of the pending updates of the page store at that point (or None).
+PendingCheckpoint = collections.namedtuple("PendingCheckpoint",
+                                           "state store_mark")
+
+
 class WiktionaryParser(object):
     """This class is used for XML parsing the Wiktionary dump file."""
 
     def __init__(self, word_cb, capture_cb,
                  capture_languages, capture_translations,
                  capture_pronunciation, capture_linkages,
-                 capture_compounds, capture_redirects):
+                 capture_compounds, capture_redirects, prefilter=False,
+                 capture_namespaces=None, store=None, emit_unchanged=True):
         assert callable(word_cb)
         assert capture_cb is None or callable(capture_cb)
         assert isinstance(capture_languages, (list, tuple, set))
@@ -52,6 +135,9 @@ class WiktionaryParser(object):
         assert capture_translations in (True, False)
         assert capture_linkages in (True, False)
         assert capture_translations in (True, False)
+        assert prefilter in (True, False)
+        assert capture_namespaces is None or isinstance(capture_namespaces,
+                                                        (list, tuple, set))
         self.word_cb = word_cb
         self.capture_cb = capture_cb
         self.capture_languages = capture_languages
@@ -60,19 +146,99 @@ class WiktionaryParser(object):
         self.capture_linkages = capture_linkages
         self.capture_compounds = capture_compounds
         self.capture_redirects = capture_redirects
+        self.capture_namespaces = None
+        if capture_namespaces is not None:
+            self.capture_namespaces = set(capture_namespaces)
         self.tag = None
         self.namespaces = {}
+        self.ns = None
+        self.skip_page = False
+        self.store = store
+        self.emit_unchanged = emit_unchanged
         self.stack = []
         self.text = None
         self.title = None
         self.pageid = None
+        self.revid = None
+        self.sha1 = None
         self.redirect = None
         self.model = None
         self.format = None
         self.language_counts = collections.defaultdict(int)
         self.pos_counts = collections.defaultdict(int)
         self.section_counts = collections.defaultdict(int)
-
+        self.skip_counts = collections.defaultdict(int)
+        # Hits, misses and evictions of the clean_value() cache, summed over
+        # this process and the workers.
+        self.clean_value_counts = collections.defaultdict(int)
+        # Bytes of (decompressed) input read, and the time spent reading and
+        # waiting for it.  See dumpreader.throughput() for the rest.
+        # The position in the dump file itself is tracked from input_start
+        # to input_size for the progress reports.
+        self.read_stats = {"bytes": 0, "chunks": 0, "read_seconds": 0.0,
+                           "wait_seconds": 0.0, "seconds": 0.0,
+                           "input_start": 0, "input_pos": 0,
+                           "input_size": 0}
+        # Time spent in each stage of the parsing and the number of times
+        # it was entered, summed over this process and the workers; see
+        # report().  The time spent in processPage() is subtracted from
+        # the "xml" stage.
+        self.stage_seconds = collections.defaultdict(float)
+        self.stage_calls = collections.defaultdict(int)
+        self.page_seconds = 0.0
+        self.num_pages = 0
+        self.num_words = 0
+        # The ``slow_pages_max`` pages that took the longest in parsePage(),
+        # as a heap of ``(seconds, seq, record)``; see slowPages().
+        self.slow_pages_max = 0
+        self.slow_pages = []
+        self.slow_pages_seq = 0
+        self.page_sections = 0
+        # The time budget of a page in parsePage() in seconds, or None, and
+        # the stage it is in.  The pages that ran out of time are listed
+        # in ``quarantined``, and written with their text to
+        # ``quarantine_file`` if it is set; see quarantinePage().
+        self.page_timeout = None
+        self.stage = None
+        self.quarantined = []
+        self.quarantine_file = None
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        # Pages whose raw text has no section header containing the name of
+        # a captured language cannot produce any words, so they can be
+        # skipped before splitting them into sections.  Note that skipped
+        # pages are not included in the other statistics.
+        self.language_gate = None
+        if prefilter:
+            self.language_gate = re.compile(
+                r"==[^=\n]*?(" +
+                "|".join(re.escape(x) for x in capture_languages) +
+                r")")
+        self.input_pos = 0
+        self.prev_input_pos = 0
+        self.page_pos = 0
+        self.resume_pageid = None
+        # With memory-mapped input each page is fed as a separate chunk;
+        # the byte range of each page is then known.
+        self.page_chunks = False
+        self.page_ranges = collections.deque()
+        self.page_range = None
+        self.mapped_path = None
+        self.checkpoint_path = None
+        self.checkpoint_every = 0
+        self.checkpoint_cb = None
+        self.checkpoint_info = {}
+        self.checkpoint_queue = None
+        self.last_page = None
+        self.pages_since_checkpoint = 0
+        self.pool = None
+        self.workers = 0
+        self.batch_size = 0
+        self.batch = []
+        self.batch_keys = []
+        self.pending = collections.deque()
+        # The stats() of the sinks of parseWiktionary(), by name.
+        self.sink_stats = {}
 
     def start(self, tag, attrs):
         """This is called whenever an XML start tag is encountered."""
@@ -88,9 +254,20 @@ class WiktionaryParser(object):
         self.attrs = attrs
         self.data = []
         if tag == "page":
+            # A start tag may be reported only when the chunk after the one
+            # it begins in is fed, so the page starts at or after the
+            # beginning of the previous chunk.
+            self.page_pos = self.prev_input_pos
+            self.page_range = None
+            if self.page_ranges:
+                self.page_range = self.page_ranges.popleft()
             self.text = None
             self.title = None
+            self.ns = None
+            self.skip_page = False
             self.pageid = None
+            self.revid = None
+            self.sha1 = None
             self.redirect = None
             self.model = None
             self.format = None
@@ -106,6 +283,15 @@ class WiktionaryParser(object):
         attrs = self.attrs
         data = "".join(self.data).strip()
         self.data = []
+        # Once a page has been found to be in a namespace we don't capture,
+        # nothing more is collected for it, but in incremental mode it is
+        # still seen, so that it is not taken as deleted.
+        if self.skip_page:
+            if (tag == "id" and self.pageid is None and
+                self.store is not None and "revision" not in self.stack):
+                self.pageid = data
+                self.store.touch(data)
+            return
         if tag in definitions.ignore_tags:
             return
         for t in definitions.stack_ignore:
@@ -113,10 +299,28 @@ class WiktionaryParser(object):
                 return
         if tag == "id":
             if "revision" in self.stack:
+                self.revid = data
                 return
             self.pageid = data
+            # When resuming, skip everything up to and including the last
+            # page emitted before the checkpoint.
+            if self.resume_pageid is not None:
+                self.skip_page = True
+                if data == self.resume_pageid:
+                    self.resume_pageid = None
+        elif tag == "sha1":
+            self.sha1 = data
         elif tag == "title":
             self.title = data
+        elif tag == "ns":
+            self.ns = data
+            # The namespace names are only known if <siteinfo> has been
+            # seen; without them all pages are captured.
+            if (self.capture_namespaces is not None and self.namespaces and
+                self.resume_pageid is None and
+                self.namespaces.get(data) not in self.capture_namespaces):
+                self.skip_page = True
+                self.skip_counts["namespace"] += 1
         elif tag == "text":
             self.text = data
         elif tag == "redirect":
@@ -141,30 +345,499 @@ class WiktionaryParser(object):
             if self.model in ("css", "sanitized-css", "javascript",
                               "Scribunto"):
                 return
+            # In incremental mode, reuse the words of unchanged pages.
+            if self.store is not None:
+                words = self.store.lookup(pageid, self.sha1)
+                if words is not None:
+                    self.skip_counts["unchanged"] += 1
+                    if self.emit_unchanged:
+                        self.processPage(title, None, words, changed=False)
+                    return
             if redirect:
                 if self.capture_redirects:
                     data = {"redirect": redirect, "word": title}
-                    self.word_cb(data)
+                    self.processPage(title, None, [data])
+                else:
+                    self.recordSkipped(title)
             else:
                 # If a capture callback has been provided, skip this page.
                 if self.capture_cb and not self.capture_cb(title, self.text):
+                    self.recordSkipped(title)
+                    return
+                # Skip the page if no captured language can be on it.
+                if (self.language_gate is not None and
+                    not self.language_gate.search(self.text)):
+                    self.skip_counts["language"] += 1
+                    self.recordSkipped(title)
                     return
                 # Parse the page, and call ``word_cb`` for each captured
                 # word.
-                ret = parsePage(title, self.text, self)
-                for data in ret:
-                    self.word_cb(data)
+                self.processPage(title, self.text)
         else:
             print("UNSUPPORTED", tag, len(data), attrs)
 
     def data(self, data):
         """This function is called for data within an XML tag."""
+        if self.skip_page and self.tag != "id":
+            return
         self.data.append(data)
 
     def close(self):
         """This function is called when parsing is complete."""
         return None
 
+    def processPage(self, title, text, words=None, changed=True):
+        """Parses the page and calls ``word_cb`` for each captured word.
+        If worker processes have been started, the page is instead queued
+        in the current batch, and the words are delivered in dump order
+        as the batches complete.  ``words`` can be used to pass a list
+        of already constructed words (e.g., redirects) through the same
+        ordered path.  In incremental mode the words of the page are
+        stored unless ``changed`` is False."""
+        start = time.perf_counter()
+        page = (self.pageid, title, self.revid, self.sha1, self.page_pos)
+        if self.pool is None:
+            if words is None:
+                words = parsePage(title, text, self)
+            self.emitWords(words, page, changed)
+            self.pages_since_checkpoint += 1
+            self.maybeCheckpoint(self.skip_counts)
+        else:
+            if (self.mapped_path is not None and text is not None and
+                self.page_range is not None):
+                # The workers read the text from their own map of the dump.
+                text = self.page_range
+            self.batch.append((title, text, words))
+            self.batch_keys.append((page, changed))
+            if len(self.batch) >= self.batch_size:
+                self.submitBatch()
+        self.page_seconds += time.perf_counter() - start
+
+    def recordSkipped(self, title):
+        """Records in incremental mode that the current page produced no
+        words, so that it is not parsed again while it is unchanged."""
+        if self.store is not None:
+            self.processPage(title, None, [])
+
+    def emitWords(self, words, page, changed):
+        """Calls ``word_cb`` for each word from a page.  ``page`` is
+        ``(pageid, title, revid, sha1, pos)`` of the page.  In incremental
+        mode the words of changed pages are stored under it.  ``words``
+        is None for a page that ran out of time; it is not stored, so
+        that it is parsed again by the next incremental run."""
+        if words is None:
+            words = []
+        elif changed and self.store is not None:
+            self.store.update(*page[:4], words)
+        for data in words:
+            self.word_cb(data)
+        self.last_page = page
+        self.num_pages += 1
+        self.num_words += len(words)
+
+    def timeStage(self, stage, start, nested=0.0):
+        """Adds the time since ``start`` (a time.perf_counter() value), less
+        ``nested`` seconds spent in other stages, to the time of
+        ``stage``, and counts one call of it.  Returns the current time,
+        so that the next stage can be timed from it."""
+        now = time.perf_counter()
+        self.stage_seconds[stage] += now - start - nested
+        self.stage_calls[stage] += 1
+        return now
+
+    def trackSlowPage(self, title, text, seconds, before):
+        """Records a page that took ``seconds`` in parsePage() if it is
+        among the slowest so far.  ``before`` are the times of the
+        ``page_stages`` before the page was parsed."""
+        heap = self.slow_pages
+        if len(heap) >= self.slow_pages_max and seconds <= heap[0][0]:
+            return
+        self.addSlowPage({
+            "title": title,
+            "chars": len(text),
+            "sections": self.page_sections,
+            "seconds": seconds,
+            "stages": dict((stage, self.stage_seconds[stage] - t)
+                           for stage, t in zip(page_stages, before)),
+        })
+
+    def addSlowPage(self, record):
+        """Adds the ``record`` of a slow page from trackSlowPage(), dropping
+        the fastest page if there are more than ``slow_pages_max``."""
+        self.slow_pages_seq += 1
+        entry = (record["seconds"], self.slow_pages_seq, record)
+        if len(self.slow_pages) < self.slow_pages_max:
+            heapq.heappush(self.slow_pages, entry)
+        elif record["seconds"] > self.slow_pages[0][0]:
+            heapq.heapreplace(self.slow_pages, entry)
+
+    def slowPages(self):
+        """Returns the records of the slowest pages, slowest first.  Each has
+        the "title" of the page, the number of "chars" in its text and of
+        "sections", the "seconds" it took in parsePage(), and the seconds
+        of each of ``page_stages`` in "stages".  See also
+        profilePages()."""
+        return list(record for seconds, seq, record
+                    in sorted(self.slow_pages, reverse=True))
+
+    def quarantinePage(self, record, text):
+        """Records a page that parsePage() gave up on.  ``record`` has the
+        "title" of the page, the "stage" that was running (see report()),
+        the "seconds" spent on the page and the number of "chars" in
+        ``text``.  It is added to ``quarantined``, and written as a line
+        of JSON with the "text" to ``quarantine_file`` if it is set, so
+        that the page can be examined (e.g., with profilePages())."""
+        self.quarantined.append(record)
+        if self.quarantine_file is not None:
+            self.quarantine_file.write(json.dumps(dict(record, text=text)) +
+                                       "\n")
+            self.quarantine_file.flush()
+
+    def progress(self):
+        """Returns the progress of the run so far as a dict: the elapsed
+        "seconds", the numbers of "pages" and "words" emitted and their
+        rates, the uncompressed "mb" read and its rate, the rate in the
+        dump file itself ("input_mb_per_s", which differs for a
+        compressed dump), and the "fraction" of the dump file done and
+        the estimated seconds left ("eta_seconds"), or None if they are
+        not known yet."""
+        stats = self.read_stats
+        seconds = (self.end_time or time.perf_counter()) - self.start_time
+        done = stats["input_pos"] - stats["input_start"]
+        total = stats["input_size"] - stats["input_start"]
+        fraction = None
+        eta = None
+        if total > 0 and done > 0:
+            fraction = min(1.0, done / total)
+            eta = seconds * (total - done) / done
+        rate = 1 / seconds if seconds > 0 else 0.0
+        return {
+            "seconds": seconds,
+            "pages": self.num_pages,
+            "pages_per_s": self.num_pages * rate,
+            "words": self.num_words,
+            "words_per_s": self.num_words * rate,
+            "mb": stats["bytes"] / 1e6,
+            "mb_per_s": stats["bytes"] / 1e6 * rate,
+            "input_mb_per_s": max(0, done) / 1e6 * rate,
+            "fraction": fraction,
+            "eta_seconds": eta,
+        }
+
+    def report(self):
+        """Returns a JSON-serializable report of the run: its progress()
+        at the end, the reading statistics (see iterWords()), the
+        "seconds" and "calls" of each stage, and the other statistics.
+        The stages are:
+
+          read               waiting for (decompressed) input
+          xml                lxml and the parser callbacks
+          parse_page         parsing the pages, which includes:
+          split_subsections  finding the sections of the pages
+          etymology          finding the templates of etymology sections
+          clean_value        making records from the template arguments
+          workers            waiting for the workers to parse a batch
+          checkpoint         writing checkpoints, including checkpoint_cb
+          word_cb            consuming the words (e.g., in ``word_cb``)
+
+        With workers, the parsing stages are summed over all of them,
+        and so can add up to more than the elapsed time.  The slowest
+        pages are listed under "slow_pages" (see slowPages()), and the
+        pages that ran out of time under "quarantined" (see
+        quarantinePage())."""
+        stages = {"read": {"seconds": self.read_stats["wait_seconds"],
+                           "calls": self.read_stats["chunks"]}}
+        for stage, seconds in self.stage_seconds.items():
+            stages[stage] = {"seconds": seconds,
+                             "calls": self.stage_calls[stage]}
+        return {
+            "progress": self.progress(),
+            "read": dict(self.read_stats),
+            "stages": stages,
+            "language_counts": dict(self.language_counts),
+            "pos_counts": dict(self.pos_counts),
+            "section_counts": dict(self.section_counts),
+            "skip_counts": dict(self.skip_counts),
+            "clean_value_counts": dict(self.clean_value_counts),
+            "slow_pages": self.slowPages(),
+            "quarantined": list(self.quarantined),
+        }
+
+    def startCheckpoints(self, path, every, checkpoint_cb=None, info={}):
+        """Enables writing a checkpoint to ``path`` every ``every`` emitted
+        pages.  ``checkpoint_cb()`` is called just before each checkpoint
+        is written; it should flush the caller's output and return a
+        JSON-serializable value (e.g., output file offsets) that is saved
+        in the checkpoint.  ``info`` is saved in the checkpoint as is."""
+        assert isinstance(path, str)
+        assert isinstance(every, int) and every > 0
+        assert checkpoint_cb is None or callable(checkpoint_cb)
+        self.checkpoint_path = path
+        self.checkpoint_every = every
+        self.checkpoint_cb = checkpoint_cb
+        self.checkpoint_info = info
+
+    def maybeCheckpoint(self, skip_counts):
+        """Checkpoints the state after the last emitted page if enough pages
+        have been emitted since the previous checkpoint.  ``skip_counts``
+        are the skip statistics as they were after that page.  The
+        checkpoint is written right away, unless ``checkpoint_queue`` is
+        set (see iterWords()), in which case it is appended there after
+        the words of the page, to be written with writeCheckpoint() once
+        those have been consumed."""
+        if (self.checkpoint_path is None or
+            self.pages_since_checkpoint < self.checkpoint_every or
+            self.last_page is None):
+            return
+        self.pages_since_checkpoint = 0
+        pageid, title, revid, sha1, pos = self.last_page
+        state = dict(self.checkpoint_info)
+        state.update({
+            "pageid": pageid,
+            "title": title,
+            "input_pos": pos,
+            "namespaces": self.namespaces,
+            "language_counts": dict(self.language_counts),
+            "pos_counts": dict(self.pos_counts),
+            "section_counts": dict(self.section_counts),
+            "skip_counts": dict(skip_counts),
+        })
+        store_mark = None
+        if self.store is not None:
+            store_mark = self.store.mark()
+        checkpoint = PendingCheckpoint(state, store_mark)
+        if self.checkpoint_queue is not None:
+            self.checkpoint_queue.append(checkpoint)
+        else:
+            self.writeCheckpoint(checkpoint)
+
+    def writeCheckpoint(self, checkpoint):
+        """Atomically writes a checkpoint returned by maybeCheckpoint().  All
+        words up to and including its page must have been passed to
+        ``word_cb``."""
+        start = time.perf_counter()
+        state, store_mark = checkpoint
+        if self.store is not None:
+            self.store.flush(store_mark)
+        output = None
+        if self.checkpoint_cb is not None:
+            output = self.checkpoint_cb()
+        state = dict(state, output=output)
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        self.timeStage("checkpoint", start)
+
+    def resumeFrom(self, state):
+        """Restores the statistics from the checkpoint ``state`` and makes
+        the parser skip pages up to the last page emitted before it.
+        Returns the input position from which reading should continue."""
+        assert isinstance(state, dict)
+        self.namespaces = state["namespaces"]
+        for name in ("language_counts", "pos_counts", "section_counts",
+                     "skip_counts"):
+            setattr(self, name,
+                    collections.defaultdict(int, state[name]))
+        self.resume_pageid = state["pageid"]
+        return state["input_pos"]
+
+    def feed(self, chunks, resuming=False):
+        """Parses the XML document formed by the ``(pos, data)`` chunks
+        with this object as the parser target.  If ``resuming`` is True,
+        the chunks start in the middle of the document (at a position
+        returned by resumeFrom()); everything before the first ``<page>``
+        is then dropped and the document element is synthesized."""
+        for pos in self.iterFeed(chunks, resuming):
+            pass
+
+    def iterFeed(self, chunks, resuming=False):
+        """Like feed(), but yields the position of each chunk after it has
+        been parsed, so that the caller can consume what was emitted
+        for it before more input is read."""
+        parser = etree.XMLParser(target=self)
+        tail = b""
+        if resuming:
+            parser.feed(b"<mediawiki>")
+        for pos, data in chunks:
+            self.prev_input_pos = self.input_pos
+            self.input_pos = pos
+            if resuming:
+                # Keep a few bytes so that a <page> tag spanning two chunks
+                # is found.
+                data = tail + data
+                idx = data.find(b"<page>")
+                if idx < 0:
+                    tail = data[-5:]
+                    continue
+                data = data[idx:]
+                self.prev_input_pos = pos
+                resuming = False
+            if self.page_chunks and data.startswith(b"<page>"):
+                self.page_ranges.append((pos, pos + len(data)))
+            start = time.perf_counter()
+            page_seconds = self.page_seconds
+            parser.feed(data)
+            self.timeStage("xml", start, self.page_seconds - page_seconds)
+            yield pos
+        parser.close()
+
+    def startWorkers(self, workers, batch_size, mapped_path=None):
+        """Starts a pool of ``workers`` processes that run ``parsePage``
+        on batches of ``batch_size`` pages.  If ``mapped_path`` is the
+        path of the uncompressed dump being fed in page chunks, the
+        workers map it too and are sent the byte ranges of the pages
+        instead of their text."""
+        assert isinstance(workers, int) and workers > 0
+        assert isinstance(batch_size, int) and batch_size > 0
+        assert mapped_path is None or isinstance(mapped_path, str)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.mapped_path = mapped_path
+        self.pool = multiprocessing.Pool(
+            workers, _initWorker,
+            ((self.capture_languages, self.capture_translations,
+              self.capture_pronunciation, self.capture_linkages,
+              self.capture_compounds, self.capture_redirects),
+             clean_value_cache_stats()["maxsize"], mapped_path,
+             self.slow_pages_max, self.page_timeout))
+
+    def submitBatch(self):
+        """Sends the current batch to the worker pool.  At most two batches
+        per worker are kept in flight; beyond that we wait for the oldest
+        one, which also keeps the memory use bounded."""
+        if self.batch:
+            # The skip statistics are updated in this process as pages are
+            # read; keep a copy as of the end of the batch for checkpoints.
+            self.pending.append((self.pool.apply_async(_parseBatch,
+                                                       (self.batch,)),
+                                 self.batch_keys, dict(self.skip_counts)))
+            self.batch = []
+            self.batch_keys = []
+        while len(self.pending) > 2 * self.workers:
+            self.deliverBatch(*self.pending.popleft())
+
+    def deliverBatch(self, result, keys, skip_counts):
+        """Merges the statistics from a completed batch into this context
+        and calls ``word_cb`` for each word in it.  ``keys`` are the
+        ``(page, changed)`` arguments of emitWords() for the pages of the
+        batch, and ``skip_counts`` the skip statistics at the end of the
+        batch."""
+        start = time.perf_counter()
+        (pages, language_counts, pos_counts, section_counts,
+         clean_value_counts, stage_seconds, stage_calls, slow_pages,
+         quarantined) = result.get()
+        self.timeStage("workers", start)
+        for k, v in stage_seconds.items():
+            self.stage_seconds[k] += v
+        for k, v in stage_calls.items():
+            self.stage_calls[k] += v
+        for record in slow_pages:
+            self.addSlowPage(record)
+        for record, text in quarantined:
+            self.quarantinePage(record, text)
+        for k, v in clean_value_counts.items():
+            self.clean_value_counts[k] += v
+        for k, v in language_counts.items():
+            self.language_counts[k] += v
+        for k, v in pos_counts.items():
+            self.pos_counts[k] += v
+        for k, v in section_counts.items():
+            self.section_counts[k] += v
+        for words, (page, changed) in zip(pages, keys):
+            self.emitWords(words, page, changed)
+        # Checkpoints are only written between batches, as the statistics
+        # are merged per batch.
+        self.pages_since_checkpoint += len(pages)
+        self.maybeCheckpoint(skip_counts)
+
+    def flushWorkers(self):
+        """Submits the last partial batch and waits until all batches have
+        been delivered."""
+        if self.pool is None:
+            return
+        self.submitBatch()
+        while self.pending:
+            self.deliverBatch(*self.pending.popleft())
+
+    def stopWorkers(self):
+        """Shuts down the worker pool.  Batches that have not been
+        delivered are discarded."""
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        self.batch = []
+        self.batch_keys = []
+        self.pending.clear()
+
+
+# Parsing context of a worker process, and its map of the dump when the
+# input is memory-mapped.  These are created by _initWorker() when the
+# worker starts.
+_worker_ctx = None
+_worker_map = None
+
+def _discardWord(data):
+    """Word callback for worker contexts.  Words are returned from
+    _parseBatch() instead."""
+    pass
+
+def _initWorker(args, clean_cache_size, mapped_path, slow_pages_max,
+                page_timeout):
+    """Initializes the parsing context in a worker process."""
+    global _worker_ctx
+    global _worker_map
+    _worker_ctx = WiktionaryParser(_discardWord, None, *args)
+    _worker_ctx.slow_pages_max = slow_pages_max
+    _worker_ctx.page_timeout = page_timeout
+    if page_timeout is not None:
+        _startPageTimer(page_timeout)
+    set_clean_value_cache(clean_cache_size)
+    if mapped_path is not None:
+        _worker_map = dumpreader.openMapped(mapped_path)
+
+def _cleanValueCounts(before):
+    """Returns the hits, misses and evictions of the clean_value() cache
+    since ``before``, a result of clean_value_cache_stats()."""
+    after = clean_value_cache_stats()
+    return dict((k, after[k] - before[k])
+                for k in ("hits", "misses", "evictions"))
+
+def _parseBatch(batch):
+    """Parses a batch of ``(title, text, words)`` pages in a worker process.
+    ``text`` can also be the byte range of the page in the memory-mapped
+    dump.  Returns the list of words for each page (None for a page that
+    ran out of time), the statistics collected while parsing this batch,
+    and the records and texts of the pages that ran out of time."""
+    ctx = _worker_ctx
+    ctx.language_counts = collections.defaultdict(int)
+    ctx.pos_counts = collections.defaultdict(int)
+    ctx.section_counts = collections.defaultdict(int)
+    ctx.stage_seconds = collections.defaultdict(float)
+    ctx.stage_calls = collections.defaultdict(int)
+    ctx.slow_pages = []
+    ctx.quarantined = []
+    before = clean_value_cache_stats()
+    pages = []
+    quarantined = []
+    for title, text, words in batch:
+        if isinstance(text, tuple):
+            text = dumpreader.mappedPageText(_worker_map, *text)
+        if words is None:
+            words = parsePage(title, text, ctx)
+            if words is None:
+                quarantined.append((ctx.quarantined[-1], text))
+        pages.append(words)
+    return (pages, dict(ctx.language_counts), dict(ctx.pos_counts),
+            dict(ctx.section_counts), _cleanValueCounts(before),
+            dict(ctx.stage_seconds), dict(ctx.stage_calls),
+            ctx.slowPages(), quarantined)
+
+
 def pageIterator(word, text, ctx):
     """Iterates over the text of the page, returning words (parts-of-speech)
     defined on the page one at a time.  (Individual word senses for the
@@ -173,9 +846,18 @@ def pageIterator(word, text, ctx):
     assert isinstance(text, str)
     assert isinstance(ctx, WiktionaryParser)
 
-    # Divide the text into subsections.  We ignore the tree structure of
-    # sections because it has so many inconsistencies.
-    sections = split_subsections(text)
+    # Divide the text into subsections and blocks of subsections for each
+    # language.  We ignore the tree structure of sections because it has
+    # so many inconsistencies.  Sections are only sliced from the text
+    # when they are parsed.
+    start = time.perf_counter()
+    ctx.stage = "split_subsections"
+    text = remove_html_comments(text)
+    sections = list(iter_subsections(text))
+    blocks = language_blocks(sections)
+    ctx.page_sections = len(sections)
+    ctx.timeStage("split_subsections", start)
+    ctx.stage = "parse_page"
 
     def iteratorFunction():
         language = None
@@ -216,10 +898,11 @@ def pageIterator(word, text, ctx):
                 ret.append(dt)
             return ret
 
-        # Iterate over all sections on the page, looking for sections whose
-        # name matches the name of a known language.
-        for sectitle, text in sections:
-            if sectitle in wiktlangs.languages:
+        # Iterate over the blocks of sections for each language on the
+        # page.  The sections of blocks for languages that we are not
+        # capturing are only counted, without extracting their text.
+        for block_language, first, last in blocks:
+            if block_language is not None:
                 # Found section for a langauge.  First flush any information
                 # for the previous language.
                 # flushPos()
@@ -229,122 +912,125 @@ def pageIterator(word, text, ctx):
                     yield w
 
                 # Initialize for parsing words in the new language.
-                language = sectitle
+                language = block_language
                 ctx.language_counts[language] += 1
                 pos = None
                 base = {"word": clean_value(word), "lang": language}
                 wordData = {}
                 words = []
-                sectitle = ""
-            else:
-                # This title continues the previous language or could be
-                # a new language or a misspelling or a previously unsupported
-                # subtitle.
-                sectitle = sectitle.lower()
-                # if sectitle in pos_map:
-                #     # New part-of-speech.  Flush the old part-of-speech.
-                #     flushPos()
-                #     # Initialize for parsing the new part-of-speech.
-                #     pos = pos_map[sectitle]
-                #     ctx.pos_counts[pos] += 1
-                #     wordData = {}
-                #     sectitle = ""
-                # else:
-                #     # We don't recognize this subtitle.  Include it in the
-                #     # counts; the counts should be periodically investigates
-                #     # to find out if new languages have been added.
-                ctx.section_counts[sectitle] += 1
+
+            # The other titles continue the language or could be a new
+            # language or a misspelling or a previously unsupported
+            # subtitle.
+            # if sectitle in pos_map:
+            #     # New part-of-speech.  Flush the old part-of-speech.
+            #     flushPos()
+            #     # Initialize for parsing the new part-of-speech.
+            #     pos = pos_map[sectitle]
+            #     ctx.pos_counts[pos] += 1
+            #     wordData = {}
+            #     sectitle = ""
+            # else:
+            #     # We don't recognize this subtitle.  Include it in the
+            #     # counts; the counts should be periodically investigates
+            #     # to find out if new languages have been added.
+            for (sectitle, is_language, kind), start, end in \
+                    sections[first:last]:
+                if not is_language:
+                    ctx.section_counts[sectitle.lower()] += 1
 
             # Check if this is a language we are capturing.  If not, just
-            # skip the section.
+            # skip the block.
             if language not in ctx.capture_languages:
                 continue
 
-            # LF: Commented out because it was removing Etymology 1 sections
-            # if pos is None:
-            #     # Have not yet seen a part-of-speech.  However, this initial
-            #     # part frequently contains pronunciation information that
-            #     # is shared by all parts of speech.  We don't care here
-            #     # whether it is under a ``pronunciation`` subsection, because
-            #     # the structure may vary.
-            #     if ctx.capture_pronunciation:
-            #         p = wikitextparser.parse(text)
-            #         parse_pronunciation(word, base, text, p)
-            #     continue
-
-            # Remove any numbers at the end of the section title.
-            sectitle = re.sub(r"\s+\d+(\.\d+)$", "", sectitle)
-
-            # Apply corrections to common misspellings in sectitle
-            if sectitle in sectitle_corrections:
-                sectitle = sectitle_corrections[sectitle]
-
-            # Mostly ignore etymology sections, as they often seem to contain
-            # links that could be misinterpreted as something else.
-            # We don't want to completely ignore Usage notes or References
-            # or Anagrams, as they are often the last section of an entry
-            # and thus completely ignoring them might miss classifications
-            # etc.
-            #
-            # However, we do want to collect information about the parts of
-            # compound words from the etymology sections (this is particularly
-            # useful for Finnish).
-            if sectitle.startswith("etymology"):
-                parseEtymology(word, wordData, text)
-                continue
+            for (sectitle, is_language, kind), start, end in \
+                    sections[first:last]:
+                # LF: Commented out because it was removing Etymology 1
+                # sections
+                # if pos is None:
+                #     # Have not yet seen a part-of-speech.  However, this
+                #     # initial part frequently contains pronunciation
+                #     # information that is shared by all parts of speech.
+                #     # We don't care here whether it is under a
+                #     # ``pronunciation`` subsection, because the structure
+                #     # may vary.
+                #     if ctx.capture_pronunciation:
+                #         p = wikitextparser.parse(text)
+                #         parse_pronunciation(word, base, text, p)
+                #     continue
+
+                # The normalized section title: lowercase, without numbers at
+                # the end, and with common misspellings corrected.
+                sectitle = kind
+
+                # Mostly ignore etymology sections, as they often seem to
+                # contain links that could be misinterpreted as something
+                # else.  We don't want to completely ignore Usage notes or
+                # References or Anagrams, as they are often the last section
+                # of an entry and thus completely ignoring them might miss
+                # classifications etc.
+                #
+                # However, we do want to collect information about the parts
+                # of compound words from the etymology sections (this is
+                # particularly useful for Finnish).
+                if sectitle.startswith("etymology"):
+                    parseEtymology(word, wordData, text[start:end], ctx)
+                    continue
+
+                # # Parse the section contents.
+                # p = wikitextparser.parse(text)
 
-            # # Parse the section contents.
-            # p = wikitextparser.parse(text)
-
-            # # If the section title is empty, it is the preamble (text before
-            # # the first subsection for the language).
-            # if sectitle == "":  # Preamble
-            #     parse_preamble(word, wordData, pos, text, p)
-            # # If the section title title indicates pronunciation, parse it here.
-            # elif sectitle == "pronunciation":
-            #     if ctx.capture_pronunciation:
-            #         parse_pronunciation(word, wordData, text, p)
-            # # Parse various linkage sections, defaulting to the linkage type
-            # # indicated by the section header.
-            # elif sectitle == "synonyms":
-            #     if ctx.capture_linkages:
-            #         parse_linkage(word, wordData, "synonyms", text, p)
-            # elif sectitle == "hypernyms":
-            #     if ctx.capture_linkages:
-            #         parse_linkage(word, wordData, "hypernyms", text, p)
-            # elif sectitle == "hyponyms":
-            #     if ctx.capture_linkages:
-            #         parse_linkage(word, wordData, "hyponyms", text, p)
-            # elif sectitle == "antonyms":
-            #     if ctx.capture_linkages:
-            #         parse_linkage(word, wordData, "antonyms", text, p)
-            # elif sectitle == "derived terms":
-            #     if ctx.capture_linkages:
-            #         parse_linkage(word, wordData, "derived", text, p)
-            # elif sectitle == "related terms":
-            #     if ctx.capture_linkages:
-            #         parse_linkage(word, wordData, "related", text, p)
-            # # Parse abbreviations.
-            # elif sectitle == "abbreviations":
-            #     parse_linkage(word, wordData, "abbreviations", text, p)
-            # # Parse proverbs.
-            # elif sectitle == "proverbs":
-            #     parse_linkage(word, wordData, "abbreviations", text, p)
-            # # Parse compounds using the word.
-            # elif sectitle == "compounds":
-            #     if ctx.capture_compounds:
-            #         parse_linkage(word, wordData, "compounds", text, p)
-            # # We skip declension information here, as it is parsed from all
-            # # sections in parse_any().
-            # elif sectitle in ("declension", "conjugation"):
-            #     pass
-            # # XXX warn on other sections
-
-            # # XXX LF: parse etymology function?
+                # # If the section title is empty, it is the preamble (text
+                # # before the first subsection for the language).
+                # if sectitle == "":  # Preamble
+                #     parse_preamble(word, wordData, pos, text, p)
+                # # If the section title title indicates pronunciation, parse
+                # # it here.
+                # elif sectitle == "pronunciation":
+                #     if ctx.capture_pronunciation:
+                #         parse_pronunciation(word, wordData, text, p)
+                # # Parse various linkage sections, defaulting to the linkage
+                # # type indicated by the section header.
+                # elif sectitle == "synonyms":
+                #     if ctx.capture_linkages:
+                #         parse_linkage(word, wordData, "synonyms", text, p)
+                # elif sectitle == "hypernyms":
+                #     if ctx.capture_linkages:
+                #         parse_linkage(word, wordData, "hypernyms", text, p)
+                # elif sectitle == "hyponyms":
+                #     if ctx.capture_linkages:
+                #         parse_linkage(word, wordData, "hyponyms", text, p)
+                # elif sectitle == "antonyms":
+                #     if ctx.capture_linkages:
+                #         parse_linkage(word, wordData, "antonyms", text, p)
+                # elif sectitle == "derived terms":
+                #     if ctx.capture_linkages:
+                #         parse_linkage(word, wordData, "derived", text, p)
+                # elif sectitle == "related terms":
+                #     if ctx.capture_linkages:
+                #         parse_linkage(word, wordData, "related", text, p)
+                # # Parse abbreviations.
+                # elif sectitle == "abbreviations":
+                #     parse_linkage(word, wordData, "abbreviations", text, p)
+                # # Parse proverbs.
+                # elif sectitle == "proverbs":
+                #     parse_linkage(word, wordData, "abbreviations", text, p)
+                # # Parse compounds using the word.
+                # elif sectitle == "compounds":
+                #     if ctx.capture_compounds:
+                #         parse_linkage(word, wordData, "compounds", text, p)
+                # # We skip declension information here, as it is parsed from
+                # # all sections in parse_any().
+                # elif sectitle in ("declension", "conjugation"):
+                #     pass
+                # # XXX warn on other sections
+
+                # # XXX LF: parse etymology function?
             
-            # # Some information is parsed from any section.
-            # parse_any(word, base, wordData, text, pos, sectitle,
-            #           p, ctx.capture_translations)
+                # # Some information is parsed from any section.
+                # parse_any(word, base, wordData, text, pos, sectitle,
+                #           p, ctx.capture_translations)
 
         # Finally flush the last language.
         flushPos()
@@ -358,13 +1044,40 @@ def parsePage(word, text, ctx):
     one for each word/part-of-speech defined on the page for the languages
     specified by ``capture_languages``.  ``word`` is page title, and ``text``
     is page text in Wikimedia format.  Other arguments indicate what is
-    captured."""
+    captured.
+
+    If ``ctx.page_timeout`` is set, a page that takes longer than that is
+    given up on: it is recorded with ctx.quarantinePage() and None is
+    returned.  SIGALRM must then be handled by _startPageTimer()."""
+    global _page_timer_armed
     assert isinstance(word, str)
     assert isinstance(text, str)
     assert isinstance(ctx, WiktionaryParser)
 
-    # Collect all words from the page.
-    words = list(x for x in pageIterator(word, text, ctx))
+    # Collect all words from the page, keeping track of the slowest pages.
+    start = time.perf_counter()
+    if ctx.slow_pages_max:
+        before = list(ctx.stage_seconds[stage] for stage in page_stages)
+    if ctx.page_timeout is None:
+        words = list(x for x in pageIterator(word, text, ctx))
+    else:
+        ctx.stage = "parse_page"
+        try:
+            _page_timer_armed = True
+            signal.setitimer(signal.ITIMER_REAL, ctx.page_timeout)
+            words = list(x for x in pageIterator(word, text, ctx))
+            _page_timer_armed = False
+        except PageTimeout:
+            words = None
+            ctx.quarantinePage({"title": word, "stage": ctx.stage,
+                                "seconds": time.perf_counter() - start,
+                                "chars": len(text)}, text)
+        finally:
+            _page_timer_armed = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    now = ctx.timeStage("parse_page", start)
+    if ctx.slow_pages_max:
+        ctx.trackSlowPage(word, text, now - start, before)
 
     # # Do some post-processing on the words.  For example, we may distribute
     # # conjugation information to all the words.
@@ -406,15 +1119,283 @@ def parseWiktionary(path, word_cb, capture_cb=None,
                      pronunciations=False,
                      linkages=False,
                      compounds=False,
-                     redirects=False):
+                     redirects=False,
+                     workers=0,
+                     batch_size=100,
+                     index_path=None,
+                     decompress_workers=0,
+                     prefilter=False,
+                     namespaces=None,
+                     incremental=None,
+                     emit_unchanged=True,
+                     checkpoint=None,
+                     checkpoint_every=10000,
+                     checkpoint_cb=None,
+                     resume_from=None,
+                     clean_cache_size=100000,
+                     prefetch=0,
+                     decompressor=None,
+                     mapped=False,
+                     shard=None,
+                     progress=0,
+                     progress_cb=None,
+                     report=None,
+                     slow_pages=20,
+                     page_timeout=None,
+                     quarantine=None,
+                     sinks=None,
+                     sink_queue_size=10000):
     """Parses Wiktionary from the dump file ``path`` (which should point
     to a "enwiktionary-<date>-pages-articles.xml.bz2" file.  This
     calls ``capture_cb(title)`` for each raw page (if provided), and
     if it returns True, and calls ``word_cb(data)`` for all words
     defined for languages in ``languages``.  The other keyword
-    arguments control what data is to be extracted."""
+    arguments control what data is to be extracted.
+
+    If ``workers`` is greater than zero, the XML is still read in this
+    process, but the pages are parsed in that many worker processes,
+    ``batch_size`` pages at a time.  ``word_cb`` is always called in
+    this process, in the same order as in a serial run, and the
+    statistics of the workers are merged into the returned context.
+
+    If ``index_path`` is given, ``path`` must be a
+    "enwiktionary-<date>-pages-articles-multistream.xml.bz2" file and
+    ``index_path`` the corresponding "...-multistream-index.txt.bz2".
+    The independent bz2 streams of the dump are then decompressed in
+    ``decompress_workers`` worker processes and fed to the parser in
+    order.
+
+    If ``prefilter`` is True, pages whose raw text has no section header
+    mentioning any of ``languages`` are skipped before any further
+    parsing, which is much faster when capturing a few languages.  Their
+    number is counted in ``ctx.skip_counts["language"]``, but the
+    languages and sections of skipped pages are not included in the
+    other statistics, so ``ctx.language_counts`` and
+    ``ctx.section_counts`` then no longer show all the languages and
+    headings in the dump.
+
+    ``namespaces`` can be a list of namespace names (as listed in the
+    ``<siteinfo>`` of the dump, "" being the main namespace) from which
+    pages are captured.  The text of pages in other namespaces is not
+    even collected; they are counted in ``ctx.skip_counts["namespace"]``.
+    By default pages in all namespaces are captured.
+
+    If ``incremental`` is given, it is the path of a ``PageStore``
+    database that records the sha1 and the extracted words of every
+    page across runs.  Only new pages and pages whose sha1 has changed
+    are then parsed.  The stored words of unchanged pages are passed to
+    ``word_cb`` as if they had been parsed, unless ``emit_unchanged``
+    is False, and their number is counted in
+    ``ctx.skip_counts["unchanged"]``.  The stored words are only reused
+    if the languages, the other extraction flags, ``namespaces`` and
+    ``capture_cb`` (compared by name) are those of the previous run;
+    otherwise all pages are parsed again.  After the whole dump has been
+    read, ``word_cb`` is called with ``{"word": title, "pageid": pageid,
+    "deleted": True}`` for each page that is no longer in the dump.
+
+    If ``checkpoint`` is given, a checkpoint is atomically written to that
+    path every ``checkpoint_every`` emitted pages.  It records the last
+    page whose words have all been passed to ``word_cb``, the input
+    position, the statistics, and the value returned by
+    ``checkpoint_cb()`` (which should flush the output and return its
+    offsets).  The checkpoint is removed when the run completes and the
+    sinks (if any) have been closed.  A run
+    that was interrupted can be continued by passing the checkpoint as
+    ``resume_from`` (see also loadCheckpoint()); reading then continues
+    from the saved position and ``word_cb`` is called only for the
+    pages after the checkpoint.
+
+    The results of clean_value() are cached for up to ``clean_cache_size``
+    distinct values per process (0 turns the cache off).  The hits,
+    misses and evictions of the caches are summed in
+    ``ctx.clean_value_counts``.
+
+    If ``prefetch`` is greater than zero, the input is read (and
+    decompressed) in a separate thread that stays up to that many
+    chunks ahead of the parser.  The amount of input, the time spent
+    reading it and waiting for it, and the resulting throughput in MB/s
+    are returned in ``ctx.read_stats`` (see dumpreader.throughput()).
+
+    A compressed dump (".bz2", ".gz", ".xz" or ".zst") other than a
+    multistream one is decompressed by an external command such as
+    lbzip2 if one is installed, and otherwise by a Python module.
+    ``decompressor`` can be a command to use instead, or "python"; see
+    dumpreader.iterFile().
+
+    If ``mapped`` is True, ``path`` must be an uncompressed dump.  It is
+    then memory-mapped and fed to the parser a page at a time, and the
+    workers (if any) read the text of the pages from their own map of
+    the file instead of being sent it.  ``shard`` can be a ``(start,
+    end)`` byte range from dumpreader.shardRanges(), to parse only the
+    pages in that part of the dump (this implies ``mapped``), e.g. in
+    several processes.
+
+    The time spent in each stage of the parsing (reading, XML parsing,
+    splitting pages into sections, etc.) is accumulated in the context;
+    see WiktionaryParser.report().  If ``progress`` is greater than
+    zero, ``progress_cb(ctx.progress())`` is called about every that
+    many seconds (by default a line is printed to stderr) with the
+    pages and words emitted so far, the throughput, and an estimate of
+    the time left.  If ``report`` is given, the report of a completed
+    run is written to that path as JSON.  It includes the
+    ``slow_pages`` pages that took the longest to parse (see
+    WiktionaryParser.slowPages()), which can be parsed again under
+    the profiler with profilePages().
+
+    If ``page_timeout`` is given, a page that takes longer than that many
+    seconds to parse is given up on, and the run continues with the
+    next page.  Such pages produce no words (and are not stored in
+    incremental mode, so that they are tried again by the next run).
+    They are listed with their title, the stage that was running and
+    the time taken in ``ctx.quarantined`` and in the report, and
+    written with their text as lines of JSON to the file ``quarantine``
+    if it is given (appending to it when resuming).  The time budget
+    uses SIGALRM, so this must be called in the main thread of a
+    process that does not otherwise use it.
+
+    ``sinks`` can be a list of sinks (see sinks.FanOut), e.g., a
+    sinks.JsonlSink, a neo4jcontroller.Neo4jSink, a sinks.StatsSink and
+    functions, to which the words are passed as well as to ``word_cb``
+    (which can then be None).  Each sink is written in its own thread
+    through a queue of up to ``sink_queue_size`` words, so that they
+    all get the words of a single pass over the dump and a slow sink
+    only holds up parsing once its queue is full.  The queues are
+    drained and the sinks flushed before each checkpoint (before
+    ``checkpoint_cb()`` is called), and the sinks are closed at the end
+    of the run, or when it fails.  An exception raised by a sink is
+    raised again here.  The statistics of their queues are returned in
+    ``ctx.sink_stats``."""
+    assert word_cb is None or callable(word_cb)
+    assert word_cb is not None or sinks
+    fanout = None
+    if sinks:
+        fanout = sinkutils.FanOut(sinks, sink_queue_size)
+        output_cb = checkpoint_cb
+
+        def checkpoint_cb():
+            # The words before the checkpoint must have been written.
+            fanout.flush()
+            if output_cb is not None:
+                return output_cb()
+            return None
+
+    words = iterWords(path, capture_cb,
+                      languages=languages,
+                      translations=translations,
+                      pronunciations=pronunciations,
+                      linkages=linkages,
+                      compounds=compounds,
+                      redirects=redirects,
+                      workers=workers,
+                      batch_size=batch_size,
+                      index_path=index_path,
+                      decompress_workers=decompress_workers,
+                      prefilter=prefilter,
+                      namespaces=namespaces,
+                      incremental=incremental,
+                      emit_unchanged=emit_unchanged,
+                      checkpoint=checkpoint,
+                      checkpoint_every=checkpoint_every,
+                      checkpoint_cb=checkpoint_cb,
+                      keep_checkpoint=True,
+                      resume_from=resume_from,
+                      clean_cache_size=clean_cache_size,
+                      prefetch=prefetch,
+                      decompressor=decompressor,
+                      mapped=mapped,
+                      shard=shard,
+                      progress=progress,
+                      progress_cb=progress_cb,
+                      report=report,
+                      slow_pages=slow_pages,
+                      page_timeout=page_timeout,
+                      quarantine=quarantine)
+    try:
+        while True:
+            try:
+                data = next(words)
+            except StopIteration as e:
+                ctx = e.value
+                if fanout is not None:
+                    fanout.close()
+                    ctx.sink_stats = fanout.stats()
+                # The words have all been written.
+                if checkpoint is not None:
+                    removeCheckpoint(checkpoint)
+                # Return the parsing context.  At least the statistics
+                # fields are accessible:
+                #   ctx.language_counts
+                #   ctx.pos_counts
+                #   ctx.section_counts
+                #   ctx.skip_counts
+                #   ctx.clean_value_counts
+                #   ctx.read_stats
+                #   ctx.sink_stats
+                #   ctx.report()
+                return ctx
+            if word_cb is not None:
+                word_cb(data)
+            if fanout is not None:
+                fanout.addWord(data)
+    except BaseException:
+        if fanout is not None:
+            fanout.close(raise_errors=False)
+        raise
+    finally:
+        # Stop the workers, restore the signal handler, etc. right away
+        # rather than when the generator is garbage-collected.
+        words.close()
+
+
+def iterWords(path, capture_cb=None,
+               languages=["English", "Translingual"],
+               translations=False,
+               pronunciations=False,
+               linkages=False,
+               compounds=False,
+               redirects=False,
+               workers=0,
+               batch_size=100,
+               index_path=None,
+               decompress_workers=0,
+               prefilter=False,
+               namespaces=None,
+               incremental=None,
+               emit_unchanged=True,
+               checkpoint=None,
+               checkpoint_every=10000,
+               checkpoint_cb=None,
+               keep_checkpoint=False,
+               resume_from=None,
+               clean_cache_size=100000,
+               prefetch=0,
+               decompressor=None,
+               mapped=False,
+               shard=None,
+               progress=0,
+               progress_cb=None,
+               report=None,
+               slow_pages=20,
+               page_timeout=None,
+               quarantine=None):
+    """Iterates over the words in the dump file ``path``, yielding the
+    words that parseWiktionary() would pass to ``word_cb``, in the same
+    order.  The other arguments are as for parseWiktionary().  The
+    input is read and parsed only as the words are consumed, one chunk
+    at a time, so a slow consumer holds back the parsing (and the
+    workers) instead of letting words pile up in memory.  The parsing
+    context, which holds the statistics, is the return value of the
+    generator (e.g., ``ctx = yield from iterWords(...)``).
+
+    Checkpoints are written when the word after the last word of the
+    checkpointed page is requested; by then the consumer must have
+    finished with (e.g., written out) all the words it has received.
+    The checkpoint is removed when the last word has been consumed,
+    unless ``keep_checkpoint`` is True, e.g., for a consumer that
+    writes the words in another thread (see sinks.AsyncSink) and must
+    only remove it with removeCheckpoint() once they have all been
+    written."""
     assert isinstance(path, str)
-    assert callable(word_cb)
     assert capture_cb is None or callable(capture_cb)
     assert isinstance(languages, (list, tuple, set))
     for x in languages:
@@ -425,28 +1406,330 @@ def parseWiktionary(path, word_cb, capture_cb=None,
     assert linkages in (True, False)
     assert compounds in (True, False)
     assert redirects in (True, False)
+    assert isinstance(workers, int) and workers >= 0
+    assert isinstance(batch_size, int) and batch_size > 0
+    assert index_path is None or isinstance(index_path, str)
+    assert isinstance(decompress_workers, int) and decompress_workers >= 0
+    assert prefilter in (True, False)
+    assert namespaces is None or isinstance(namespaces, (list, tuple, set))
+    assert incremental is None or isinstance(incremental, str)
+    assert emit_unchanged in (True, False)
+    assert checkpoint is None or isinstance(checkpoint, str)
+    assert isinstance(checkpoint_every, int) and checkpoint_every > 0
+    assert checkpoint_cb is None or callable(checkpoint_cb)
+    assert keep_checkpoint in (True, False)
+    assert resume_from is None or isinstance(resume_from, str)
+    assert isinstance(clean_cache_size, int) and clean_cache_size >= 0
+    assert isinstance(prefetch, int) and prefetch >= 0
+    assert (decompressor is None or decompressor == "python" or
+            isinstance(decompressor, (list, tuple)))
+    assert mapped in (True, False)
+    assert shard is None or (isinstance(shard, (list, tuple)) and
+                             len(shard) == 2)
+    assert isinstance(progress, (int, float)) and progress >= 0
+    assert progress_cb is None or callable(progress_cb)
+    assert report is None or isinstance(report, str)
+    assert isinstance(slow_pages, int) and slow_pages >= 0
+    assert page_timeout is None or (isinstance(page_timeout, (int, float))
+                                    and page_timeout > 0)
+    assert quarantine is None or isinstance(quarantine, str)
+    if shard is not None:
+        shard = list(shard)
+        mapped = True
+    if mapped and (index_path is not None or
+                   os.path.splitext(path)[1] in dumpreader.decompressors):
+        raise ValueError("{}: only uncompressed dumps can be memory-mapped"
+                         .format(path))
 
-    # Open the input file.
-    if path.endswith(".bz2"):
-        wikt_f = bz2.BZ2File(path, "r", buffering=(4 * 1024 * 1024))
-    else:
-        wikt_f = open(path, "rb", buffering=(4 * 1024 * 1024))
+    # Open the store of pages from previous runs.  With checkpoints, the
+    # store is only flushed when a checkpoint is written, so that it never
+    # gets ahead of the checkpoint.
+    store = None
+    if incremental is not None:
+        # The stored words are only reused by runs that would extract the
+        # same words from the same pages.
+        settings = {"languages": sorted(languages),
+                    "translations": translations,
+                    "pronunciations": pronunciations,
+                    "linkages": linkages,
+                    "compounds": compounds,
+                    "redirects": redirects,
+                    "namespaces": (None if namespaces is None
+                                   else sorted(namespaces)),
+                    "capture_cb": (None if capture_cb is None else
+                                   getattr(capture_cb, "__module__", "") +
+                                   "." +
+                                   getattr(capture_cb, "__qualname__", ""))}
+        store = pagestore.PageStore(incremental,
+                                    None if checkpoint else 10000, settings)
+
+    # Create parsing context.  The words and checkpoints it emits are
+    # queued, to be yielded and written in order.
+    queue = collections.deque()
+    ctx = WiktionaryParser(queue.append, capture_cb,
+                           languages, translations,
+                           pronunciations, linkages, compounds,
+                           redirects, prefilter=prefilter,
+                           capture_namespaces=namespaces, store=store,
+                           emit_unchanged=emit_unchanged)
+    ctx.slow_pages_max = slow_pages
+    ctx.page_timeout = page_timeout
+    completed = False
+    # Continue from a checkpoint of an interrupted run.
+    start = 0
+    if resume_from is not None:
+        state = loadCheckpoint(resume_from)
+        if (state.get("path") != path or
+            state.get("index_path") != index_path or
+            state.get("shard") != shard):
+            raise ValueError("{}: checkpoint is for a different input"
+                             .format(resume_from))
+        start = ctx.resumeFrom(state)
+    if checkpoint is not None:
+        ctx.startCheckpoints(checkpoint, checkpoint_every, checkpoint_cb,
+                             {"path": path, "index_path": index_path,
+                              "shard": shard})
+        ctx.checkpoint_queue = queue
+
+    def drain():
+        # Yields the words emitted so far, writing each checkpoint once the
+        # words before it have been consumed.
+        while queue:
+            item = queue.popleft()
+            if isinstance(item, PendingCheckpoint):
+                ctx.writeCheckpoint(item)
+            else:
+                start = time.perf_counter()
+                yield item
+                ctx.timeStage("word_cb", start)
 
+    # Without workers, the pages are timed in this process.
+    timer_handler = None
+    if page_timeout is not None:
+        timer_handler = _startPageTimer(page_timeout)
+        if quarantine is not None:
+            ctx.quarantine_file = open(quarantine,
+                                       "a" if resume_from else "w")
+    set_clean_value_cache(clean_cache_size)
+    clean_value_before = clean_value_cache_stats()
+    if workers > 0:
+        ctx.startWorkers(workers, batch_size, path if mapped else None)
+    if progress_cb is None:
+        progress_cb = printProgress
+    read_start = time.perf_counter()
+    ctx.start_time = read_start
+    next_progress = read_start + progress
     try:
-        # Create parsing context.
-        ctx = WiktionaryParser(word_cb, capture_cb,
-                               languages, translations,
-                               pronunciations, linkages, compounds,
-                               redirects)
-        # Parse the XML file.
-        parser = etree.XMLParser(target=ctx)
-        etree.parse(wikt_f, parser)
+        # Open the input file.  The decompressed streams of a multistream
+        # dump are fed to the parser in order.  The progress is measured
+        # in the dump file itself, from where reading starts.
+        stats = ctx.read_stats
+        stats["input_size"] = os.path.getsize(path)
+        if index_path is not None:
+            stats["input_start"] = stats["input_pos"] = start
+            chunks = dumpreader.iterMultistream(path, index_path,
+                                                decompress_workers, start)
+        elif mapped:
+            # The XML before the first page is needed when starting a
+            # shard, but not when resuming (the checkpoint has it).
+            shard_start, shard_end = shard or (0, None)
+            shard_start = max(start, shard_start)
+            if shard_end is not None:
+                stats["input_size"] = shard_end
+            stats["input_start"] = stats["input_pos"] = shard_start
+            chunks = dumpreader.iterMapped(path, shard_start, shard_end,
+                                           header=(resume_from is None))
+            ctx.page_chunks = True
+        else:
+            # A compressed dump is decompressed from the start even when
+            # resuming.
+            if os.path.splitext(path)[1] not in dumpreader.decompressors:
+                stats["input_start"] = stats["input_pos"] = start
+            chunks = dumpreader.iterFile(path, start,
+                                         decompressor=decompressor,
+                                         stats=stats)
+        if prefetch > 0:
+            chunks = dumpreader.prefetchChunks(chunks, prefetch, stats)
+        chunks = dumpreader.timeChunks(chunks, stats,
+                                       file_positions=(index_path is not None
+                                                       or mapped))
+        try:
+            # Parse the XML file, yielding the words from each chunk before
+            # reading the next one.
+            for pos in ctx.iterFeed(chunks, (resume_from is not None)):
+                yield from drain()
+                if progress and time.perf_counter() >= next_progress:
+                    progress_cb(ctx.progress())
+                    next_progress = time.perf_counter() + progress
+            stats["input_pos"] = stats["input_size"]
+        finally:
+            chunks.close()
+            ctx.read_stats["seconds"] = time.perf_counter() - read_start
+            if prefetch == 0:
+                ctx.read_stats["read_seconds"] = \
+                    ctx.read_stats["wait_seconds"]
+            dumpreader.throughput(ctx.read_stats)
+        # Deliver the words from any batches still being parsed.
+        ctx.flushWorkers()
+        yield from drain()
+        # Report the pages that have disappeared since the previous run.
+        if store is not None:
+            for pageid, title in store.deletions():
+                yield {"word": title, "pageid": pageid, "deleted": True}
+        completed = True
     finally:
-        wikt_f.close()
-
-    # Return the parsing context.  At least the statistics fields are
-    # accessible:
-    #   ctx.language_counts
-    #   ctx.pos_counts
-    #   ctx.section_counts
+        ctx.end_time = time.perf_counter()
+        ctx.stopWorkers()
+        if page_timeout is not None:
+            _stopPageTimer(timer_handler)
+        if ctx.quarantine_file is not None:
+            ctx.quarantine_file.close()
+        if store is not None:
+            store.close(completed)
+        for k, v in _cleanValueCounts(clean_value_before).items():
+            ctx.clean_value_counts[k] += v
+    if checkpoint is not None and not keep_checkpoint:
+        removeCheckpoint(checkpoint)
+    if report is not None:
+        with open(report, "w") as f:
+            json.dump(ctx.report(), f, indent=2, sort_keys=True)
     return ctx
+
+
+def printProgress(progress):
+    """Prints a line for a ``progress`` dict from WiktionaryParser.progress()
+    to stderr.  This is the default ``progress_cb`` of iterWords()."""
+    line = ("{pages} pages ({pages_per_s:.0f}/s), {words} words, "
+            "{mb:.1f} MB ({mb_per_s:.1f} MB/s, dump {input_mb_per_s:.1f} "
+            "MB/s)".format(**progress))
+    if progress["fraction"] is not None:
+        eta = int(progress["eta_seconds"])
+        line += ", {:.1f}% done, ETA {}:{:02}:{:02}".format(
+            100 * progress["fraction"], eta // 3600, eta // 60 % 60, eta % 60)
+    print(line, file=sys.stderr, flush=True)
+
+
+def loadCheckpoint(path):
+    """Loads a checkpoint written by ``parseWiktionary``.  The ``"output"``
+    key holds the value that was returned by ``checkpoint_cb``."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def removeCheckpoint(path):
+    """Removes the checkpoint ``path`` of a completed run, if it exists."""
+    if os.path.exists(path):
+        os.remove(path)
+
+def parseWord(path, title, languages=["English", "Translingual"],
+              translations=False,
+              pronunciations=False,
+              linkages=False,
+              compounds=False,
+              redirects=True,
+              db_path=None):
+    """Parses the single page ``title`` from the dump file ``path`` and
+    returns the list of words defined on it for languages in
+    ``languages``.  This uses the title index built by
+    ``dumpreader.buildTitleIndex()`` to seek directly to the page, so
+    ``path`` must be either a multistream bz2 dump or an uncompressed
+    XML dump.  Raises KeyError if the page is not in the index."""
+    assert isinstance(path, str)
+    assert isinstance(title, str)
+    assert isinstance(languages, (list, tuple, set))
+    for x in languages:
+        assert isinstance(x, str)
+        assert x in wiktlangs.languages
+
+    entry = dumpreader.lookupTitle(path, title, db_path)
+    if entry is None:
+        raise KeyError(title)
+    offset, pageid = entry
+
+    # A bz2 stream holds many pages; only the requested one is parsed.
+    words = []
+
+    def word_cb(data):
+        if ctx.title == title:
+            words.append(data)
+
+    def capture_cb(page_title, text):
+        return page_title == title
+
+    ctx = WiktionaryParser(word_cb, capture_cb,
+                           languages, translations,
+                           pronunciations, linkages, compounds,
+                           redirects, prefilter=True)
+    parser = etree.XMLParser(target=ctx)
+    parser.feed(b"<mediawiki>")
+    parser.feed(dumpreader.readPages(path, offset))
+    parser.feed(b"</mediawiki>")
+    parser.close()
+    return words
+
+
+def pageTexts(path, titles, index_path=None, db_path=None):
+    """Returns a dict from each of ``titles`` to the text of that page in
+    the dump ``path``.  If the dump has a title index (see parseWord()),
+    the pages are read directly; otherwise the dump is read until all
+    of them have been found.  Titles that are not in the dump are
+    missing from the result."""
+    assert isinstance(path, str)
+    assert isinstance(titles, (list, tuple, set))
+    texts = {}
+
+    def capture_cb(title, text):
+        if title in titles:
+            texts[title] = text
+        return False
+
+    def newContext():
+        return WiktionaryParser(_discardWord, capture_cb, [], False, False,
+                                False, False, False)
+
+    if db_path is None:
+        db_path = dumpreader.titleIndexPath(path)
+    if os.path.exists(db_path):
+        for title in titles:
+            entry = dumpreader.lookupTitle(path, title, db_path)
+            if entry is None:
+                continue
+            parser = etree.XMLParser(target=newContext())
+            parser.feed(b"<mediawiki>")
+            parser.feed(dumpreader.readPages(path, entry[0]))
+            parser.feed(b"</mediawiki>")
+            parser.close()
+        return texts
+    if index_path is not None:
+        chunks = dumpreader.iterMultistream(path, index_path)
+    else:
+        chunks = dumpreader.iterFile(path)
+    feed = newContext().iterFeed(chunks)
+    try:
+        for pos in feed:
+            if len(texts) == len(set(titles)):
+                break
+    finally:
+        feed.close()
+        chunks.close()
+    return texts
+
+
+def profilePages(path, titles, languages=["English", "Translingual"],
+                 index_path=None, db_path=None, sort="cumulative"):
+    """Parses the pages ``titles`` of the dump ``path`` (e.g., the titles
+    of the slow pages in the report of a run, see iterWords()) again
+    under cProfile, and returns the pstats.Stats sorted by ``sort``.
+    Only parsePage() is profiled, not reading the pages; see
+    pageTexts()."""
+    assert isinstance(languages, (list, tuple, set))
+    texts = pageTexts(path, titles, index_path, db_path)
+    ctx = WiktionaryParser(_discardWord, None, languages, False, False,
+                           False, False, False)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for title in titles:
+        if title in texts:
+            parsePage(title, texts[title], ctx)
+    profiler.disable()
+    return pstats.Stats(profiler).sort_stats(sort)
@@ -0,0 +1,1789 @@
+# Equivalence checks and micro-benchmarks for the fast paths in the parser.
+# Each check compares a fast path against the straightforward implementation
+# it replaces on real and hand-written inputs, and then times both.
+#
+# The suite times the whole parser and its hot functions on a dump, by
+# default a synthetic one generated with the same seed every time, and
+# writes the results as JSON so that they can be compared between commits.
+#
+# Usage: python benchmark.py [dump.xml] [check ...]
+#        python benchmark.py generate dump.xml [pages [seed]]
+#        python benchmark.py generate dump-multistream.xml.bz2 [pages [seed]]
+#        python benchmark.py suite results.json [dump.xml | pages]
+#                                              [previous.json]
+
+import bz2
+import collections
+import csv
+import gzip
+import hashlib
+import html
+import json
+import lzma
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import dumpreader
+import wikitextparser
+import wiktlangs
+import WiktionaryParser
+from neo4jexport import CsvExporter, KeyTable
+from neo4jcontroller import (BatchWriter, EtymologyGraph, Neo4jSink,
+                             nodeProperties, skipped_word_keys)
+from sinks import AsyncSink, JsonlSink, SinkFull, StatsSink
+from wikiutils import *
+
+
+def readTexts(path):
+    """Returns the texts of all pages in the uncompressed XML dump
+    ``path``."""
+    with open(path, "r", encoding="utf-8") as f:
+        xml = f.read()
+    return list(html.unescape(m.group(1))
+                for m in re.finditer(r"(?s)<text[^>]*>(.*?)</text>", xml))
+
+
+def timeit(fn, inputs, repeat=3):
+    """Returns the best time in seconds of calling ``fn`` on each of the
+    ``inputs``."""
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        for x in inputs:
+            fn(x)
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def report(name, n, ref_time, new_time):
+    print("{}: {} inputs, reference {:.3f}s, new {:.3f}s, speedup {:.1f}x"
+          .format(name, n, ref_time, new_time,
+                  ref_time / new_time if new_time else float("inf")))
+
+
+# Etymology sections exercising the corner cases of scan_templates().
+etymology_cases = [
+    "",
+    "From {{der|en|la|dictum}}.",
+    "{{der|en|la|{{m|la|x|t=y}}|a=b=c}}",
+    "{{m|la|[[a|b]]|t=q}}",
+    "{{ m | la | x = 1 | 2 }}",
+    "{{bor|pt|en|[[a]]}} and {{cog|es|-}}",
+    "{{inh|gl|roa-opt|-}} {{m|la|[[x]]|[[y|z]]}}",
+    "{{m|la|x}}<!-- {{der|en|fr|y}} -->",
+    "{{der|en|la|<nowiki>|</nowiki>}}",
+    "{{der|en|la|x|{{{1}}}}}",
+    "{{{{bor|}}}}",
+    "{{der|en|la|x",
+    "}} {{der|en|la|x}}",
+    "{{der|en|la|[[a]]]}}",
+    "{{bor|{{x ]t=la}}}}",
+    "{{[[a|b]]{{m|la|x}}}}",
+    "{{m|la|[[a|{{b}}]]}}",
+    "{{m|la|[http://example.org x]}}",
+    "{{m|la|{x}}}",
+    "{{m\n|la\n|x}}",
+    "{{#if:{{m|la|x}}|{{der|en|la|y}}}}",
+    "{{PAGENAME}} {{m|la|x}}",
+]
+
+
+def etymologySections(texts):
+    sections = []
+    for text in texts:
+        for (title, is_language, kind), section in split_subsections(text):
+            if kind.startswith("etymology"):
+                sections.append(section)
+    return sections
+
+
+def checkEtymology(texts):
+    """Checks that parseEtymology(), which uses scan_templates(), gives the
+    same result as a full wikitextparser parse."""
+    def ref(text):
+        data = {}
+        WiktionaryParser.addEtymologyTemplates(
+            data, wikitextparser.parse(text).templates)
+        return data
+
+    def new(text):
+        data = {}
+        WiktionaryParser.parseEtymology("", data, text)
+        return data
+
+    sections = etymologySections(texts)
+    fallbacks = 0
+    for text in etymology_cases + sections:
+        assert ref(text) == new(text), text
+        if scan_templates(text, WiktionaryParser.isEtymologyTemplate) is None:
+            fallbacks += 1
+    print("etymology: {} of {} inputs fall back to wikitextparser"
+          .format(fallbacks, len(etymology_cases) + len(sections)))
+    report("etymology", len(sections), timeit(ref, sections),
+           timeit(new, sections))
+
+    # Most of the time above goes to clean_value(); this only compares
+    # finding the templates and their arguments.
+    def ref_scan(text):
+        return list((t.name, list((x.name, x.value) for x in t.arguments))
+                    for t in wikitextparser.parse(text).templates
+                    if WiktionaryParser.isEtymologyTemplate(t.name.strip()))
+
+    def new_scan(text):
+        return scan_templates(text, WiktionaryParser.isEtymologyTemplate)
+
+    report("etymology templates", len(sections), timeit(ref_scan, sections),
+           timeit(new_scan, sections))
+
+
+# Values exercising the substitutions of clean_value().
+clean_value_cases = [
+    "",
+    " ",
+    "word",
+    "two words",
+    " padded ",
+    "two  spaces",
+    "tab\there",
+    "line\nbreak",
+    "end .",
+    "(a )",
+    "nbsp\xa0here",
+    "it’s",
+    "”quoted”",
+    "&amp; &lt;b&gt; &#91;x&#93;",
+    "<!-- comment -->text<!--",
+    "a<ref>note</ref>b",
+    "a<br>b<br/>c",
+    "<span class=\"x\">text</span>",
+    "[[link]] and [[target|display]]",
+    "[http://example.org display text] [http://example.org]",
+    "''italic'' and '''bold''' and ''''' both '''''",
+    "{{en dash}}{{\\}}{{...}}{{BCE}}{{B.C.E.}}{{AD}}",
+    "{{sumti|1}} {{sumti}}",
+    "{{gloss|a meaning}} {{gloss|x=y|z}}",
+    "{{given name|male|lang=en}}",
+    "{{inflection of|word||p|lang=la}}",
+    "{{taxon|genus|family|Felidae}}",
+    "{{l|en|word}} {{l|en|[[a|b]]}} {{zh-l|字}}",
+    "{{w2|en|x|y}} {{W|Wikipedia}}",
+    "{{l|en|{{m|la|x}}}}",
+    "{{l|en|{{l|en|{{l|en|x}}}}}}",
+    "{{unknown|a|b}} text",
+    "{{{1}}} {{{{x}}}}",
+    "{{l|en|x",
+    "'{{x}}' and [{{x}}[ and <{{x}}!-- -->",
+    "&#123;&#123;l|en|x&#125;&#125;",
+]
+
+# Pieces from which random values are built.
+clean_value_pieces = [
+    "{{", "}}", "{", "}", "|", "=", "[[", "]]", "[", "]", "<", ">", "<!--",
+    "-->", "<ref>", "</ref>", "<br>", "<br/>", "''", "'''", "'", "&amp;",
+    "&", " ", "  ", "\n", "\t", "\xa0", "’", "”", ".", ",", ")",
+    "a", "word", "en", "l|", "gloss|", "sumti|", "ndash", "...", "{{l|en|",
+    "{{w2|", "{{W|", "http://x ", "lang=", "[x]", "|a=b", "|a=", "x=",
+    "{{gloss", "{{taxon|", "{{m|", "[[a|b]]", "{{x}}", "\t]", " ]",
+]
+
+# Template names and argument pieces from which random nested templates are
+# built, which are mostly balanced (unlike those built from
+# clean_value_pieces).
+clean_nested_names = [
+    "l|en|", "l|", "w|", "w|a|", "ja-l|", "w2|a|", "w2|", "m|", "W|",
+    "gloss|", "taxon|", "x", "x|", "l",
+]
+clean_nested_pieces = [
+    "a", "t", "|", "=", "b=", "|t=", "|a=b", " ", "''", "[", "]", "[x]",
+    "[[a]]", "[[a|b]]",
+]
+
+
+def nestedTemplate(rnd, depth):
+    """Returns a random template from clean_nested_names and
+    clean_nested_pieces, with templates nested up to ``depth`` levels."""
+    parts = ["{{", rnd.choice(clean_nested_names)]
+    for i in range(rnd.randint(0, 4)):
+        if depth > 0 and rnd.random() < 0.4:
+            parts.append(nestedTemplate(rnd, depth - 1))
+        else:
+            parts.append(rnd.choice(clean_nested_pieces))
+    parts.append("}}")
+    return "".join(parts)
+
+
+def templateValues(texts):
+    """Returns the headings and template argument values of ``texts``,
+    which are the values clean_value() is mostly called on."""
+    values = []
+    for text in texts:
+        values.extend(m.group(1)
+                      for m in re.finditer(r"(?m)^==+([^=\n]+?)==+", text))
+        for t in wikitextparser.parse(text).templates:
+            values.extend(x.value for x in t.arguments)
+    return values
+
+
+def checkCleanValue(texts):
+    """Checks that clean_value() gives the same result as
+    clean_value_reference()."""
+    values = templateValues(texts)
+    rnd = random.Random(0)
+    fuzz = list("".join(rnd.choice(clean_value_pieces)
+                        for i in range(rnd.randint(1, 12)))
+                for j in range(20000))
+    nested = list("".join(nestedTemplate(rnd, rnd.randint(0, 4))
+                          if rnd.random() < 0.5 else
+                          rnd.choice(clean_nested_pieces + ["{{", "}}"])
+                          for i in range(rnd.randint(1, 4)))
+                  for j in range(20000))
+    for value in clean_value_cases + values + fuzz + nested:
+        assert clean_value(value) == clean_value_reference(value), value
+    report("clean_value", len(values), timeit(clean_value_reference, values),
+           timeit(clean_value, values))
+
+
+# Malformed values on which the regexps of clean_value_reference() take
+# quadratic or exponential time, as functions of a repeat count.
+adversarial_cases = [
+    ("gloss brackets", lambda n: "{{gloss|" + "[x]" * n),
+    ("gloss links", lambda n: "{{gloss|" + "[[x]]" * n),
+    ("named arguments", lambda n: "{{l|en" + "|a=b" * n),
+    ("named arguments }", lambda n: "{{l|en" + "|a=b" * n + "}"),
+    ("w2 arguments", lambda n: "{{w2|" + "[a|b]=" * n),
+    ("nested templates", lambda n: "{{l|" * n),
+    ("closed nested templates", lambda n: "{{l|en|" * n + "x" + "}}" * n),
+    ("closed nested arguments",
+     lambda n: "{{w2|a|t=b|c|[[x]] " * n + "y" + "}}" * n),
+    ("unclosed templates", lambda n: "{{" * n),
+    ("unclosed comments", lambda n: "<!--" * n),
+    ("unclosed refs", lambda n: "<ref>" * n),
+    ("unclosed tags", lambda n: "<" * n),
+    ("unclosed links", lambda n: "[[" * n),
+    ("URL tabs", lambda n: "[" + "\t" * n),
+    ("URL spaces", lambda n: "[a " * n),
+    ("emphasis", lambda n: "''" + "'a" * n),
+    ("quotes", lambda n: "'''" * n),
+]
+
+
+def checkCleanValueCache(texts):
+    """Checks the hits, misses and evictions counted by the clean_value()
+    cache, and that parseWiktionary() returns those of its run in
+    ``ctx.clean_value_counts``, serially and with workers, whatever the
+    size of the cache."""
+    values = list("{{{{l|en|w{}}}}}".format(i) for i in range(5))
+    set_clean_value_cache(100)
+    for value in values * 3 + ["plain"]:
+        clean_value(value)
+    assert clean_value_cache_stats() == {"hits": 10, "misses": 5,
+                                         "evictions": 0, "size": 5,
+                                         "maxsize": 100}
+    set_clean_value_cache(2)
+    for value in values + values[-1:]:
+        assert clean_value(value) == clean_value_reference(value)
+    assert clean_value_cache_stats() == {"hits": 1, "misses": 5,
+                                         "evictions": 3, "size": 2,
+                                         "maxsize": 2}
+    set_clean_value_cache(0)
+    clean_value(values[0])
+    assert clean_value_cache_stats() == {"hits": 0, "misses": 0,
+                                         "evictions": 0, "size": 0,
+                                         "maxsize": 0}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 300)
+        kwargs = {"languages": list(wiktlangs.languages)}
+        expected = None
+        for size, workers in ((100000, 0), (10, 0), (0, 0), (100000, 2)):
+            words = []
+            ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                   clean_cache_size=size,
+                                                   workers=workers, **kwargs)
+            counts = dict(ctx.clean_value_counts)
+            if workers == 0:
+                stats = clean_value_cache_stats()
+                assert counts == dict((k, stats[k]) for k in counts)
+            if expected is None:
+                expected = words
+                calls = counts["hits"] + counts["misses"]
+                assert counts["hits"] > 0
+            assert words == expected
+            if size == 0:
+                assert counts == {"hits": 0, "misses": 0, "evictions": 0}
+            else:
+                assert counts["hits"] + counts["misses"] == calls
+            if size == 10:
+                assert counts["evictions"] > 0
+            print("clean_value cache: size {}, {} workers: {} hits, {} "
+                  "misses, {} evictions".format(size, workers,
+                                                counts["hits"],
+                                                counts["misses"],
+                                                counts["evictions"]))
+
+
+def checkAdversarial(texts):
+    """Checks that clean_value() gives the same result as
+    clean_value_reference() on small adversarial values, and that its
+    time grows linearly on large ones.  The reference is not timed, as
+    it would not finish."""
+    set_clean_value_cache(0)
+    for name, make in adversarial_cases:
+        for n in range(7):
+            value = make(n)
+            assert clean_value(value) == clean_value_reference(value), value
+        # The values are made larger until they take long enough to be
+        # timed reliably.
+        n = 10000
+        small = timeit(clean_value, [make(n)])
+        while small < 0.05:
+            n *= 4
+            small = timeit(clean_value, [make(n)])
+        large = timeit(clean_value, [make(4 * n)])
+        print("adversarial {}: {} repeats {:.3f}s, {} repeats {:.3f}s"
+              .format(name, n, small, 4 * n, large))
+        # Quadratic time would be 16 times slower.
+        assert large < 8 * small, name
+
+
+def checkHeadings(texts):
+    """Checks that classify_heading() gives the same result as
+    classify_heading_uncached() on the headings of ``texts``."""
+    headings = list(m.group(1) for text in texts
+                    for m in re.finditer(r"(?m)^==+([^=\n]+?)==+", text))
+    for raw in headings + ["Etymology 2", "Noun 1.1", "Adjectif", ""]:
+        assert classify_heading(raw) == classify_heading_uncached(raw), raw
+    report("headings", len(headings),
+           timeit(classify_heading_uncached, headings),
+           timeit(classify_heading, headings))
+
+
+class FakeTransientError(Exception):
+    """A retryable error, as raised by a Neo4j driver."""
+
+    def is_retryable(self):
+        return True
+
+
+class FakeNeo4jDriver(object):
+    """Stands in for a Neo4j driver, recording the statements and rows of
+    the transactions run through it.  Every ``fail_every``-th
+    transaction fails with ``error`` first."""
+
+    def __init__(self, fail_every=0, error=FakeTransientError):
+        self.fail_every = fail_every
+        self.error = error
+        self.transactions = 0
+        self.sessions = 0
+        self.batches = []
+        self.statements = []
+
+    def session(self, **kwargs):
+        self.sessions += 1
+        return FakeNeo4jSession(self)
+
+
+class FakeNeo4jSession(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def execute_write(self, fn, *args):
+        # The rows of a failed transaction are rolled back.
+        driver = self.driver
+        driver.transactions += 1
+        tx = FakeNeo4jTransaction(driver)
+        result = fn(tx, *args)
+        if driver.fail_every and driver.transactions % driver.fail_every == 0:
+            raise driver.error("deadlock")
+        driver.batches.extend(tx.batches)
+        return result
+
+    def run(self, statement, **params):
+        self.driver.statements.append(statement)
+        return FakeNeo4jTransaction(self.driver)
+
+    def close(self):
+        pass
+
+
+class FakeNeo4jTransaction(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.batches = []
+
+    def run(self, statement, **params):
+        self.batches.append((statement, list(params["rows"])))
+        return self
+
+    def consume(self):
+        pass
+
+
+def checkNeo4j(texts):
+    """Checks that BatchWriter writes every word once, in full batches of
+    parameterized statements, also when transactions fail transiently,
+    and times it against a fake driver."""
+    ctx = WiktionaryParser.WiktionaryParser(
+        lambda data: None, None, list(wiktlangs.languages), False, False,
+        False, False, False)
+    words = list(data for i, text in enumerate(texts)
+                 for data in WiktionaryParser.parsePage("page{}".format(i),
+                                                        text, ctx)
+                 if "lang" in data)
+    # Neo4j only stores lists of values of one type; the other lists are
+    # stored as JSON, as dicts are.
+    props = nodeProperties({"word": "a", "tags": ["x", "y"], "ids": (1, 2),
+                            "flags": [True], "none": None, "empty": [],
+                            "mixed": ["x", 1], "numbers": [1, 2.5],
+                            "bools": [1, True], "nested": [["x"]],
+                            "forms": {"plural": "as"}}, ["word"])
+    assert props == {"tags": ["x", "y"], "ids": [1, 2], "flags": [True],
+                     "empty": [], "mixed": '["x", 1]',
+                     "numbers": "[1, 2.5]", "bools": "[1, true]",
+                     "nested": '[["x"]]', "forms": '{"plural": "as"}'}
+    # The batches are small enough that some of the transactions fail,
+    # and the rows of those are written once, when they are retried.
+    batch_size = 3
+    for fail_every in (0, 3):
+        driver = FakeNeo4jDriver(fail_every)
+        writer = BatchWriter(driver=driver, batch_size=batch_size,
+                             retry_delay=0)
+        for data in words:
+            writer.addWord(data)
+        writer.close()
+        rows = list(row for statement, batch in driver.batches
+                    for row in batch)
+        assert len(rows) == len(words)
+        assert all(len(batch) == batch_size for statement, batch
+                   in driver.batches[:-1])
+        assert all(statement == writer.word_statement
+                   for statement, batch in driver.batches)
+        for data, row in zip(words, rows):
+            assert row["key"]["word"] == data["word"]
+            assert row["props"] == nodeProperties(data, skipped_word_keys)
+        stats = writer.stats()
+        assert stats["rows"] == len(words)
+        assert stats["retries"] == (driver.transactions - stats["batches"])
+        assert (stats["retries"] > 0) == (fail_every > 0)
+        print("neo4j: {} words in {} batches, {} sessions, {} retries, "
+              "{:.0f} words/s".format(stats["rows"], stats["batches"],
+                                      driver.sessions, stats["retries"],
+                                      stats["elapsed_rows_per_s"]))
+    # The key of the words is constrained, which indexes it for MERGE.
+    driver = FakeNeo4jDriver()
+    writer = BatchWriter(driver=driver)
+    writer.createConstraints()
+    writer.close()
+    assert driver.statements == writer.constraintStatements()
+    assert "REQUIRE (n.word, n.lang, n.pos) IS UNIQUE" in driver.statements[0]
+
+    # The etymology graph merges each term once (with a large enough cache)
+    # and before the relationships that use it.
+    for cache_size in (0, 100000):
+        driver = FakeNeo4jDriver()
+        writer = BatchWriter(driver=driver, batch_size=100)
+        graph = EtymologyGraph(writer, cache_size=cache_size)
+        graph.createConstraints()
+        for data in words:
+            graph.addWord(data)
+        writer.close()
+        assert driver.statements == graph.constraintStatements()
+        merged = collections.defaultdict(int)
+        edges = 0
+        for statement, batch in driver.batches:
+            for row in batch:
+                if statement == graph.node_statement:
+                    merged[(row["word"], row["lang"])] += 1
+                else:
+                    assert (row["word"], row["lang"]) in merged
+                    assert (row["target_word"], row["target_lang"]) in merged
+                    edges += 1
+        assert cache_size == 0 or max(merged.values()) == 1
+        print("neo4j etymology graph: cache size {}, {} terms merged {} "
+              "times, {} relationships".format(cache_size, len(merged),
+                                               sum(merged.values()), edges))
+
+    # Errors are raised once the retries are used up, and other errors
+    # right away.
+    for error, max_retries in ((FakeTransientError, 2), (ValueError, 5)):
+        driver = FakeNeo4jDriver(1, error)
+        writer = BatchWriter(driver=driver, max_retries=max_retries,
+                             retry_delay=0)
+        writer.addWord({"word": "x", "lang": "English"})
+        try:
+            writer.flush()
+            assert False
+        except error:
+            pass
+        assert driver.transactions == (max_retries + 1
+                                       if error is FakeTransientError else 1)
+
+
+def readCsv(path):
+    """Returns the rows of the CSV file ``path``, which may be gzipped."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        return list(csv.reader(f))
+
+
+def checkExport(texts):
+    """Checks that CsvExporter writes each node once and the same
+    relationships as EtymologyGraph, with every key table and with
+    compression, and times it."""
+    # The key tables keep the exact keys, so distinct keys are never taken
+    # for duplicates.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        keys = list("en\t{}".format(i) for i in range(10000))
+        for key_table in (KeyTable(), KeyTable(os.path.join(tmpdir, "k.db"))):
+            assert all(key_table.add(key) for key in keys)
+            assert not any(key_table.add(key) for key in keys)
+            assert len(key_table) == len(keys)
+            key_table.close()
+
+    ctx = WiktionaryParser.WiktionaryParser(
+        lambda data: None, None, list(wiktlangs.languages), False, False,
+        False, False, False)
+    words = list(data for i, text in enumerate(texts)
+                 for data in WiktionaryParser.parsePage("page{}".format(i),
+                                                        text, ctx)
+                 if "lang" in data)
+    driver = FakeNeo4jDriver()
+    writer = BatchWriter(driver=driver)
+    graph = EtymologyGraph(writer)
+    for data in words:
+        graph.addWord(data)
+    writer.close()
+    terms = set()
+    edges = []
+    for statement, batch in driver.batches:
+        for row in batch:
+            if statement == graph.node_statement:
+                terms.add((row["word"], row["lang"]))
+            else:
+                edges.append((row["word"], row["lang"], row["target_word"],
+                              row["target_lang"]))
+    keys = set((data["word"], data["lang"], data.get("pos") or "")
+               for data in words)
+    # Redirects are not written, as in Neo4jSink.
+    records = words + [{"redirect": "color", "word": "colour"}]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for compress, key_table in ((False, None), (True, None),
+                                    (False, os.path.join(tmpdir, "keys.db"))):
+            directory = os.path.join(tmpdir, "export")
+            start = time.time()
+            with CsvExporter(directory, compress=compress,
+                             key_table=key_table) as exporter:
+                for data in records:
+                    exporter.addWord(data)
+            seconds = time.time() - start
+            rows = dict((name, readCsv(path))
+                        for name, path in exporter.paths.items())
+            assert len(rows["words"]) == len(keys) + 1
+            assert (set(tuple(row[1:4]) for row in rows["words"][1:]) ==
+                    keys)
+            ids = dict((row[0], (row[1], row[2]))
+                       for row in rows["terms"][1:])
+            assert len(ids) == len(rows["terms"]) - 1
+            assert set(ids.values()) == terms
+            # The writer batches the relationships by type.
+            assert (sorted(ids[row[0]] + ids[row[1]]
+                           for row in rows["relationships"][1:]) ==
+                    sorted(edges))
+            stats = exporter.stats()
+            print("export (compress {}, key table {}): {} words, {} terms, "
+                  "{} relationships, {:.0f} words/s".format(
+                      compress, "disk" if key_table else "memory",
+                      stats["words"], stats["terms"], stats["relationships"],
+                      len(words) / seconds))
+
+
+class FakeSlowSink(object):
+    """Sink that takes ``delay`` seconds to write every ``every``-th
+    record, as a database round trip for a batch or a disk flush would,
+    and fails on the record ``fail_at`` (counting from 1) if it is
+    given."""
+
+    def __init__(self, delay=0.0, every=1, fail_at=None):
+        self.delay = delay
+        self.every = every
+        self.fail_at = fail_at
+        self.words = []
+        self.flushes = 0
+        self.closed = False
+
+    def addWord(self, data):
+        if self.fail_at == len(self.words) + 1:
+            raise ValueError("write failed")
+        self.words.append(data)
+        if self.delay and len(self.words) % self.every == 0:
+            time.sleep(self.delay)
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        self.closed = True
+
+
+def checkSinks(texts):
+    """Checks that AsyncSink writes every record in order, propagates the
+    errors of the sink, and applies backpressure, and times parsing with
+    a slow sink written synchronously and through the queue."""
+    ctx = WiktionaryParser.WiktionaryParser(
+        lambda data: None, None, list(wiktlangs.languages), False, False,
+        False, False, False)
+
+    def parseAll(word_cb):
+        for i, text in enumerate(texts):
+            for data in WiktionaryParser.parsePage("page{}".format(i), text,
+                                                   ctx):
+                word_cb(data)
+
+    words = []
+    parseAll(words.append)
+    delay, every = 0.02, 100
+    start = time.perf_counter()
+    parseAll(FakeSlowSink(delay, every).addWord)
+    sync_time = time.perf_counter() - start
+    sink = FakeSlowSink(delay, every)
+    start = time.perf_counter()
+    with AsyncSink(sink, queue_size=1000) as async_sink:
+        parseAll(async_sink)
+    async_time = time.perf_counter() - start
+    assert sink.words == words and sink.closed
+    stats = async_sink.stats()
+    assert stats["written"] == stats["records"] == len(words)
+    print("sinks: {} words with a sink taking {:.0f}ms every {} words: "
+          "{:.3f}s synchronous, {:.3f}s through the queue (depth {:.1f} on "
+          "average, {} at most, blocked {:.3f}s)".format(
+              len(words), delay * 1000, every, sync_time, async_time,
+              stats["mean_depth"],
+                                    stats["max_depth"],
+                                    stats["blocked_seconds"]))
+
+    # flush() writes everything queued, as needed before a checkpoint.
+    records = list({"word": "word{}".format(i), "lang": "English"}
+                   for i in range(20))
+    sink = FakeSlowSink(0.001)
+    async_sink = AsyncSink(sink)
+    for data in records:
+        async_sink.addWord(data)
+    async_sink.flush()
+    assert sink.words == records and sink.flushes == 1
+    async_sink.close()
+
+    # The error of the sink is raised once in the parsing thread, and the
+    # records after it are not written.
+    sink = FakeSlowSink(fail_at=5)
+    async_sink = AsyncSink(sink)
+    try:
+        for data in records:
+            async_sink.addWord(data)
+        async_sink.flush()
+        assert False
+    except ValueError:
+        pass
+    async_sink.close()
+    assert len(sink.words) == 4 and sink.closed
+
+    # A failed sink is closed, and its error is raised by close() if it
+    # has not been raised yet.
+    sink = FakeSlowSink(fail_at=1)
+    async_sink = AsyncSink(sink)
+    async_sink.addWord(records[0])
+    try:
+        async_sink.close()
+        assert False
+    except ValueError:
+        pass
+    assert sink.closed
+    assert async_sink.stats()["failed"]
+
+    # A full queue drops records or blocks up to the timeout.  The writer
+    # holds the first record until it is released.
+    started = threading.Event()
+    release = threading.Event()
+
+    def hold(data):
+        started.set()
+        release.wait()
+
+    for full, timeout in (("drop", None), ("block", 0.01)):
+        async_sink = AsyncSink(hold, queue_size=2, full=full,
+                               timeout=timeout)
+        async_sink.addWord(records[0])
+        started.wait()
+        try:
+            for data in records[1:10]:
+                async_sink.addWord(data)
+            assert full == "drop"
+        except SinkFull:
+            assert full == "block"
+        stats = async_sink.stats()
+        assert stats["dropped"] == (7 if full == "drop" else 1)
+        release.set()
+        async_sink.close()
+        assert (async_sink.stats()["written"] ==
+                stats["records"] - stats["dropped"])
+        started.clear()
+        release.clear()
+
+
+def checkFanOut(texts):
+    """Checks that parseWiktionary() passes every word to each of several
+    sinks in one pass, also across a checkpoint and when a sink fails,
+    and times it against a pass per sink."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 500)
+        kwargs = {"languages": list(wiktlangs.languages)}
+        words = []
+        WiktionaryParser.parseWiktionary(path, words.append, **kwargs)
+        jsonl_path = os.path.join(tmpdir, "words.jsonl")
+
+        def makeSinks():
+            driver = FakeNeo4jDriver()
+            writer = BatchWriter(driver=driver)
+            return [JsonlSink(jsonl_path), StatsSink(),
+                    Neo4jSink(writer, EtymologyGraph(writer)),
+                    FakeSlowSink(0.02, 100)], driver
+
+        def checkOutputs(sinks, driver):
+            with open(jsonl_path, encoding="utf-8") as f:
+                assert list(json.loads(line) for line in f) == words
+            assert sinks[1].stats()["words"] == len(words)
+            assert (sum(1 for statement, batch in driver.batches
+                        for row in batch
+                        if statement == sinks[2].writer.word_statement) ==
+                    sum(1 for data in words if "lang" in data))
+            assert sinks[3].words == words
+
+        sinks, driver = makeSinks()
+        start = time.perf_counter()
+        for sink in sinks:
+            WiktionaryParser.parseWiktionary(path, sink.addWord, **kwargs)
+            if hasattr(sink, "close"):
+                sink.close()
+        passes_time = time.perf_counter() - start
+        checkOutputs(sinks, driver)
+        sinks, driver = makeSinks()
+        start = time.perf_counter()
+        ctx = WiktionaryParser.parseWiktionary(path, None, sinks=sinks,
+                                               **kwargs)
+        fanout_time = time.perf_counter() - start
+        checkOutputs(sinks, driver)
+        assert (set(ctx.sink_stats) ==
+                set(["JsonlSink", "StatsSink", "Neo4jSink", "FakeSlowSink"]))
+        print("fan-out: {} words to {} sinks: {:.3f}s in a pass per sink, "
+              "{:.3f}s in one pass".format(len(words), len(sinks),
+                                           passes_time, fanout_time))
+
+        # A run that fails after a checkpoint continues the JSONL file from
+        # the offset recorded in it.
+        checkpoint = os.path.join(tmpdir, "checkpoint.json")
+        jsonl = JsonlSink(jsonl_path)
+
+        def failAt(n):
+            written = []
+
+            def word_cb(data):
+                if len(written) >= n:
+                    raise ValueError("write failed")
+                written.append(data)
+            return word_cb
+
+        try:
+            WiktionaryParser.parseWiktionary(
+                path, None, sinks=[jsonl, failAt(len(words) // 2)],
+                checkpoint=checkpoint, checkpoint_every=20,
+                checkpoint_cb=lambda: {"offset": jsonl.tell()}, **kwargs)
+            assert False
+        except ValueError:
+            pass
+        assert jsonl.f.closed
+        state = WiktionaryParser.loadCheckpoint(checkpoint)
+        jsonl = JsonlSink(jsonl_path, state["output"]["offset"])
+        WiktionaryParser.parseWiktionary(
+            path, None, sinks=[jsonl], checkpoint=checkpoint,
+            checkpoint_every=20, resume_from=checkpoint, **kwargs)
+        with open(jsonl_path, encoding="utf-8") as f:
+            assert list(json.loads(line) for line in f) == words
+        assert not os.path.exists(checkpoint)
+
+        # The checkpoint is kept when the last words, still queued at the
+        # end of the dump, fail to be written.
+        try:
+            WiktionaryParser.parseWiktionary(
+                path, None, sinks=[FakeSlowSink(fail_at=len(words))],
+                checkpoint=checkpoint, checkpoint_every=20, **kwargs)
+            assert False
+        except ValueError:
+            pass
+        assert os.path.exists(checkpoint)
+
+
+def checkIncremental(texts):
+    """Checks that an incremental run reuses the stored words of the
+    pages only when the settings are those of the previous run."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 300)
+        store = os.path.join(tmpdir, "pages.db")
+        for languages in (["English"], ["English"], ["Portuguese"],
+                          ["Portuguese"]):
+            expected = []
+            WiktionaryParser.parseWiktionary(path, expected.append,
+                                             languages=languages,
+                                             redirects=True)
+            words = []
+            ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                   languages=languages,
+                                                   redirects=True,
+                                                   incremental=store)
+            assert words == expected
+            unchanged = ctx.skip_counts.get("unchanged", 0)
+            print("incremental: {}: {} words, {} pages unchanged".format(
+                ", ".join(languages), len(words), unchanged))
+        # The last run reused the pages stored by the one before it.
+        assert unchanged > 0
+        words = []
+        ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                               languages=["Portuguese"],
+                                               incremental=store)
+        assert ctx.skip_counts.get("unchanged", 0) == 0
+
+        # Pages that a run skips (by namespace or with the prefilter) are
+        # not reported as deleted, and are reused when they are captured
+        # again.
+        generateDump(path, 300, other_namespaces=0.2)
+        store = os.path.join(tmpdir, "pages2.db")
+        for kwargs in ({}, {"namespaces": [""]},
+                       {"namespaces": [""], "prefilter": True}, {}, {}):
+            expected = []
+            WiktionaryParser.parseWiktionary(path, expected.append,
+                                             languages=["Portuguese"],
+                                             **kwargs)
+            words = []
+            ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                   languages=["Portuguese"],
+                                                   incremental=store,
+                                                   **kwargs)
+            assert words == expected
+        assert ctx.skip_counts["unchanged"] > 0
+
+
+def checkNamespaces(texts):
+    """Checks that the pages outside the namespaces given to
+    parseWiktionary() are skipped and counted, and that the words of the
+    other pages are those of a run without the filter."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 500, other_namespaces=0.2)
+        with open(path, encoding="utf-8") as f:
+            other = sum(1 for ns in re.findall(r"<ns>(\d+)</ns>", f.read())
+                        if ns != "0")
+        kwargs = {"languages": list(wiktlangs.languages), "redirects": True}
+        all_words = []
+        WiktionaryParser.parseWiktionary(path, all_words.append, **kwargs)
+        expected = list(data for data in all_words
+                        if not data["word"].startswith(("Template:",
+                                                        "Appendix:")))
+        assert 0 < len(expected) < len(all_words)
+        for workers in (0, 2):
+            words = []
+            ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                   namespaces=[""],
+                                                   workers=workers,
+                                                   **kwargs)
+            assert words == expected
+            assert ctx.skip_counts["namespace"] == other
+        print("namespaces: {} of {} words kept, {} pages skipped".format(
+            len(words), len(all_words), other))
+
+
+def checkPrefilter(texts):
+    """Checks that the prefilter, which skips the pages whose raw text has
+    no heading with a captured language, gives the same words as a run
+    without it, serially and with workers."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 500)
+        for languages in (["Galician"], ["English", "Translingual"]):
+            expected = []
+            start = time.perf_counter()
+            ctx = WiktionaryParser.parseWiktionary(path, expected.append,
+                                                   languages=languages)
+            seconds = time.perf_counter() - start
+            language_counts = dict((x, ctx.language_counts[x])
+                                   for x in languages)
+            assert expected
+            for workers in (0, 2):
+                words = []
+                start = time.perf_counter()
+                ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                       languages=languages,
+                                                       prefilter=True,
+                                                       workers=workers)
+                assert words == expected
+                assert ctx.skip_counts["language"] > 0
+                assert (dict((x, ctx.language_counts[x])
+                             for x in languages) == language_counts)
+                if workers == 0:
+                    print("prefilter: {}: {} words, {} pages skipped, "
+                          "{:.3f}s ({:.3f}s without)".format(
+                              ", ".join(languages), len(words),
+                              ctx.skip_counts["language"],
+                              time.perf_counter() - start, seconds))
+
+
+def parseStats(ctx):
+    """Returns the statistics of the parsing context ``ctx`` that do not
+    depend on how the dump was read."""
+    return {"language_counts": dict(ctx.language_counts),
+            "pos_counts": dict(ctx.pos_counts),
+            "section_counts": dict(ctx.section_counts),
+            "skip_counts": dict(ctx.skip_counts)}
+
+
+def checkWorkers(texts):
+    """Checks that parsing in worker processes gives the same words, in
+    the same order, and the same merged statistics as a serial run."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 500)
+        kwargs = {"languages": list(wiktlangs.languages), "redirects": True}
+        expected = []
+        start = time.perf_counter()
+        ctx = WiktionaryParser.parseWiktionary(path, expected.append,
+                                               **kwargs)
+        serial_time = time.perf_counter() - start
+        expected_stats = parseStats(ctx)
+        assert any("redirect" in data for data in expected)
+        for workers, batch_size in ((2, 100), (2, 7), (3, 1)):
+            words = []
+            start = time.perf_counter()
+            ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                   workers=workers,
+                                                   batch_size=batch_size,
+                                                   **kwargs)
+            seconds = time.perf_counter() - start
+            assert words == expected
+            assert parseStats(ctx) == expected_stats
+            print("workers: {} workers, batches of {}: {} words, {:.3f}s "
+                  "({:.3f}s serial)".format(workers, batch_size, len(words),
+                                            seconds, serial_time))
+
+        # When word_cb fails, the workers are stopped and the SIGALRM handler
+        # restored before the exception reaches the caller.
+        handler = signal.getsignal(signal.SIGALRM)
+
+        def word_cb(data):
+            if data["word"] == expected[10]["word"]:
+                raise FakeCrash()
+
+        try:
+            WiktionaryParser.parseWiktionary(
+                path, word_cb, workers=2, page_timeout=60,
+                quarantine=os.path.join(tmpdir, "quarantine.jsonl"),
+                **kwargs)
+            assert False
+        except FakeCrash:
+            assert multiprocessing.active_children() == []
+            assert signal.getsignal(signal.SIGALRM) == handler
+
+
+class FakeCrash(Exception):
+    """Interrupts a run, as a crash would."""
+    pass
+
+
+def resumedWords(path, checkpoint, crash_at, **kwargs):
+    """Returns the words of a run over ``path`` that is interrupted after
+    ``crash_at`` words and resumed from its last checkpoint, dropping
+    the words emitted after that checkpoint as a real output would."""
+    words = []
+
+    def word_cb(data):
+        if len(words) >= crash_at:
+            raise FakeCrash()
+        words.append(data)
+
+    try:
+        WiktionaryParser.parseWiktionary(
+            path, word_cb, checkpoint=checkpoint, checkpoint_every=13,
+            checkpoint_cb=lambda: {"words": len(words)}, **kwargs)
+        assert False
+    except FakeCrash:
+        pass
+    state = WiktionaryParser.loadCheckpoint(checkpoint)
+    assert 0 < state["output"]["words"] <= crash_at
+    del words[state["output"]["words"]:]
+    WiktionaryParser.parseWiktionary(path, words.append,
+                                     checkpoint=checkpoint,
+                                     checkpoint_every=13,
+                                     resume_from=checkpoint, **kwargs)
+    assert not os.path.exists(checkpoint)
+    return words, state
+
+
+def checkResume(texts):
+    """Checks that a run resumed from a checkpoint in the middle of the
+    dump gives the same words as an uninterrupted run, when reading
+    uncompressed and bz2 dumps and with workers."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 500)
+        bz2_path = path + ".bz2"
+        with open(path, "rb") as f, bz2.open(bz2_path, "wb") as out:
+            out.write(f.read())
+        checkpoint = os.path.join(tmpdir, "checkpoint.json")
+        kwargs = {"languages": list(wiktlangs.languages), "redirects": True}
+        expected = []
+        WiktionaryParser.parseWiktionary(path, expected.append, **kwargs)
+        for name, dump, extra in (("xml", path, {}),
+                                  ("bz2", bz2_path, {}),
+                                  ("bz2 python", bz2_path,
+                                   {"decompressor": "python"}),
+                                  ("workers", path, {"workers": 2,
+                                                     "batch_size": 5})):
+            words, state = resumedWords(dump, checkpoint,
+                                        len(expected) // 2,
+                                        **dict(kwargs, **extra))
+            assert words == expected
+            print("resume: {}: {} words, resumed after {} at {}".format(
+                name, len(words), state["output"]["words"],
+                state["title"]))
+
+
+def checkPrefetch(texts):
+    """Checks that prefetchChunks() yields the same chunks as the reader it
+    wraps, for uncompressed, bz2 and multistream dumps and whatever the
+    depth, that it raises the errors of the reader after the chunks read
+    before them, that closing it early stops its thread and closes the
+    reader, and that parsing with ``prefetch`` gives the same words."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path, ms_path, index_path = syntheticDumps(tmpdir)
+        bz2_path = path + ".bz2"
+        with open(path, "rb") as f, bz2.open(bz2_path, "wb") as out:
+            out.write(f.read())
+        readers = {
+            "xml": lambda: dumpreader.iterFile(path, chunk_size=4096),
+            "bz2": lambda: dumpreader.iterFile(bz2_path, chunk_size=4096,
+                                               decompressor="python"),
+            "multistream": lambda: dumpreader.iterMultistream(ms_path,
+                                                              index_path),
+        }
+        for name, reader in readers.items():
+            expected = list(reader())
+            assert len(expected) > 1
+            for depth in (1, 3, 1000):
+                stats = {"read_seconds": 0.0}
+                chunks = list(dumpreader.prefetchChunks(reader(), depth,
+                                                        stats))
+                assert chunks == expected, (name, depth)
+                assert stats["read_seconds"] > 0
+            print("prefetch: {}: {} chunks, {} bytes".format(
+                name, len(expected), sum(len(data) for pos, data
+                                         in expected)))
+
+        def failing():
+            yield from expected[:2]
+            raise OSError("read error")
+        chunks = []
+        try:
+            for chunk in dumpreader.prefetchChunks(failing(), 1):
+                chunks.append(chunk)
+        except OSError as e:
+            assert str(e) == "read error"
+        else:
+            assert False, "prefetchChunks() did not raise"
+        assert chunks == expected[:2]
+
+        threads = threading.active_count()
+        reader = readers["xml"]()
+        chunks = dumpreader.prefetchChunks(reader, 1)
+        assert next(chunks) == next(iter(readers["xml"]()))
+        chunks.close()
+        assert threading.active_count() == threads
+        assert reader.gi_frame is None
+
+        kwargs = {"languages": list(wiktlangs.languages), "redirects": True}
+        expected = []
+        WiktionaryParser.parseWiktionary(bz2_path, expected.append,
+                                         decompressor="python", **kwargs)
+        words = []
+        WiktionaryParser.parseWiktionary(bz2_path, words.append,
+                                         decompressor="python", prefetch=4,
+                                         **kwargs)
+        assert words == expected
+
+
+def checkDecompressors(texts):
+    """Checks that reading a compressed dump through the external
+    decompressors that are installed gives the same chunks as the Python
+    modules (or the uncompressed dump), also from an offset, that the
+    position in the file is tracked, and that a failing decompressor
+    raises an OSError with its error output."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 300)
+        with open(path, "rb") as f:
+            xml = f.read()
+        compressors = {".gz": lambda p: gzip.open(p, "wb"),
+                       ".xz": lambda p: lzma.open(p, "wb"),
+                       ".bz2": lambda p: bz2.open(p, "wb")}
+        for ext, cmds in dumpreader.decompressors.items():
+            dump = path + ext
+            for cmd in cmds:
+                if not shutil.which(cmd[0]):
+                    print("decompressors: {} not installed".format(cmd[0]))
+                    continue
+                if not os.path.exists(dump):
+                    if ext in compressors:
+                        with compressors[ext](dump) as out:
+                            out.write(xml)
+                    else:
+                        subprocess.run(cmd[:1] + ["-q", "-o", dump, path],
+                                       check=True)
+                if ext in dumpreader.decompress_modules:
+                    expected = list(dumpreader.iterFile(
+                        dump, chunk_size=4096, decompressor="python"))
+                else:
+                    expected = list(dumpreader.iterFile(path,
+                                                        chunk_size=4096))
+                assert len(expected) > 1
+                stats = {}
+                chunks = list(dumpreader.iterFile(dump, chunk_size=4096,
+                                                  decompressor=cmd,
+                                                  stats=stats))
+                assert chunks == expected, cmd
+                assert stats["input_pos"] == os.path.getsize(dump)
+                start = len(xml) // 3
+                chunks = list(dumpreader.iterFile(dump, start,
+                                                  chunk_size=4096,
+                                                  decompressor=cmd))
+                assert chunks[0][0] == start
+                assert b"".join(data for pos, data in chunks) == xml[start:]
+                # Stopping early kills the command.
+                chunks = dumpreader.iterFile(dump, chunk_size=4096,
+                                             decompressor=cmd)
+                assert next(chunks) == expected[0]
+                chunks.close()
+                print("decompressors: {}: {} chunks".format(" ".join(cmd),
+                                                            len(expected)))
+        cmd = ["gzip", "-dc"]
+        if shutil.which(cmd[0]):
+            # A truncated gzip file, and one that is not gzip at all.
+            dump = path + ".gz"
+            bad_path = os.path.join(tmpdir, "bad.xml.gz")
+            with open(dump, "rb") as f:
+                data = f.read()
+            for bad in (data[:len(data) // 2], b"not gzip data\n" * 100):
+                with open(bad_path, "wb") as f:
+                    f.write(bad)
+                try:
+                    for chunk in dumpreader.iterFile(bad_path,
+                                                     decompressor=cmd):
+                        pass
+                except OSError as e:
+                    message = str(e)
+                else:
+                    assert False, "no OSError for a corrupt file"
+                assert message.startswith("gzip -dc failed on " + bad_path)
+                with open(bad_path, "rb") as f:
+                    result = subprocess.run(cmd, stdin=f,
+                                            stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.PIPE)
+                assert result.returncode != 0
+                stderr = result.stderr.decode("utf-8", "replace").strip()
+                assert stderr and message.endswith(stderr), message
+                print("decompressors: corrupt file: {}".format(message))
+
+
+def syntheticDumps(tmpdir, pages=500):
+    """Writes a synthetic dump with some titles escaped in XML to
+    ``tmpdir``, uncompressed and as a multistream dump of streams of 20
+    pages.  Returns the paths of the dump, of the multistream dump and
+    of its index."""
+    path = os.path.join(tmpdir, "dump.xml")
+    generateDump(path, pages, special_titles=0.05)
+    ms_path = os.path.join(tmpdir, "dump-multistream.xml.bz2")
+    index_path = os.path.join(tmpdir, "dump-multistream-index.txt.bz2")
+    writeMultistream(path, ms_path, index_path, 20)
+    return path, ms_path, index_path
+
+
+def checkMultistream(texts):
+    """Checks that reading a multistream dump through its index gives the
+    same words and statistics as reading the uncompressed dump, with
+    and without decompression workers."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path, ms_path, index_path = syntheticDumps(tmpdir)
+        kwargs = {"languages": list(wiktlangs.languages), "redirects": True}
+        expected = []
+        ctx = WiktionaryParser.parseWiktionary(path, expected.append,
+                                               **kwargs)
+        expected_stats = parseStats(ctx)
+        assert len(dumpreader.streamRanges(ms_path, index_path)) > 2
+        for decompress_workers in (0, 2):
+            words = []
+            ctx = WiktionaryParser.parseWiktionary(
+                ms_path, words.append, index_path=index_path,
+                decompress_workers=decompress_workers, **kwargs)
+            assert words == expected
+            assert parseStats(ctx) == expected_stats
+            print("multistream: {} decompression workers: {} words in {} "
+                  "streams".format(decompress_workers, len(words),
+                                   ctx.read_stats["chunks"]))
+
+
+def checkTitleIndex(texts):
+    """Checks that the title indexes built from a multistream index and
+    by scanning the uncompressed dump have the same keys, including
+    titles escaped in XML, and that parseWord() finds the words of a
+    page through either of them."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path, ms_path, index_path = syntheticDumps(tmpdir)
+        languages = list(wiktlangs.languages)
+        expected = collections.defaultdict(list)
+        WiktionaryParser.parseWiktionary(
+            path, lambda data: expected[data["word"]].append(data),
+            languages=languages, redirects=True)
+        dumpreader.buildTitleIndex(path)
+        dumpreader.buildTitleIndex(ms_path, index_path)
+        rows = []
+        for db_path in (dumpreader.titleIndexPath(path),
+                        dumpreader.titleIndexPath(ms_path)):
+            db = sqlite3.connect(db_path)
+            rows.append(dict((title, pageid) for title, pageid in db.execute(
+                "SELECT title, pageid FROM pages")))
+            db.close()
+        assert rows[0] == rows[1]
+        special = list(title for title in rows[0]
+                       if re.search("[&'\"]", title))
+        assert special
+        titles = special + sorted(rows[0])[::25]
+        for dump in (path, ms_path):
+            for title in titles:
+                words = WiktionaryParser.parseWord(dump, title, languages)
+                assert words == expected[title]
+        print("title index: {} titles, {} with escaped characters, {} "
+              "looked up in each dump".format(len(rows[0]), len(special),
+                                              len(titles)))
+
+
+def checkShards(texts):
+    """Checks that reading a memory-mapped dump, with and without
+    workers, and parsing it in shards gives the same words and
+    statistics as reading it as a stream."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 500, special_titles=0.05)
+        kwargs = {"languages": list(wiktlangs.languages), "redirects": True}
+        expected = []
+        ctx = WiktionaryParser.parseWiktionary(path, expected.append,
+                                               **kwargs)
+        expected_stats = parseStats(ctx)
+        for workers in (0, 2):
+            words = []
+            ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                   mapped=True,
+                                                   workers=workers, **kwargs)
+            assert words == expected
+            assert parseStats(ctx) == expected_stats
+        for num_shards in (1, 2, 3, 7, 600):
+            ranges = dumpreader.shardRanges(path, num_shards)
+            assert len(ranges) == num_shards
+            assert ranges[0][0] == 0
+            assert ranges[-1][1] == os.path.getsize(path)
+            assert all(ranges[i][1] == ranges[i + 1][0]
+                       for i in range(len(ranges) - 1))
+            words = []
+            stats = collections.defaultdict(collections.Counter)
+            for shard in ranges:
+                ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                       shard=shard, **kwargs)
+                for name, counts in parseStats(ctx).items():
+                    stats[name].update(counts)
+            assert words == expected
+            assert (dict((name, dict(counts))
+                         for name, counts in stats.items()) ==
+                    expected_stats)
+            print("shards: {} shards ({} empty): {} words".format(
+                num_shards, sum(1 for start, end in ranges if start == end),
+                len(words)))
+
+
+def checkReport(texts):
+    """Checks that ``progress_cb`` gets the progress of a run, and that the
+    report written to ``report`` has the statistics of the run, with the
+    seconds of each stage.  The stages of the main process do not
+    overlap, so they add up to about the elapsed time, serially and with
+    workers (whose parsing stages are summed separately)."""
+    keys = ["clean_value_counts", "language_counts", "pos_counts",
+            "progress", "quarantined", "read", "section_counts",
+            "skip_counts", "slow_pages", "stages"]
+    progress_keys = ["eta_seconds", "fraction", "input_mb_per_s", "mb",
+                     "mb_per_s", "pages", "pages_per_s", "seconds", "words",
+                     "words_per_s"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        report_path = os.path.join(tmpdir, "report.json")
+        generateDump(path, 1000)
+        kwargs = {"languages": list(wiktlangs.languages)}
+        for workers in (0, 2):
+            words = []
+            progress = []
+            ctx = WiktionaryParser.parseWiktionary(
+                path, words.append, workers=workers, progress=0.001,
+                progress_cb=progress.append, report=report_path, **kwargs)
+            assert progress
+            for record in progress:
+                assert sorted(record) == progress_keys
+            for a, b in zip(progress, progress[1:]):
+                assert a["seconds"] <= b["seconds"]
+                assert a["pages"] <= b["pages"] and a["words"] <= b["words"]
+            with open(report_path) as f:
+                report = json.load(f)
+            assert sorted(report) == keys
+            assert report == json.loads(json.dumps(ctx.report()))
+            total = report["progress"]["seconds"]
+            assert report["progress"]["words"] == len(words)
+            assert report["progress"]["fraction"] == 1.0
+            assert progress[-1]["seconds"] <= total
+            stages = report["stages"]
+            for stage in ("read", "xml", "parse_page", "split_subsections",
+                          "etymology", "clean_value", "word_cb"):
+                assert stages[stage]["calls"] > 0, stage
+            for stage, record in stages.items():
+                assert record["seconds"] >= 0, stage
+            nested = sum(stages[stage]["seconds"]
+                         for stage in WiktionaryParser.page_stages)
+            assert nested <= stages["parse_page"]["seconds"]
+            main = ["read", "xml", "workers", "checkpoint", "word_cb"]
+            if workers == 0:
+                main.append("parse_page")
+            seconds = sum(stages[stage]["seconds"] for stage in main
+                          if stage in stages)
+            assert 0.9 * total <= seconds <= total, (seconds, total)
+            print("report: {} workers: {:.3f}s in stages of {:.3f}s, {} "
+                  "progress reports".format(workers, seconds, total,
+                                            len(progress)))
+
+
+def checkPageTimeout(texts):
+    """Checks that a page that takes longer than ``page_timeout`` is given
+    up on, quarantined and listed among the slow pages, and that the
+    other pages are still parsed, serially and with workers."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "dump.xml")
+        generateDump(path, 200)
+        kwargs = {"languages": list(wiktlangs.languages), "redirects": True}
+        expected = []
+        WiktionaryParser.parseWiktionary(path, expected.append, **kwargs)
+        # A page that takes about a second, in the middle of the dump.
+        text = ("==English==\n\n===Etymology===\n" +
+                "From {{der|en|la|amo}}, {{m|la|amicus|t=friend}}. " * 20000 +
+                "\n\n===Noun===\n{{en-noun}}\n\n# friend\n")
+        with open(path, encoding="utf-8") as f:
+            xml = f.read()
+        pos = xml.find("  <page>", len(xml) // 2)
+        xml = (xml[:pos] +
+               "  <page>\n"
+               "    <title>slow</title>\n"
+               "    <ns>0</ns>\n"
+               "    <id>1000000</id>\n"
+               "    <revision>\n"
+               "      <id>2000000</id>\n"
+               '      <text xml:space="preserve">{}</text>\n'
+               "    </revision>\n"
+               "  </page>\n".format(html.escape(text, quote=False)) +
+               xml[pos:])
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(xml)
+        quarantine = os.path.join(tmpdir, "quarantine.jsonl")
+        for workers in (0, 2):
+            words = []
+            start = time.perf_counter()
+            ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                                   page_timeout=0.3,
+                                                   quarantine=quarantine,
+                                                   workers=workers,
+                                                   **kwargs)
+            seconds = time.perf_counter() - start
+            assert words == expected
+            assert list(record["title"] for record in ctx.quarantined) == \
+                ["slow"]
+            assert ctx.report()["quarantined"] == ctx.quarantined
+            assert ctx.slowPages()[0]["title"] == "slow"
+            with open(quarantine, encoding="utf-8") as f:
+                records = list(json.loads(line) for line in f)
+            assert len(records) == 1
+            assert records[0]["text"] == text.strip()
+            print("page timeout: {} workers: {} words, {} quarantined after "
+                  "{:.2f}s in {}, {:.2f}s in all".format(
+                      workers, len(words), records[0]["title"],
+                      records[0]["seconds"], records[0]["stage"], seconds))
+
+
+# Languages of the synthetic dumps, with their codes and relative frequency.
+synthetic_languages = [
+    ("English", "en", 30), ("Spanish", "es", 8), ("Portuguese", "pt", 6),
+    ("French", "fr", 8), ("German", "de", 6), ("Italian", "it", 6),
+    ("Galician", "gl", 2), ("Latin", "la", 6), ("Dutch", "nl", 4),
+    ("Swedish", "sv", 3), ("Finnish", "fi", 4), ("Polish", "pl", 3),
+    ("Translingual", "mul", 2),
+]
+
+# Relative frequency of pages with 1, 2, ... language sections.
+synthetic_section_counts = [70, 14, 6, 4, 2, 1, 1, 1, 1]
+
+# Formats of the titles with characters escaped in XML, for a word and a
+# plain title.
+synthetic_special_titles = ["{} & {}", "{}'s {}", '"{}" {}']
+
+synthetic_pos = ["Noun", "Verb", "Adjective", "Adverb", "Proper noun",
+                 "Interjection", "Pronoun"]
+
+synthetic_syllables = ["a", "mi", "go", "ta", "re", "lo", "ka", "sen", "tu",
+                       "dor", "el", "vi", "sta", "ne", "bra", "qu", "ü", "ø"]
+
+
+def syntheticWord(rnd):
+    return "".join(rnd.choice(synthetic_syllables)
+                   for i in range(rnd.randint(1, 4)))
+
+
+def syntheticTemplate(rnd, code, depth=0):
+    """Returns a random etymology template for the language ``code``,
+    possibly with a nested template and named arguments."""
+    name = rnd.choice(sorted(WiktionaryParser.etymologyTemplates))
+    source = rnd.choice(synthetic_languages)[1]
+    term = syntheticWord(rnd)
+    if depth == 0 and rnd.random() < 0.1:
+        term = syntheticTemplate(rnd, source, depth + 1)
+    elif rnd.random() < 0.2:
+        term = "[[{}]]".format(term)
+    args = [code, source, term]
+    if name in ("affix", "prefix", "suffix", "confix", "compound"):
+        args = [code, syntheticWord(rnd), syntheticWord(rnd)]
+    elif name in ("m", "m+", "mention", "cog", "cognate",
+                  "langname-mention"):
+        args = [source, term]
+    if rnd.random() < 0.3:
+        args.append("t=" + syntheticWord(rnd))
+    if rnd.random() < 0.1:
+        args.append("")
+    return "{{" + "|".join([name] + args) + "}}"
+
+
+def syntheticSection(rnd, language, code, title):
+    """Returns the text of a random ``language`` section for the page
+    ``title``."""
+    lines = ["=={}==".format(language), ""]
+    etymologies = 1 if rnd.random() < 0.9 else rnd.randint(2, 3)
+    for e in range(etymologies):
+        heading = "Etymology"
+        if etymologies > 1:
+            heading += " {}".format(e + 1)
+        lines.append("==={}===".format(heading))
+        parts = ["From " + syntheticTemplate(rnd, code)]
+        for i in range(rnd.randint(0, 3)):
+            parts.append(rnd.choice([", from ", ", derived from ",
+                                     ". Compare "]) +
+                         syntheticTemplate(rnd, code))
+        if rnd.random() < 0.2:
+            parts.append(" <!-- {{rfe|" + code + "}} -->")
+        lines.extend(["".join(parts) + ".", ""])
+        if rnd.random() < 0.5:
+            lines.extend(["===Pronunciation===",
+                          "* {{IPA|" + code + "|/" + title + "/}}", ""])
+        for pos in rnd.sample(synthetic_pos, rnd.randint(1, 2)):
+            lines.extend(["===" + pos + "===",
+                          "{{head|" + code + "|" + pos.lower() + "}}", ""])
+            for i in range(rnd.randint(1, 5)):
+                sense = "# [[{}]]".format(syntheticWord(rnd))
+                if rnd.random() < 0.3:
+                    sense = "# {{lb|" + code + "|informal}} " + sense[2:]
+                if rnd.random() < 0.3:
+                    sense += " {{gloss|" + syntheticWord(rnd) + "}}"
+                lines.append(sense)
+            lines.append("")
+            if rnd.random() < 0.3:
+                lines.extend(["====Synonyms====",
+                              "* {{l|" + code + "|" + syntheticWord(rnd) +
+                              "}}", ""])
+            if code == "en" and rnd.random() < 0.5:
+                lines.append("====Translations====")
+                lines.append("{{trans-top|" + syntheticWord(rnd) + "}}")
+                for name, other, weight in rnd.sample(synthetic_languages,
+                                                      3):
+                    lines.append("* {}: {{{{t+|{}|{}}}}}"
+                                 .format(name, other, syntheticWord(rnd)))
+                lines.extend(["{{trans-bottom}}", ""])
+    return "\n".join(lines)
+
+
+def syntheticPage(rnd, title):
+    """Returns the text of a random page ``title`` with a realistic number
+    of language sections."""
+    count = rnd.choices(range(1, len(synthetic_section_counts) + 1),
+                        synthetic_section_counts)[0]
+    languages = []
+    while len(languages) < count:
+        language = rnd.choices(synthetic_languages,
+                               list(x[2] for x in synthetic_languages))[0]
+        if language not in languages:
+            languages.append(language)
+    languages.sort()
+    sections = list(syntheticSection(rnd, name, code, title)
+                    for name, code, weight in languages)
+    return "{{also|" + title + "s}}\n" + "\n----\n\n".join(sections)
+
+
+def generateDump(path, pages=2000, seed=0, redirects=0.05,
+                 special_titles=0.0, other_namespaces=0.0):
+    """Writes a synthetic dump of ``pages`` pages to ``path``, the same for
+    the same ``seed``.  A fraction ``redirects`` of the pages are
+    redirects to other pages, a fraction ``special_titles`` have titles
+    with characters that are escaped in XML, and a fraction
+    ``other_namespaces`` are in the Template: and Appendix: namespaces
+    (with the same kind of text as the others)."""
+    rnd = random.Random(seed)
+    titles = []
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/"'
+                ' version="0.10" xml:lang="en">\n'
+                '  <siteinfo>\n'
+                '    <sitename>Wiktionary</sitename>\n'
+                '    <namespaces>\n'
+                '      <namespace key="0" case="case-sensitive" />\n'
+                '      <namespace key="10" case="case-sensitive">Template'
+                '</namespace>\n'
+                '      <namespace key="100" case="case-sensitive">Appendix'
+                '</namespace>\n'
+                '    </namespaces>\n'
+                '  </siteinfo>\n')
+        for pageid in range(1, pages + 1):
+            title = "{}{}".format(syntheticWord(rnd), pageid)
+            if special_titles and rnd.random() < special_titles:
+                title = rnd.choice(synthetic_special_titles).format(
+                    syntheticWord(rnd), title)
+            ns = 0
+            if other_namespaces and rnd.random() < other_namespaces:
+                ns, prefix = rnd.choice([(10, "Template:"),
+                                         (100, "Appendix:")])
+                title = prefix + title
+            redirect = ""
+            if titles and rnd.random() < redirects:
+                target = rnd.choice(titles)
+                redirect = '    <redirect title="{}" />\n'.format(
+                    html.escape(target))
+                text = "#REDIRECT [[{}]]".format(target)
+            else:
+                titles.append(title)
+                text = syntheticPage(rnd, title)
+            f.write("  <page>\n"
+                    "    <title>{}</title>\n"
+                    "    <ns>{}</ns>\n"
+                    "    <id>{}</id>\n"
+                    "{}"
+                    "    <revision>\n"
+                    "      <id>{}</id>\n"
+                    "      <model>wikitext</model>\n"
+                    "      <format>text/x-wiki</format>\n"
+                    '      <text xml:space="preserve">{}</text>\n'
+                    "      <sha1>{}</sha1>\n"
+                    "    </revision>\n"
+                    "  </page>\n".format(
+                        html.escape(title, quote=False), ns, pageid,
+                        redirect,
+                        1000000 + pageid, html.escape(text, quote=False),
+                        hashlib.sha1(text.encode("utf-8")).hexdigest()))
+        f.write("</mediawiki>\n")
+
+
+def writeMultistream(xml_path, path, index_path, pages_per_stream=100):
+    """Writes the uncompressed dump ``xml_path`` as a multistream dump
+    ``path`` (one bz2 stream for the header, one for each
+    ``pages_per_stream`` pages and one for the end) and its bz2 index
+    ``index_path``, with the titles XML-escaped as Wikimedia does."""
+    with open(xml_path, "rb") as f:
+        data = f.read()
+    first = data.find(b"  <page>")
+    last = data.rfind(b"</page>\n") + len(b"</page>\n")
+    pages = re.findall(rb"(?s)  <page>.*?</page>\n", data[first:last])
+    with open(path, "wb") as out, \
+         bz2.open(index_path, "wt", encoding="utf-8") as index:
+        out.write(bz2.compress(data[:first]))
+        for i in range(0, len(pages), pages_per_stream):
+            offset = out.tell()
+            stream = pages[i:i + pages_per_stream]
+            for page in stream:
+                title = html.unescape(re.search(
+                    rb"<title>(.*?)</title>", page).group(1).decode("utf-8"))
+                pageid = int(re.search(rb"<id>(\d+)</id>", page).group(1))
+                index.write("{}:{}:{}\n".format(offset, pageid,
+                                                html.escape(title)))
+            out.write(bz2.compress(b"".join(stream)))
+        out.write(bz2.compress(data[last:]))
+
+
+def runSuite(path, repeat=3):
+    """Times parseWiktionary() on the dump ``path`` capturing all the
+    languages of synthetic dumps, and the hot functions on the inputs
+    they get from it.  Returns the results as a JSON-serializable
+    dict."""
+    texts = readTexts(path)
+    languages = list(x[0] for x in synthetic_languages)
+    best = None
+    for i in range(repeat):
+        words = []
+        start = time.perf_counter()
+        ctx = WiktionaryParser.parseWiktionary(path, words.append,
+                                               languages=languages,
+                                               redirects=True,
+                                               translations=True)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best[0]:
+            best = (seconds, len(words), ctx.report())
+    seconds, num_words, report = best
+    size = os.path.getsize(path)
+
+    set_clean_value_cache(0)
+    values = templateValues(texts)
+    sections = etymologySections(texts)
+
+    def parse_etymology(text):
+        WiktionaryParser.parseEtymology("", {}, text)
+
+    functions = {}
+    for name, fn, inputs in (("clean_value", clean_value, values),
+                             ("split_subsections",
+                              lambda text: list(split_subsections(text)),
+                              texts),
+                             ("parseEtymology", parse_etymology, sections)):
+        functions[name] = {"inputs": len(inputs),
+                           "seconds": timeit(fn, inputs, repeat)}
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "dump": {"path": path, "bytes": size, "pages": len(texts)},
+        "parse": {"seconds": seconds,
+                  "words": num_words,
+                  "pages_per_s": len(texts) / seconds,
+                  "mb_per_s": size / 1e6 / seconds,
+                  "stages": report["stages"]},
+        "functions": functions,
+    }
+
+
+def compareResults(old, new):
+    """Prints the times of the results ``new`` of runSuite() relative to the
+    results ``old``, e.g., from the previous commit."""
+    if old["dump"] != new["dump"]:
+        print("Note: the results are for different dumps")
+    rows = [("parseWiktionary", old["parse"]["seconds"],
+             new["parse"]["seconds"])]
+    for name, result in new["functions"].items():
+        if name in old["functions"]:
+            rows.append((name, old["functions"][name]["seconds"],
+                         result["seconds"]))
+    for name, old_time, new_time in rows:
+        print("{}: {:.3f}s -> {:.3f}s ({:+.1f}%)".format(
+            name, old_time, new_time, 100 * (new_time / old_time - 1)))
+
+
+checks = {
+    "etymology": checkEtymology,
+    "clean_value": checkCleanValue,
+    "clean_cache": checkCleanValueCache,
+    "adversarial": checkAdversarial,
+    "headings": checkHeadings,
+    "neo4j": checkNeo4j,
+    "export": checkExport,
+    "sinks": checkSinks,
+    "fanout": checkFanOut,
+    "incremental": checkIncremental,
+    "namespaces": checkNamespaces,
+    "prefilter": checkPrefilter,
+    "workers": checkWorkers,
+    "resume": checkResume,
+    "multistream": checkMultistream,
+    "prefetch": checkPrefetch,
+    "decompressors": checkDecompressors,
+    "titles": checkTitleIndex,
+    "shards": checkShards,
+    "timeout": checkPageTimeout,
+    "report": checkReport,
+}
+
+
+if __name__ == "__main__":
+    path = "amigo.xml"
+    names = sys.argv[1:]
+    if names and names[0] == "generate":
+        args = list(int(x) for x in names[2:4])
+        if names[1].endswith(".xml.bz2"):
+            # A multistream dump, with its index next to it.
+            with tempfile.TemporaryDirectory() as tmpdir:
+                xml_path = os.path.join(tmpdir, "dump.xml")
+                generateDump(xml_path, *args)
+                writeMultistream(xml_path, names[1],
+                                 names[1][:-len(".xml.bz2")] +
+                                 "-index.txt.bz2")
+        else:
+            generateDump(names[1], *args)
+        sys.exit(0)
+    if names and names[0] == "suite":
+        # The arguments after the results are told apart by their form.
+        path = previous = None
+        pages = 2000
+        for arg in names[2:]:
+            if arg.endswith(".json"):
+                previous = arg
+            elif arg.isdigit():
+                pages = int(arg)
+            else:
+                path = arg
+        with tempfile.TemporaryDirectory() as tmpdir:
+            synthetic = path is None
+            if synthetic:
+                path = os.path.join(tmpdir, "synthetic.xml")
+                generateDump(path, pages)
+            results = runSuite(path)
+        if synthetic:
+            results["dump"]["path"] = "synthetic"
+        with open(names[1], "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        if previous is not None:
+            with open(previous) as f:
+                compareResults(json.load(f), results)
+        sys.exit(0)
+    if names and names[0] not in checks:
+        path = names.pop(0)
+    texts = readTexts(path)
+    for name in names or checks.keys():
+        checks[name](texts)
@@ -1,9 +1,9 @@
 import re
 
 # These XML tags are ignored when parsing.
-ignore_tags = set(["sha1", "comment", "username", "timestamp",
+ignore_tags = set(["comment", "username", "timestamp",
                    "sitename", "dbname", "base", "generator", "case",
-                   "ns", "restrictions", "contributor", "username",
+                   "restrictions", "contributor", "username",
                    "minor", "parentid", "namespaces", "revision",
                    "siteinfo", "mediawiki",
 ])
@@ -0,0 +1,517 @@
+import bz2
+import collections
+import gzip
+import html
+import lzma
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from lxml import etree
+
+
+def openIndex(index_path):
+    """Opens the index of a multistream dump for reading as text.  Wikimedia
+    publishes the index compressed ("...-multistream-index.txt.bz2"), but
+    an already decompressed index is accepted too."""
+    assert isinstance(index_path, str)
+    if index_path.endswith(".bz2"):
+        return bz2.open(index_path, "rt", encoding="utf-8")
+    return open(index_path, "r", encoding="utf-8")
+
+
+def iterIndex(index_path):
+    """Iterates over the entries of a multistream index.  Each line of the
+    index is "<stream offset>:<page id>:<title>"; this yields
+    ``(offset, pageid, title)`` for each line.  Note that titles may
+    themselves contain colons.  The titles are XML-escaped in the index
+    (e.g., "AT&amp;T"), and are unescaped as in the dump itself."""
+    with openIndex(index_path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            offset, pageid, title = line.split(":", 2)
+            yield int(offset), int(pageid), html.unescape(title)
+
+
+def streamRanges(path, index_path):
+    """Returns a list of ``(start, end)`` byte ranges of the independent bz2
+    streams in the multistream dump ``path``.  The first range is the
+    stream containing the ``<mediawiki>`` and ``<siteinfo>`` header,
+    which is not listed in the index, and the last one extends to the
+    end of the file (it also contains the closing ``</mediawiki>``)."""
+    offsets = set(offset for offset, pageid, title in iterIndex(index_path))
+    offsets.add(0)
+    starts = sorted(offsets)
+    ends = starts[1:] + [os.path.getsize(path)]
+    return list(zip(starts, ends))
+
+
+def readStream(path, start, end):
+    """Reads and decompresses the bz2 stream at bytes ``start`` to ``end``
+    of ``path``."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        return bz2.decompress(f.read(end - start))
+
+
+def _readStream(args):
+    """Pool wrapper for readStream()."""
+    return readStream(*args)
+
+
+# External commands that decompress their standard input to stdout, by file
+# extension, in order of preference.  The first one found on the PATH is
+# used by default.
+decompressors = {
+    ".bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"]],
+    ".gz": [["pigz", "-dc"], ["gzip", "-dc"]],
+    ".xz": [["xz", "-dc"]],
+    ".zst": [["zstd", "-dc"]],
+}
+
+# Python modules that can decompress a file, by file extension.
+decompress_modules = {
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+
+
+def findDecompressor(path):
+    """Returns the default external decompressor command for the file
+    ``path`` (see ``decompressors``), or None if it should be read with a
+    Python module or is not compressed."""
+    for cmd in decompressors.get(os.path.splitext(path)[1], []):
+        if shutil.which(cmd[0]):
+            return cmd
+    return None
+
+
+def iterFile(path, start=0, chunk_size=(1024 * 1024), decompressor=None,
+             stats=None):
+    """Iterates over the contents of the dump file ``path`` in chunks of
+    ``chunk_size`` bytes, yielding ``(pos, data)`` for each chunk.  A
+    compressed file (".bz2", ".gz", ".xz" or ".zst") is decompressed, and
+    ``pos`` is then the position in the decompressed data.  Reading
+    starts at position ``start``.  If ``stats`` is given, the position
+    reached in the file itself (which differs from ``pos`` for a
+    compressed file) is kept in ``stats["input_pos"]``.
+
+    By default a compressed file is decompressed by an external command
+    from ``decompressors`` if one is installed (the parallel bzip2
+    decompressors are much faster than the bz2 module), and otherwise
+    by a Python module.  ``decompressor`` can instead be a command
+    (e.g., ``["lbzip2", "-dc", "-n", "8"]``) that reads the file from
+    its standard input, or "python" to always use the Python modules."""
+    assert isinstance(path, str)
+    assert isinstance(start, int) and start >= 0
+    assert (decompressor is None or decompressor == "python" or
+            isinstance(decompressor, (list, tuple)))
+    ext = os.path.splitext(path)[1]
+    if decompressor is None:
+        decompressor = findDecompressor(path)
+    if isinstance(decompressor, (list, tuple)):
+        return _iterPipe(list(decompressor), path, start, chunk_size, stats)
+    if ext not in decompress_modules and ext in decompressors:
+        raise ValueError("{}: no decompressor found for {} files"
+                         .format(path, ext))
+    raw = open(path, "rb", buffering=(4 * 1024 * 1024))
+    f = raw
+    if ext in decompress_modules:
+        f = decompress_modules[ext](raw, "rb")
+    return _iterStream(f, raw, start, chunk_size, stats)
+
+
+def _iterStream(f, raw, start, chunk_size, stats):
+    """Iterates over the chunks of the file object ``f``, which reads the
+    file ``raw``, for iterFile()."""
+    try:
+        if start:
+            f.seek(start)
+        pos = start
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            if stats is not None:
+                stats["input_pos"] = raw.tell()
+            yield pos, data
+            pos += len(data)
+    finally:
+        f.close()
+        raw.close()
+
+
+def _iterPipe(cmd, path, start, chunk_size, stats):
+    """Iterates over the chunks of the output of the decompressor command
+    ``cmd`` run on the file ``path`` for iterFile().  The data before
+    position ``start`` is read and discarded.  Raises OSError with the
+    error output of the command if it fails.  If the iteration is stopped
+    early, the command is killed."""
+    with open(path, "rb") as f, tempfile.TemporaryFile() as err:
+        # The command shares the offset of ``f``, which tells how far it
+        # has read the file.
+        proc = subprocess.Popen(cmd, stdin=f, stdout=subprocess.PIPE,
+                                stderr=err)
+        completed = False
+        try:
+            pos = 0
+            while True:
+                data = proc.stdout.read(chunk_size)
+                if not data:
+                    break
+                if pos + len(data) > start:
+                    if pos < start:
+                        data = data[start - pos:]
+                        pos = start
+                    if stats is not None:
+                        stats["input_pos"] = os.lseek(f.fileno(), 0,
+                                                      os.SEEK_CUR)
+                    yield pos, data
+                pos += len(data)
+            completed = True
+        finally:
+            if not completed:
+                proc.kill()
+            proc.stdout.close()
+            status = proc.wait()
+        if status != 0:
+            err.seek(0)
+            msg = err.read().decode("utf-8", "replace").strip()
+            raise OSError("{} failed on {} with exit status {}: {}"
+                          .format(" ".join(cmd), path, status, msg))
+        if pos < start:
+            raise ValueError("{}: cannot start at {}, there are only {} "
+                             "bytes".format(path, start, pos))
+
+
+def openMapped(path):
+    """Returns a read-only memory map of the uncompressed dump ``path``, or
+    an empty bytes object if the file is empty."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iterMapped(path, start=0, end=None, header=False):
+    """Iterates over the uncompressed dump ``path`` through a memory map,
+    yielding ``(pos, data)`` for the XML before the first ``<page>`` and
+    then for each page, from its ``<page>`` tag up to the next one.
+    Reading starts at position ``start``, which must be at a page (or
+    0), and stops at position ``end``, which must be at a page (or the
+    end of the file).  If reading stops before the end of the file, the
+    document element is closed at the end.  If ``header`` is True and
+    ``start`` is not 0, the XML before the first page is yielded first
+    (at position ``start``), so that the chunks form a complete
+    document.  See also shardRanges()."""
+    assert isinstance(path, str)
+    assert isinstance(start, int) and start >= 0
+    assert end is None or (isinstance(end, int) and end >= start)
+    buf = openMapped(path)
+    try:
+        if end is None:
+            end = len(buf)
+        if header and start > 0:
+            first = buf.find(b"<page>")
+            yield start, buf[:first]
+        pos = start
+        while pos < end:
+            idx = buf.find(b"<page>", pos + 1, end)
+            if idx < 0:
+                idx = end
+            yield pos, buf[pos:idx]
+            pos = idx
+        if end < len(buf):
+            yield end, b"</mediawiki>"
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+def shardRanges(path, num_shards):
+    """Divides the uncompressed dump ``path`` into ``num_shards`` ranges
+    of about the same size that start and end at page boundaries, so
+    that they can be parsed independently (see iterMapped()).  Returns a
+    list of ``(start, end)``; some may be empty if pages are large."""
+    assert isinstance(num_shards, int) and num_shards > 0
+    buf = openMapped(path)
+    try:
+        size = len(buf)
+        bounds = [0]
+        for i in range(1, num_shards):
+            idx = buf.find(b"<page>", max(bounds[-1], size * i // num_shards))
+            bounds.append(size if idx < 0 else idx)
+        bounds.append(size)
+        return list(zip(bounds[:-1], bounds[1:]))
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+def mappedPageText(buf, start, end):
+    """Returns the text of the page at bytes ``start`` to ``end`` of the
+    memory-mapped dump ``buf``, as a parser target would collect it (the
+    text of the last revision, stripped)."""
+    data = buf[start:end]
+    data = data[:data.rfind(b"</page>") + len(b"</page>")]
+    text = None
+    for elem in etree.fromstring(data).iter("{*}text"):
+        text = (elem.text or "").strip()
+    return text
+
+
+def iterMultistream(path, index_path, workers=0, start=0):
+    """Iterates over the decompressed contents of each bz2 stream of the
+    multistream dump ``path``, in file order, yielding ``(pos, data)``
+    where ``pos`` is the offset of the stream in the file.  The
+    concatenation of the chunks is the full XML document, so they can be
+    fed directly to an XML parser.  Streams before offset ``start`` are
+    skipped.  If ``workers`` is greater than zero, the streams are
+    decompressed in that many worker processes.  At most two streams per
+    worker are decompressed ahead of the consumer so that memory use
+    stays bounded when parsing is the bottleneck."""
+    assert isinstance(path, str)
+    assert isinstance(index_path, str)
+    assert isinstance(workers, int) and workers >= 0
+    ranges = [(s, e) for s, e in streamRanges(path, index_path) if s >= start]
+    if workers == 0:
+        for s, e in ranges:
+            yield s, readStream(path, s, e)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for s, e in ranges:
+            pending.append((s, pool.apply_async(_readStream,
+                                                ((path, s, e),))))
+            while len(pending) > 2 * workers:
+                s, result = pending.popleft()
+                yield s, result.get()
+        while pending:
+            s, result = pending.popleft()
+            yield s, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def prefetchChunks(chunks, depth, stats=None):
+    """Iterates over the ``(pos, data)`` chunks of ``chunks`` (as returned by
+    iterFile() or iterMultistream()), which are read in a separate thread
+    that stays up to ``depth`` chunks ahead.  bz2 decompression releases
+    the GIL, so it can then overlap with the parsing of earlier chunks.
+    If ``stats`` is given, the time spent reading is added to
+    ``stats["read_seconds"]``.  Errors in the reader thread are raised
+    here.  Closing this iterator stops the reader thread and closes
+    ``chunks``."""
+    assert isinstance(depth, int) and depth > 0
+    q = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(entry):
+        # Waits for room in the queue unless the consumer has gone away.
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        try:
+            it = iter(chunks)
+            while not stop.is_set():
+                t = time.perf_counter()
+                chunk = next(it, None)
+                if stats is not None:
+                    stats["read_seconds"] += time.perf_counter() - t
+                if chunk is None:
+                    put(("end", None))
+                    return
+                put(("chunk", chunk))
+        except BaseException as e:
+            put(("error", e))
+        finally:
+            chunks.close()
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = q.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+
+def timeChunks(chunks, stats, file_positions=False):
+    """Iterates over ``chunks``, adding the time spent waiting for each
+    chunk to ``stats["wait_seconds"]`` and the number of chunks and bytes
+    to ``stats["chunks"]`` and ``stats["bytes"]``.  If ``file_positions``
+    is True, the positions of the chunks are offsets in the dump file
+    (as with iterMultistream() and iterMapped()), and the last one is
+    kept in ``stats["input_pos"]``."""
+    it = iter(chunks)
+    try:
+        while True:
+            t = time.perf_counter()
+            chunk = next(it, None)
+            stats["wait_seconds"] += time.perf_counter() - t
+            if chunk is None:
+                return
+            stats["chunks"] += 1
+            stats["bytes"] += len(chunk[1])
+            if file_positions:
+                stats["input_pos"] = chunk[0]
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def throughput(stats):
+    """Adds the derived throughput figures to the reading statistics
+    ``stats`` collected by prefetchChunks() and timeChunks() over
+    ``stats["seconds"]`` of parsing: "mb_per_s" is the overall rate,
+    "input_mb_per_s" the rate in the (possibly compressed) dump file
+    itself, from ``stats["input_start"]`` to ``stats["input_pos"]``,
+    "read_mb_per_s" the rate at which the input alone could be read,
+    and "overlap_seconds" the reading time that was hidden behind
+    parsing by prefetching."""
+    mb = stats["bytes"] / 1e6
+    input_mb = (stats["input_pos"] - stats["input_start"]) / 1e6
+    stats["mb_per_s"] = mb / stats["seconds"] if stats["seconds"] else 0.0
+    stats["input_mb_per_s"] = (input_mb / stats["seconds"]
+                               if stats["seconds"] else 0.0)
+    stats["read_mb_per_s"] = (mb / stats["read_seconds"]
+                              if stats["read_seconds"] else 0.0)
+    stats["overlap_seconds"] = max(0.0, stats["read_seconds"] -
+                                   stats["wait_seconds"])
+    return stats
+
+
+def titleIndexPath(path):
+    """Returns the default path of the title index for the dump ``path``."""
+    return path + ".titles.sqlite"
+
+
+def _scanPages(path):
+    """Scans an uncompressed XML dump and yields ``(offset, pageid, title)``
+    for each page, where ``offset`` is the byte offset of the line
+    containing its ``<page>`` tag.  This relies on the one-tag-per-line
+    layout of the Wikimedia dumps."""
+    title_re = re.compile(rb"<title>(.*)</title>")
+    id_re = re.compile(rb"<id>(\d+)</id>")
+    with open(path, "rb", buffering=(4 * 1024 * 1024)) as f:
+        offset = 0
+        start = None
+        title = None
+        for line in f:
+            if start is None:
+                if b"<page>" in line:
+                    start = offset
+            elif title is None:
+                m = title_re.search(line)
+                if m:
+                    title = html.unescape(m.group(1).decode("utf-8"))
+            else:
+                # The first <id> after the title is the page id; the
+                # revision ids come later.
+                m = id_re.search(line)
+                if m:
+                    yield start, int(m.group(1)), title
+                    start = None
+                    title = None
+            offset += len(line)
+
+
+def buildTitleIndex(path, index_path=None, db_path=None):
+    """Builds an on-disk index from page title to the page id and the
+    offset at which the page can be read in the dump ``path``.  For a
+    multistream dump, ``index_path`` must be its
+    "...-multistream-index.txt.bz2" and the offset is that of the bz2
+    stream containing the page.  For an uncompressed XML dump the file
+    is scanned once and the offset is that of the page itself.  The
+    index is stored in the SQLite database ``db_path`` (by default next
+    to the dump), which is returned."""
+    assert isinstance(path, str)
+    if db_path is None:
+        db_path = titleIndexPath(path)
+    if index_path is not None:
+        entries = iterIndex(index_path)
+    elif os.path.splitext(path)[1] in decompressors:
+        raise ValueError("{}: random access into a compressed dump requires "
+                         "the index of a multistream dump".format(path))
+    else:
+        entries = _scanPages(path)
+    tmp_path = db_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.execute("CREATE TABLE pages (title TEXT PRIMARY KEY, "
+                   "offset INTEGER, pageid INTEGER)")
+        db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+                       ((title, offset, pageid)
+                        for offset, pageid, title in entries))
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_path, db_path)
+    return db_path
+
+
+def lookupTitle(path, title, db_path=None):
+    """Returns ``(offset, pageid)`` for ``title`` from the title index of
+    the dump ``path``, or None if there is no such page."""
+    if db_path is None:
+        db_path = titleIndexPath(path)
+    if not os.path.exists(db_path):
+        raise FileNotFoundError("{}: no title index, see buildTitleIndex()"
+                                .format(db_path))
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute("SELECT offset, pageid FROM pages WHERE title = ?",
+                          (title,)).fetchone()
+    finally:
+        db.close()
+
+
+def readPages(path, offset):
+    """Reads the XML of the page(s) at ``offset`` of the dump ``path``.  For
+    a multistream dump this decompresses the whole bz2 stream at
+    ``offset``, which contains up to 100 pages; for an uncompressed dump
+    this reads the single page starting at ``offset``.  The returned
+    bytes are a sequence of ``<page>`` elements without the enclosing
+    ``<mediawiki>`` element."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        if path.endswith(".bz2"):
+            decomp = bz2.BZ2Decompressor()
+            parts = []
+            while not decomp.eof:
+                buf = f.read(256 * 1024)
+                if not buf:
+                    break
+                parts.append(decomp.decompress(buf))
+            return b"".join(parts)
+        parts = []
+        for line in f:
+            parts.append(line)
+            if b"</page>" in line:
+                break
+        return b"".join(parts)
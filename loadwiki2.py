@@ -1,22 +1,41 @@
 import wiktextract
 # import json    # or `import simplejson as json` if on Python < 2.6
-from neo4jcontroller import DbController
+from neo4jcontroller import BatchWriter, EtymologyGraph
+from sinks import AsyncSink
 
 filePath = 'enwiktionary-20190501-pages-meta-current.xml'
 
-db = DbController('bolt://localhost:7687', 'neo4j', 'h6u4%kr')
+# Words are merged into the database in batches over one session, on
+# their keys, which the constraint indexes.
+db = BatchWriter('bolt://localhost:7687', 'neo4j', 'h6u4%kr',
+                 batch_size=1000)
+db.createConstraints()
+# The etymology records are also written as relationships between terms.
+etymologies = EtymologyGraph(db)
+etymologies.createConstraints()
 
 def processWord(data):
-    print(data)
     if not "lang" in data.keys():
         return
     # obj = json.loads(data)
-    db.createWordNode(data)
+    db.addWord(data)
+    etymologies.addWord(data)
 
-ctx = wiktextract.parse_wiktionary(
-    path = filePath, word_cb=processWord,
-    capture_cb=None,
-    languages=["English", "Translingual"],
-    translations=False,
-    pronunciations=False,
-    redirects=True)
\ No newline at end of file
+# The words are written in another thread, so that parsing goes on during
+# the round trips to the database.
+sink = AsyncSink(processWord, name="neo4j")
+try:
+    with sink:
+        ctx = wiktextract.parse_wiktionary(
+            path = filePath, word_cb=sink,
+            capture_cb=None,
+            languages=["English", "Translingual"],
+            translations=False,
+            pronunciations=False,
+            redirects=True)
+finally:
+    db.close()
+print("{rows} rows in {batches} batches ({retries} retries), "
+      "{rows_per_s:.0f} rows/s".format(**db.stats()))
+print("queue depth {mean_depth:.0f} on average, {max_depth} at most, "
+      "blocked {blocked_seconds:.1f}s".format(**sink.stats()))
@@ -2,51 +2,87 @@ import sys
 import json
 import os
 import WiktionaryParser
+from sinks import AsyncSink
 
 # infile = 'copyright.xml'
 infile = 'enwiktionary-20190501-pages-meta-current.xml'
 # infile = 'amigo.xml'
 
-# Open output file.
+# Open output file.  When writing to a regular file, a checkpoint is kept
+# next to it so that an interrupted run continues where it left off.
 out_path = "words.json"
+checkpoint_path = None
+resume_from = None
+word_count = 0
 if out_path and out_path != "-":
     if out_path.startswith("/dev/"):
         out_tmp_path = out_path
     else:
         out_tmp_path = out_path + ".tmp"
-    out_f = open(out_tmp_path, "w", buffering=1024*1024)
+        checkpoint_path = out_path + ".checkpoint"
+    if (checkpoint_path and os.path.exists(checkpoint_path) and
+        os.path.exists(out_tmp_path)):
+        # Drop whatever was written after the checkpoint and append.
+        state = WiktionaryParser.loadCheckpoint(checkpoint_path)
+        os.truncate(out_tmp_path, state["output"]["offset"])
+        word_count = state["output"]["word_count"]
+        resume_from = checkpoint_path
+        out_f = open(out_tmp_path, "a", buffering=1024*1024)
+    else:
+        out_f = open(out_tmp_path, "w", buffering=1024*1024)
 else:
     out_tmp_path = out_path
     out_f = sys.stdout
 
-word_count = 0
+def checkpoint_cb():
+    # The words queued before the checkpoint must be in the file.
+    sink.flush()
+    out_f.flush()
+    os.fsync(out_f.fileno())
+    return {"offset": out_f.tell(), "word_count": word_count}
+
+def capture_cb(title, text):
+    # return capture_page(title, text, args.pages_dir)
+    return True
+
+words = WiktionaryParser.iterWords(
+    # args.path,
+    infile,
+    capture_cb,
+    languages=["Portuguese", "Translingual"], #args.language,
+    pronunciations=False, #args.pronunciations,
+    translations=False, #args.translations,
+    linkages=False, #args.linkages,
+    compounds=False, #args.compounds,
+    redirects=False, #args.redirects
+    namespaces=[""],
+    # Only the words are kept, so pages without a captured language can be
+    # skipped (they are then missing from the language counts).
+    prefilter=True,
+    checkpoint=checkpoint_path,
+    checkpoint_cb=checkpoint_cb,
+    # The checkpoint is removed below, once the queued words are written.
+    keep_checkpoint=True,
+    resume_from=resume_from,
+    progress=60
+)
 
-def word_cb(data):
-    global word_count
-    word_count += 1
+def write_word(data):
     out_f.write(json.dumps(data))
     out_f.write("\n")
     if not out_path or out_path == "-":
         out_f.flush()
 
-def capture_cb(title, text):
-    # return capture_page(title, text, args.pages_dir)
-    return True
-
+# The words are written in another thread, so that parsing goes on while
+# the output is written.
+sink = AsyncSink(write_word, name="json")
 try:
-    ctx = WiktionaryParser.parseWiktionary(
-        # args.path,
-        infile,
-        word_cb,
-        capture_cb,
-        languages=["Portuguese", "Translingual"], #args.language,
-        pronunciations=False, #args.pronunciations,
-        translations=False, #args.translations,
-        linkages=False, #args.linkages,
-        compounds=False, #args.compounds,
-        redirects=False #args.redirects
-    )
+    with sink:
+        for data in words:
+            word_count += 1
+            sink.addWord(data)
 finally:
+    words.close()
     if out_path and out_path != "-":
         out_f.close()
 
@@ -56,3 +92,5 @@ if out_path != out_tmp_path:
     except FileNotFoundError:
         pass
     os.rename(out_tmp_path, out_path)
+if checkpoint_path:
+    WiktionaryParser.removeCheckpoint(checkpoint_path)
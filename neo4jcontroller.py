@@ -1,4 +1,18 @@
-from neo4j import GraphDatabase
+import collections
+import json
+import re
+import time
+
+try:
+    from neo4j import GraphDatabase
+    from neo4j.exceptions import (ServiceUnavailable, SessionExpired,
+                                  TransientError)
+    # Errors after which a batch is retried (see BatchWriter.isTransient()).
+    transient_errors = (ServiceUnavailable, SessionExpired, TransientError)
+except ImportError:
+    # BatchWriter can still be used with another driver.
+    GraphDatabase = None
+    transient_errors = ()
 
 class DbController(object):
 
@@ -46,3 +60,454 @@ class DbController(object):
         result = tx.run(txt)
         return result.single()[0]
 
+
+# Labels and property names that can be used in statements without quoting.
+identifier_re = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Keys of the word records that are not stored as node properties (as in
+# DbController._wordToString()).
+skipped_word_keys = ("heads", "senses", "categories")
+
+
+def nodeProperties(data, skip=()):
+    """Converts the record ``data`` into properties that Neo4j can store:
+    strings, numbers, booleans and lists of values of one of these types
+    are kept, None values are dropped, and anything else (e.g., a list
+    of etymology records, or of strings and numbers, which Neo4j rejects)
+    is stored as JSON.  Keys in ``skip`` are left out."""
+    props = {}
+    for k, v in data.items():
+        if k in skip or v is None:
+            continue
+        if isinstance(v, (list, tuple)):
+            types = set(type(x) for x in v)
+            if len(types) <= 1 and types <= {str, int, float, bool}:
+                v = list(v)
+            else:
+                v = json.dumps(v, ensure_ascii=False, sort_keys=True)
+        elif not isinstance(v, (str, int, float, bool)):
+            v = json.dumps(v, ensure_ascii=False, sort_keys=True)
+        props[k] = v
+    return props
+
+
+class BatchWriter(object):
+    """Writes records to Neo4j in batches.  Rows are buffered per statement
+    and written ``batch_size`` at a time as the ``$rows`` parameter of
+    the statement (e.g., ``UNWIND $rows AS row MERGE ...``), each batch
+    in one transaction of a session that is reused across batches.
+    When a batch is full, all buffered rows are written, in the order in
+    which their statements were first used, so that e.g. nodes are
+    written before the relationships between them.
+
+    A batch that fails with a transient error (see isTransient()) is
+    retried up to ``max_retries`` times on a new session, waiting
+    ``retry_delay`` seconds the first time and twice as long each time
+    after that.  Other errors are raised to the caller, and the rows
+    stay buffered.
+
+    ``driver`` can be any object with the session() method of a Neo4j
+    driver (e.g., a fake one for testing); otherwise a driver is
+    created for ``uri``, ``user`` and ``password``, and closed by
+    close().  The counts and throughput of the writes are returned by
+    stats()."""
+
+    def __init__(self, uri=None, user=None, password=None, driver=None,
+                 database=None, batch_size=1000, max_retries=5,
+                 retry_delay=0.1, label="word", key=("word", "lang", "pos")):
+        assert driver is not None or isinstance(uri, str)
+        assert database is None or isinstance(database, str)
+        assert isinstance(batch_size, int) and batch_size > 0
+        assert isinstance(max_retries, int) and max_retries >= 0
+        assert isinstance(retry_delay, (int, float)) and retry_delay >= 0
+        assert identifier_re.match(label)
+        for name in key:
+            assert identifier_re.match(name)
+        self.own_driver = driver is None
+        if driver is None:
+            if GraphDatabase is None:
+                raise ValueError("the neo4j package is needed to connect to "
+                                 "{}".format(uri))
+            driver = GraphDatabase.driver(uri, auth=(user, password))
+        self.driver = driver
+        self.database = database
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.label = label
+        self.key = tuple(key)
+        # Words are merged on their key properties; a missing key is stored
+        # as "", as MERGE does not accept null values.
+        self.word_statement = (
+            "UNWIND $rows AS row MERGE (n:" + label + " {" +
+            ", ".join("{0}: row.key.{0}".format(name) for name in key) +
+            "}) SET n += row.props")
+        self.session = None
+        self.buffers = {}
+        self.counts = {"rows": 0, "batches": 0, "retries": 0}
+        self.write_seconds = 0.0
+        self.start_time = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(flush=(exc_type is None))
+
+    def constraintStatements(self):
+        """Returns the statements that create the constraints the words
+        need (Neo4j 5 syntax): their keys are unique, which also indexes
+        them, so that the MERGE of each word does not scan all the
+        words."""
+        return ["CREATE CONSTRAINT " + self.label + "_key IF NOT EXISTS "
+                "FOR (n:" + self.label + ") "
+                "REQUIRE (" + ", ".join("n." + name for name in self.key) +
+                ") IS UNIQUE"]
+
+    def createConstraints(self):
+        """Creates the constraints of constraintStatements(), if they do
+        not exist yet.  This should be called before any words are
+        added."""
+        for statement in self.constraintStatements():
+            self.runStatement(statement)
+
+    def addWord(self, data):
+        """Adds a word record (as produced by the parser) to be merged as a
+        node.  Its nested values are stored as JSON; see
+        nodeProperties()."""
+        key = dict((name, data.get(name) or "") for name in self.key)
+        self.addRow(self.word_statement,
+                    {"key": key,
+                     "props": nodeProperties(data, skipped_word_keys)})
+
+    def addRow(self, statement, row):
+        """Adds ``row`` to be written with ``statement``, which gets a batch
+        of rows as ``$rows``.  Once the batch is full, all buffered rows
+        are written."""
+        rows = self.buffers.get(statement)
+        if rows is None:
+            rows = self.buffers[statement] = []
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows."""
+        for statement, rows in self.buffers.items():
+            if rows:
+                self.writeBatch(statement, rows)
+                rows.clear()
+
+    def isTransient(self, e):
+        """Returns True if the exception ``e`` is a transient error after
+        which a batch can be retried: one of ``transient_errors`` of the
+        neo4j package, or an error whose is_retryable() method returns
+        True."""
+        if isinstance(e, transient_errors):
+            return True
+        is_retryable = getattr(e, "is_retryable", None)
+        return callable(is_retryable) and bool(is_retryable())
+
+    def retry(self, fn):
+        """Calls ``fn(session)`` with the session of this writer, retrying
+        on transient errors.  Returns the number of retries."""
+        delay = self.retry_delay
+        retries = 0
+        while True:
+            try:
+                if self.session is None:
+                    if self.database is None:
+                        self.session = self.driver.session()
+                    else:
+                        self.session = self.driver.session(
+                            database=self.database)
+                fn(self.session)
+                return retries
+            except Exception as e:
+                if not self.isTransient(e) or retries >= self.max_retries:
+                    raise
+                self.closeSession()
+                retries += 1
+                time.sleep(delay)
+                delay *= 2
+
+    def writeBatch(self, statement, rows):
+        """Writes ``rows`` with ``statement`` in one transaction, retrying
+        on transient errors."""
+        start = time.perf_counter()
+        rows = list(rows)
+
+        def write(session):
+            # execute_write() replaces write_transaction() in newer
+            # versions of the driver.
+            execute = getattr(session, "execute_write", None)
+            if execute is None:
+                execute = session.write_transaction
+            execute(_runBatch, statement, rows)
+
+        retries = self.retry(write)
+        self.counts["rows"] += len(rows)
+        self.counts["batches"] += 1
+        self.counts["retries"] += retries
+        self.write_seconds += time.perf_counter() - start
+
+    def runStatement(self, statement):
+        """Runs ``statement`` (e.g., a schema command) in its own
+        transaction, after writing the buffered rows."""
+        self.flush()
+        self.counts["retries"] += self.retry(
+            lambda session: session.run(statement).consume())
+
+    def closeSession(self):
+        """Closes the current session, ignoring errors (it may already be
+        broken)."""
+        if self.session is None:
+            return
+        try:
+            self.session.close()
+        except Exception:
+            pass
+        self.session = None
+
+    def close(self, flush=True):
+        """Writes the buffered rows (unless ``flush`` is False) and closes the
+        session, and the driver if it was created by this writer."""
+        try:
+            if flush:
+                self.flush()
+        finally:
+            self.closeSession()
+            if self.own_driver:
+                self.driver.close()
+                self.own_driver = False
+
+    def stats(self):
+        """Returns the numbers of "rows", "batches" and "retries" written so
+        far, the "seconds" spent writing them (including retries) and the
+        elapsed seconds, and the resulting "rows_per_s" rates."""
+        elapsed = time.perf_counter() - self.start_time
+        stats = dict(self.counts)
+        stats["seconds"] = self.write_seconds
+        stats["elapsed_seconds"] = elapsed
+        stats["rows_per_s"] = (self.counts["rows"] / self.write_seconds
+                               if self.write_seconds > 0 else 0.0)
+        stats["elapsed_rows_per_s"] = (self.counts["rows"] / elapsed
+                                       if elapsed > 0 else 0.0)
+        return stats
+
+
+def _runBatch(tx, statement, rows):
+    """Transaction function of BatchWriter.writeBatch()."""
+    tx.run(statement, rows=rows).consume()
+
+
+# The terms that an etymology record relates a word to, for the
+# relationships (template names, as in definitions.argsMap) that become
+# edges: a list of (word key, language key) of the record.  If the language
+# key is None or missing from the record, the term is in the language in
+# etymology_term_languages, or else in the language of the word itself.
+etymology_edge_terms = {
+    "borrowed": [("source word", "source language")],
+    "derived": [("source word", "source language")],
+    "inherited": [("source word", "source language")],
+    "learned borrowing": [("source word", "source language")],
+    "calque": [("source word", "source language")],
+    "mention": [("word", "language")],
+    "cognate": [("word", "language")],
+    "back-form": [("word", None)],
+    "clipping": [("word", None)],
+    "affix": [("word {}".format(i), "language {}".format(i))
+              for i in range(1, 5)],
+    "confix": [("word {}".format(i), "language {}".format(i))
+               for i in range(1, 5)],
+    "doublet": [("word {}".format(i), None) for i in range(1, 5)],
+    "prefix": [("prefix", "language prefix"), ("root", "language root")],
+    "suffix": [("root", "language root"), ("suffix", "language suffix")],
+    "PIE root": [("word {}".format(i), None) for i in range(1, 5)],
+}
+
+etymology_term_languages = {
+    "PIE root": "ine-pro",
+}
+
+# Relationships whose "language" is that of the word itself rather than of
+# the term it relates to.
+etymology_own_language = set(k for k in etymology_edge_terms
+                             if k not in ("mention", "cognate"))
+
+
+def wordLanguage(data, language_codes):
+    """Returns the language code of the word record ``data``: the code
+    given by its etymology records if they tell it, else the code
+    remembered in ``language_codes`` (a dict from language names to
+    codes, which is updated) for its language name, else the name."""
+    name = data.get("lang")
+    for record in data.get("etymology", ()):
+        if (record.get("relationship") in etymology_own_language and
+            record.get("language")):
+            code = record["language"]
+            if name:
+                language_codes.setdefault(name, code)
+            return code
+    return language_codes.get(name, name)
+
+
+def etymologyEdges(records, lang):
+    """Generates ``(relationship, target_word, target_lang, props)`` for
+    each term the etymology records ``records`` of a word of language
+    code ``lang`` relate it to (see etymology_edge_terms), where
+    ``props`` are the other fields of the record.  Records of other
+    relationships are ignored."""
+    for record in records:
+        relationship = record.get("relationship")
+        terms = etymology_edge_terms.get(relationship)
+        if terms is None:
+            continue
+        used = set(["relationship", "language"])
+        for word_key, lang_key in terms:
+            used.add(word_key)
+            used.add(lang_key)
+        props = nodeProperties(dict((k, v) for k, v in record.items()
+                                    if k not in used))
+        for word_key, lang_key in terms:
+            target_word = record.get(word_key)
+            if not target_word:
+                continue
+            if lang_key is not None and lang_key in record:
+                target_lang = record[lang_key]
+            else:
+                target_lang = etymology_term_languages.get(relationship,
+                                                           lang)
+            if not target_lang:
+                continue
+            yield relationship, target_word, target_lang, props
+
+
+class EtymologyGraph(object):
+    """Writes the etymology records of words as a graph through the
+    BatchWriter ``writer``: a node labeled ``label`` for each (word,
+    lang) term, and a relationship from the term of each word to each
+    term its etymology records relate it to, typed by the relationship
+    (e.g., "borrowed", "inherited", "derived", "mention", "cognate",
+    with other characters than letters, digits and "_" replaced by
+    "_"; see etymology_edge_terms; other records are ignored).  The other
+    fields of a record (e.g., "gloss") are set on the relationship.
+
+    The terms are keyed by the language codes used in the templates.
+    The code of the language of a word is taken from its records (the
+    language codes of the languages seen are remembered for words whose
+    records do not tell it); failing that, its language name is used.
+
+    The keys of the last ``cache_size`` terms merged are cached, and
+    they are not merged again.  The cache assumes that the writes
+    succeed; after an error, a new EtymologyGraph should be used."""
+
+    def __init__(self, writer, label="term", cache_size=100000):
+        assert isinstance(writer, BatchWriter)
+        assert identifier_re.match(label)
+        assert isinstance(cache_size, int) and cache_size >= 0
+        self.writer = writer
+        self.label = label
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.language_codes = {}
+        self.counts = collections.defaultdict(int)
+        self.node_statement = ("UNWIND $rows AS row MERGE (n:" + label +
+                               " {word: row.word, lang: row.lang})")
+        self.edge_statements = dict(
+            (relationship,
+             "UNWIND $rows AS row "
+             "MATCH (a:" + label + " {word: row.word, lang: row.lang}) "
+             "MATCH (b:" + label + " {word: row.target_word, "
+             "lang: row.target_lang}) "
+             "MERGE (a)-[r:" + re.sub(r"\W", "_", relationship) +
+             "]->(b) SET r += row.props")
+            for relationship in etymology_edge_terms)
+
+    def constraintStatements(self):
+        """Returns the statements that create the constraints the graph
+        needs (Neo4j 5 syntax): the (word, lang) keys of the terms are
+        unique, which also indexes them for the MERGE and MATCH of the
+        writes."""
+        return ["CREATE CONSTRAINT " + self.label + "_key IF NOT EXISTS "
+                "FOR (n:" + self.label + ") "
+                "REQUIRE (n.word, n.lang) IS UNIQUE"]
+
+    def createConstraints(self):
+        """Creates the constraints of constraintStatements(), if they do
+        not exist yet.  This should be called before any words are
+        added."""
+        for statement in self.constraintStatements():
+            self.writer.runStatement(statement)
+
+    def addTerm(self, word, lang):
+        """Merges the node of the term (``word``, ``lang``) unless it has
+        been merged recently."""
+        key = (word, lang)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.counts["cached_terms"] += 1
+            return
+        self.writer.addRow(self.node_statement, {"word": word, "lang": lang})
+        self.counts["terms"] += 1
+        if self.cache_size:
+            self.cache[key] = True
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def wordLanguage(self, data):
+        """Returns the language code of the word record ``data``."""
+        return wordLanguage(data, self.language_codes)
+
+    def addWord(self, data):
+        """Adds the terms and relationships of the etymology records of the
+        word record ``data``."""
+        records = data.get("etymology")
+        word = data.get("word")
+        if not records or not word:
+            return
+        lang = self.wordLanguage(data)
+        if not lang:
+            return
+        self.counts["skipped_records"] += sum(
+            1 for record in records
+            if record.get("relationship") not in etymology_edge_terms)
+        source_added = False
+        for relationship, target_word, target_lang, props in \
+                etymologyEdges(records, lang):
+            if not source_added:
+                self.addTerm(word, lang)
+                source_added = True
+            self.addTerm(target_word, target_lang)
+            self.writer.addRow(self.edge_statements[relationship],
+                               {"word": word, "lang": lang,
+                                "target_word": target_word,
+                                "target_lang": target_lang,
+                                "props": props})
+            self.counts[relationship] += 1
+
+
+class Neo4jSink(object):
+    """Sink (see sinks.FanOut) that writes the words with a language as
+    nodes through the BatchWriter ``writer``, and their etymology
+    records through the EtymologyGraph ``graph`` if it is given (which
+    should use the same writer).  Closing the sink closes the writer."""
+
+    def __init__(self, writer, graph=None):
+        assert isinstance(writer, BatchWriter)
+        assert graph is None or graph.writer is writer
+        self.writer = writer
+        self.graph = graph
+
+    def addWord(self, data):
+        if "lang" not in data:
+            return
+        self.writer.addWord(data)
+        if self.graph is not None:
+            self.graph.addWord(data)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
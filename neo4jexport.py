@@ -0,0 +1,270 @@
+import csv
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import WiktionaryParser
+from neo4jcontroller import (etymologyEdges, etymology_edge_terms,
+                             nodeProperties, skipped_word_keys, wordLanguage)
+
+
+class KeyTable(object):
+    """Set of the keys of the nodes written so far, used to write each node
+    once in a single pass.  The keys are kept in memory or, if ``path``
+    is given, in a SQLite table at ``path`` keyed by them (without row
+    ids, so that each key is stored once), which is slower but needs
+    little memory."""
+
+    def __init__(self, path=None):
+        assert path is None or isinstance(path, str)
+        self.path = path
+        self.count = 0
+        if path is None:
+            self.keys = set()
+            self.db = None
+        else:
+            self.keys = None
+            self.db = sqlite3.connect(path)
+            # The table is rebuilt by the next run if this one is cut short.
+            self.db.execute("PRAGMA journal_mode = OFF")
+            self.db.execute("PRAGMA synchronous = OFF")
+            self.db.execute("DROP TABLE IF EXISTS keys")
+            self.db.execute("CREATE TABLE keys (key TEXT PRIMARY KEY) "
+                            "WITHOUT ROWID")
+
+    def add(self, key):
+        """Adds the string ``key``.  Returns True if it is new."""
+        if self.db is None:
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+        else:
+            cursor = self.db.execute("INSERT OR IGNORE INTO keys VALUES (?)",
+                                     (key,))
+            if not cursor.rowcount:
+                return False
+        self.count += 1
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+class CsvExporter(object):
+    """Writes words and the etymology graph as CSV files for ``neo4j-admin
+    database import``, which builds a new database offline much faster
+    than writing the same graph through a server (see BatchWriter and
+    EtymologyGraph).  The graph is the same: a node labeled
+    ``word_label`` for each (word, lang, pos) key of the word records, a
+    node labeled ``term_label`` for each (word, lang) term of their
+    etymology records, and a relationship from the term of each word to
+    each term its records relate it to, typed by the relationship.
+
+    The files are written to ``directory``: words.csv, terms.csv and
+    relationships.csv (with ``.gz`` appended if ``compress`` is True),
+    each with a header line.  Each node is written the first time its
+    key is seen, so later records with the same key are dropped (rather
+    than updating the node as the MERGE of BatchWriter does); the keys
+    are kept in a KeyTable, in memory unless ``key_table`` gives the
+    path of an on-disk one.
+
+    The columns are fixed by the header, so the properties of words
+    other than ``word_columns`` and of relationships other than
+    ``edge_columns`` are stored together as JSON in a "props" column.
+    Lists are also stored as JSON."""
+
+    def __init__(self, directory, compress=False, key_table=None,
+                 word_label="word", term_label="term",
+                 word_key=("word", "lang", "pos"),
+                 word_columns=("etymology", "redirect"),
+                 edge_columns=("gloss", "alt", "alt word")):
+        assert isinstance(directory, str)
+        assert key_table is None or isinstance(key_table, str)
+        self.directory = directory
+        self.word_label = word_label
+        self.term_label = term_label
+        self.word_key = tuple(word_key)
+        self.word_columns = tuple(word_columns)
+        self.edge_columns = tuple(edge_columns)
+        self.language_codes = {}
+        self.edge_types = dict((relationship, re.sub(r"\W", "_",
+                                                     relationship))
+                               for relationship in etymology_edge_terms)
+        self.counts = {"words": 0, "duplicate_words": 0, "terms": 0,
+                       "relationships": 0}
+        # Whether any value has a line break, which neo4j-admin only
+        # accepts with --multiline-fields.
+        self.multiline = False
+        self.start_time = time.time()
+        os.makedirs(directory, exist_ok=True)
+        suffix = ".csv.gz" if compress else ".csv"
+        self.paths = dict((name, os.path.join(directory, name + suffix))
+                          for name in ("words", "terms", "relationships"))
+        self.files = {}
+        self.writers = {}
+        for name, path in self.paths.items():
+            if compress:
+                f = gzip.open(path, "wt", encoding="utf-8", newline="",
+                              compresslevel=1)
+            else:
+                f = open(path, "w", encoding="utf-8", newline="",
+                         buffering=1024*1024)
+            self.files[name] = f
+            self.writers[name] = csv.writer(f)
+        # The ids only link the rows of the files; they are not stored.
+        self.writers["words"].writerow(
+            [":ID(" + word_label + ")"] + list(self.word_key) +
+            list(self.word_columns) + ["props", ":LABEL"])
+        self.writers["terms"].writerow(
+            [":ID(" + term_label + ")", "word", "lang", ":LABEL"])
+        self.writers["relationships"].writerow(
+            [":START_ID(" + term_label + ")", ":END_ID(" + term_label + ")",
+             ":TYPE"] + list(self.edge_columns) + ["props"])
+        self.keys = KeyTable(key_table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def csvValue(self, v):
+        """Converts the property value ``v`` into a CSV field."""
+        if v is None:
+            return ""
+        if isinstance(v, bool):
+            v = "true" if v else "false"
+        elif isinstance(v, list):
+            v = json.dumps(v, ensure_ascii=False)
+        elif not isinstance(v, str):
+            v = str(v)
+        if "\n" in v or "\r" in v:
+            self.multiline = True
+        return v
+
+    def propsValue(self, props, columns):
+        """Returns the properties in ``props`` that are not in ``columns``
+        as a JSON CSV field, or "" if there are none."""
+        rest = dict((k, v) for k, v in props.items() if k not in columns)
+        if not rest:
+            return ""
+        return self.csvValue(json.dumps(rest, ensure_ascii=False,
+                                        sort_keys=True))
+
+    def addTerm(self, word, lang):
+        """Writes the node of the term (``word``, ``lang``) unless it has
+        been written already, and returns its id."""
+        # Titles, language codes and cleaned values have no tabs, so the
+        # ids are unambiguous.
+        term_id = lang + "\t" + word
+        if self.keys.add("t" + term_id):
+            self.writers["terms"].writerow(
+                [term_id, self.csvValue(word), self.csvValue(lang),
+                 self.term_label])
+            self.counts["terms"] += 1
+        return term_id
+
+    def addWord(self, data):
+        """Writes the node of the word record ``data`` unless one with its
+        key has been written already, and the terms and relationships of
+        its etymology records.  Records without a language (redirects)
+        are skipped, as in Neo4jSink."""
+        if "lang" not in data:
+            return
+        key = list(data.get(name) or "" for name in self.word_key)
+        word_id = "\t".join(key)
+        if self.keys.add("w" + word_id):
+            props = nodeProperties(data, skipped_word_keys)
+            columns = self.word_key + self.word_columns
+            self.writers["words"].writerow(
+                [word_id] + list(self.csvValue(v) for v in key) +
+                list(self.csvValue(props.get(name))
+                     for name in self.word_columns) +
+                [self.propsValue(props, columns), self.word_label])
+            self.counts["words"] += 1
+        else:
+            self.counts["duplicate_words"] += 1
+        records = data.get("etymology")
+        word = data.get("word")
+        if not records or not word:
+            return
+        lang = wordLanguage(data, self.language_codes)
+        if not lang:
+            return
+        source_id = None
+        for relationship, target_word, target_lang, props in \
+                etymologyEdges(records, lang):
+            if source_id is None:
+                source_id = self.addTerm(word, lang)
+            target_id = self.addTerm(target_word, target_lang)
+            self.writers["relationships"].writerow(
+                [source_id, target_id, self.edge_types[relationship]] +
+                list(self.csvValue(props.get(name))
+                     for name in self.edge_columns) +
+                [self.propsValue(props, self.edge_columns)])
+            self.counts["relationships"] += 1
+
+    def importCommand(self, database="neo4j"):
+        """Returns the neo4j-admin command (Neo4j 5 syntax) that imports
+        the files into a new database ``database``."""
+        args = ["neo4j-admin", "database", "import", "full",
+                "--nodes=" + self.paths["words"],
+                "--nodes=" + self.paths["terms"],
+                "--relationships=" + self.paths["relationships"]]
+        if self.multiline:
+            args.append("--multiline-fields=true")
+        args.append(database)
+        return " ".join(args)
+
+    def close(self):
+        """Closes the files."""
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.keys.close()
+
+    def stats(self):
+        """Returns the numbers of words, duplicate words dropped, terms
+        and relationships written, and the seconds since the exporter was
+        created."""
+        stats = dict(self.counts)
+        stats["seconds"] = time.time() - self.start_time
+        return stats
+
+
+def exportWiktionary(path, directory, compress=False, key_table=None,
+                     **kwargs):
+    """Parses the dump file ``path`` with parseWiktionary() (which gets
+    ``kwargs``) and writes the words and their etymology graph as CSV
+    files in ``directory`` for neo4j-admin; see CsvExporter.  Returns
+    the exporter, which is closed."""
+    exporter = CsvExporter(directory, compress=compress, key_table=key_table)
+    try:
+        WiktionaryParser.parseWiktionary(path, exporter.addWord, **kwargs)
+    finally:
+        exporter.close()
+    return exporter
+
+
+if __name__ == "__main__":
+    # Usage: python neo4jexport.py dump.xml.bz2 directory [language ...]
+    if len(sys.argv) < 3:
+        print("Usage: python neo4jexport.py dump.xml.bz2 directory "
+              "[language ...]")
+        sys.exit(1)
+    exporter = exportWiktionary(sys.argv[1], sys.argv[2],
+                                languages=sys.argv[3:] or ["English",
+                                                           "Translingual"])
+    print("{words} words ({duplicate_words} duplicates dropped), {terms} "
+          "terms, {relationships} relationships in {seconds:.1f}s".format(
+              **exporter.stats()))
+    print(exporter.importCommand())
@@ -0,0 +1,139 @@
+import json
+import sqlite3
+
+
+class PageStore(object):
+    """Persistent store of the pages seen by previous runs over a dump.  For
+    each page this keeps its revision id, the sha1 of its text, and the
+    words that were extracted from it, so that an incremental run only
+    needs to parse the pages that have changed.  Each run is a new
+    generation; pages not seen during a run have been deleted from the
+    dump.  Updates are written every ``flush_every`` pages, or only when
+    flush() is called if it is None.
+
+    The words of a page depend on the settings of the run (e.g., the
+    languages captured), which are given as ``settings``, a
+    JSON-serializable value.  If they differ from those of the previous
+    run, the stored words are not reused: the pages are kept (so that
+    deletions are still reported) but are all parsed again, and the
+    number of pages invalidated is in ``self.invalidated``."""
+
+    def __init__(self, path, flush_every=10000, settings=None):
+        assert isinstance(path, str)
+        assert flush_every is None or (isinstance(flush_every, int) and
+                                       flush_every > 0)
+        self.path = path
+        self.flush_every = flush_every
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages ("
+                        "pageid INTEGER PRIMARY KEY, title TEXT, "
+                        "revid INTEGER, sha1 TEXT, words TEXT, "
+                        "generation INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs ("
+                        "generation INTEGER PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                        "key TEXT PRIMARY KEY, value TEXT)")
+        self.invalidated = 0
+        settings = json.dumps(settings, sort_keys=True)
+        row = self.db.execute("SELECT value FROM meta "
+                              "WHERE key = 'settings'").fetchone()
+        if row is None or row[0] != settings:
+            # Pages without a sha1 are never found by lookup().
+            cursor = self.db.execute("UPDATE pages SET sha1 = NULL "
+                                     "WHERE sha1 IS NOT NULL")
+            self.invalidated = max(0, cursor.rowcount)
+            self.db.execute("INSERT OR REPLACE INTO meta "
+                            "VALUES ('settings', ?)", (settings,))
+            self.db.commit()
+        row = self.db.execute("SELECT MAX(generation) FROM runs").fetchone()
+        self.generation = (row[0] or 0) + 1
+        self.updates = []
+        self.touched = []
+        # Numbers of updates and touched pages already written.
+        self.num_flushed = (0, 0)
+
+    def lookup(self, pageid, sha1):
+        """Returns the list of words stored for ``pageid`` if its sha1 is
+        still ``sha1``, marking the page as seen in this run.  Returns
+        None if the page is new or has changed."""
+        if not pageid or not sha1:
+            return None
+        row = self.db.execute("SELECT sha1, words FROM pages "
+                              "WHERE pageid = ?", (int(pageid),)).fetchone()
+        if row is None or row[0] != sha1:
+            return None
+        self.touch(pageid)
+        return json.loads(row[1])
+
+    def touch(self, pageid):
+        """Marks the page ``pageid`` as seen in this run, e.g., when it is
+        skipped without being looked up, so that it is not taken as
+        deleted.  Pages that are not stored are ignored."""
+        if not pageid:
+            return
+        self.touched.append((self.generation, int(pageid)))
+        if (self.flush_every is not None and
+            len(self.touched) >= self.flush_every):
+            self.flush()
+
+    def update(self, pageid, title, revid, sha1, words):
+        """Stores the words extracted from a new or changed page."""
+        if not pageid:
+            return
+        self.updates.append((int(pageid), title, int(revid or 0), sha1,
+                             json.dumps(words), self.generation))
+        if (self.flush_every is not None and
+            len(self.updates) >= self.flush_every):
+            self.flush()
+
+    def mark(self):
+        """Returns a mark of the updates so far, which can be passed to
+        flush() to write only those."""
+        return (self.num_flushed[0] + len(self.updates),
+                self.num_flushed[1] + len(self.touched))
+
+    def flush(self, mark=None):
+        """Writes the pending updates to the database.  If ``mark`` is given,
+        only the updates made before mark() returned it are written."""
+        if mark is None:
+            mark = self.mark()
+        num_updates = max(0, mark[0] - self.num_flushed[0])
+        num_touched = max(0, mark[1] - self.num_flushed[1])
+        self.num_flushed = (self.num_flushed[0] + num_updates,
+                            self.num_flushed[1] + num_touched)
+        if num_updates:
+            self.db.executemany("INSERT OR REPLACE INTO pages "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                self.updates[:num_updates])
+            del self.updates[:num_updates]
+        if num_touched:
+            self.db.executemany("UPDATE pages SET generation = ? "
+                                "WHERE pageid = ?",
+                                self.touched[:num_touched])
+            del self.touched[:num_touched]
+        self.db.commit()
+
+    def deletions(self):
+        """Removes the pages that were not seen in this run from the store
+        and returns them as a list of ``(pageid, title)``.  This should
+        only be called after the whole dump has been read."""
+        self.flush()
+        rows = self.db.execute("SELECT pageid, title FROM pages "
+                               "WHERE generation < ?",
+                               (self.generation,)).fetchall()
+        self.db.execute("DELETE FROM pages WHERE generation < ?",
+                        (self.generation,))
+        self.db.commit()
+        return rows
+
+    def close(self, completed=False):
+        """Closes the store.  If ``completed`` is True, the pending updates
+        are flushed and the run is recorded as a finished generation.
+        Otherwise the updates since the last flush are discarded, so that
+        a run resumed from a checkpoint (which flushes the store) parses
+        those pages again."""
+        if completed:
+            self.flush()
+            self.db.execute("INSERT INTO runs VALUES (?)", (self.generation,))
+            self.db.commit()
+        self.db.close()
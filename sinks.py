@@ -0,0 +1,340 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+
+class SinkFull(Exception):
+    """Raised by AsyncSink.addWord() when the queue of a sink stayed full
+    for longer than its timeout."""
+    pass
+
+
+class AsyncSink(object):
+    """Passes word records to ``sink`` in ``threads`` writer threads
+    through a queue of at most ``queue_size`` records, so that a slow
+    sink (e.g., one writing to a database over the network) does not
+    stall parsing until the queue is full.  ``sink`` is an object with
+    an ``addWord(data)`` method and optionally ``flush()`` and
+    ``close()`` methods (e.g., a BatchWriter or a CsvExporter), or a
+    function that is called with each record.  With more than one
+    thread, the sink must be thread-safe and the records may be written
+    out of order.
+
+    When the queue is full, ``full`` tells what addWord() does:
+    "block" waits for room (raising SinkFull after ``timeout`` seconds,
+    unless it is None), and "drop" drops the record (counting it in
+    stats()).  An exception raised by the sink is raised again by the
+    next call to addWord(), flush() or close() in the parsing thread;
+    the records queued after it are dropped.
+
+    flush() waits until the queued records have been written, so it
+    should be called from ``checkpoint_cb`` (see parseWiktionary())
+    before the output is recorded in a checkpoint."""
+
+    def __init__(self, sink, queue_size=10000, threads=1, full="block",
+                 timeout=None, name="sink"):
+        assert isinstance(queue_size, int) and queue_size > 0
+        assert isinstance(threads, int) and threads > 0
+        assert full in ("block", "drop")
+        assert timeout is None or timeout > 0
+        if hasattr(sink, "addWord"):
+            self.write = sink.addWord
+            self.sink_flush = getattr(sink, "flush", None)
+            self.sink_close = getattr(sink, "close", None)
+        else:
+            assert callable(sink)
+            self.write = sink
+            self.sink_flush = self.sink_close = None
+        self.sink = sink
+        self.name = name
+        self.full = full
+        self.timeout = timeout
+        self.queue = queue.Queue(queue_size)
+        self.queue_size = queue_size
+        # The first exception raised by the sink, until it is raised again.
+        self.error = None
+        self.failed = False
+        self.lock = threading.Lock()
+        self.counts = {"records": 0, "written": 0, "dropped": 0,
+                       "discarded": 0, "blocked": 0, "max_depth": 0,
+                       "depth_sum": 0}
+        self.blocked_seconds = 0.0
+        self.write_seconds = 0.0
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.run,
+                                      name="{}-{}".format(name, i),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def __call__(self, data):
+        """Same as addWord(), so that the sink can be used as ``word_cb``."""
+        self.addWord(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # After an error in the parser, the queued records are still
+        # written, but errors of the sink do not hide the first one.
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def run(self):
+        # Writer thread: writes records until it gets None.
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    return
+                if self.failed:
+                    with self.lock:
+                        self.counts["discarded"] += 1
+                    continue
+                start = time.perf_counter()
+                try:
+                    self.write(data)
+                except Exception as e:
+                    with self.lock:
+                        if not self.failed:
+                            self.error = e
+                            self.failed = True
+                        self.counts["discarded"] += 1
+                    continue
+                seconds = time.perf_counter() - start
+                with self.lock:
+                    self.counts["written"] += 1
+                    self.write_seconds += seconds
+            finally:
+                self.queue.task_done()
+
+    def raiseError(self):
+        """Raises the exception raised by the sink, if it has not been
+        raised yet."""
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def addWord(self, data):
+        """Queues the record ``data`` to be written."""
+        self.raiseError()
+        counts = self.counts
+        counts["records"] += 1
+        depth = self.queue.qsize()
+        counts["depth_sum"] += depth
+        if depth > counts["max_depth"]:
+            counts["max_depth"] = depth
+        try:
+            self.queue.put_nowait(data)
+            return
+        except queue.Full:
+            if self.full == "drop":
+                counts["dropped"] += 1
+                return
+        counts["blocked"] += 1
+        start = time.perf_counter()
+        try:
+            self.queue.put(data, timeout=self.timeout)
+        except queue.Full:
+            counts["dropped"] += 1
+            raise SinkFull("{}: queue full for {}s".format(self.name,
+                                                           self.timeout))
+        finally:
+            self.blocked_seconds += time.perf_counter() - start
+
+    def flush(self):
+        """Waits until the queued records have been written, and flushes
+        the sink."""
+        self.queue.join()
+        self.raiseError()
+        if self.sink_flush is not None and not self.failed:
+            self.sink_flush()
+
+    def close(self):
+        """Writes the queued records, stops the writer threads and closes
+        the sink, even if it has failed."""
+        if not self.threads:
+            return
+        self.queue.join()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # A sink that failed is still closed (e.g., to close its file),
+        # but its first error is the one raised.
+        try:
+            if self.sink_close is not None:
+                self.sink_close()
+            elif self.sink_flush is not None and not self.failed:
+                self.sink_flush()
+        finally:
+            self.raiseError()
+
+    def stats(self):
+        """Returns the numbers of records given to the sink, written, dropped
+        because the queue was full, and discarded after an error, the
+        maximum and mean queue depth seen by addWord(), how many times and
+        for how long it blocked, and the seconds spent writing."""
+        with self.lock:
+            stats = dict(self.counts)
+            write_seconds = self.write_seconds
+        depth_sum = stats.pop("depth_sum")
+        stats["queue_size"] = self.queue_size
+        stats["mean_depth"] = depth_sum / max(1, stats["records"])
+        stats["blocked_seconds"] = self.blocked_seconds
+        stats["write_seconds"] = write_seconds
+        stats["failed"] = self.failed
+        return stats
+
+
+class JsonlSink(object):
+    """Sink that writes each record as a line of JSON to the file ``path``.
+    To continue a file after a checkpoint, pass the offset returned by
+    tell() just after a flush() (e.g., in ``checkpoint_cb``) as
+    ``offset``; whatever was written after it is dropped."""
+
+    def __init__(self, path, offset=None):
+        assert isinstance(path, str)
+        assert offset is None or (isinstance(offset, int) and offset >= 0)
+        self.path = path
+        if offset is None:
+            self.f = open(path, "w", encoding="utf-8",
+                          buffering=1024*1024)
+        else:
+            os.truncate(path, offset)
+            self.f = open(path, "a", encoding="utf-8",
+                          buffering=1024*1024)
+
+    def addWord(self, data):
+        self.f.write(json.dumps(data))
+        self.f.write("\n")
+
+    def flush(self):
+        """Flushes the file to disk."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def tell(self):
+        """Returns the offset of the end of the records written."""
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+class StatsSink(object):
+    """Sink that counts the records by language, part of speech and
+    etymology relationship."""
+
+    def __init__(self):
+        self.words = 0
+        self.language_counts = collections.defaultdict(int)
+        self.pos_counts = collections.defaultdict(int)
+        self.relationship_counts = collections.defaultdict(int)
+
+    def addWord(self, data):
+        self.words += 1
+        self.language_counts[data.get("lang")] += 1
+        self.pos_counts[data.get("pos")] += 1
+        for record in data.get("etymology", ()):
+            self.relationship_counts[record.get("relationship")] += 1
+
+    def stats(self):
+        """Returns the counts as a JSON-serializable dict."""
+        return {"words": self.words,
+                "language_counts": dict((str(k), v) for k, v
+                                        in self.language_counts.items()),
+                "pos_counts": dict((str(k), v) for k, v
+                                   in self.pos_counts.items()),
+                "relationship_counts": dict(
+                    (str(k), v) for k, v in self.relationship_counts.items())}
+
+
+def sinkName(sink):
+    """Returns a name for ``sink``: its class name, or the name of a
+    function."""
+    if hasattr(sink, "addWord"):
+        return sink.__class__.__name__
+    return getattr(sink, "__name__", sink.__class__.__name__)
+
+
+class FanOut(object):
+    """Passes each record to all the ``sinks``, each through its own
+    AsyncSink with a queue of ``queue_size`` records, so that the sinks
+    write in parallel and a slow sink only holds up the others once its
+    queue is full.  The sinks can be AsyncSinks, which are used as they
+    are (e.g., to give a sink another queue size, or let it drop
+    records rather than block), or anything AsyncSink takes.
+
+    flush() and close() act on all the sinks before raising the first
+    exception from any of them."""
+
+    def __init__(self, sinks, queue_size=10000):
+        assert isinstance(sinks, (list, tuple)) and sinks
+        self.sinks = []
+        try:
+            for sink in sinks:
+                if not isinstance(sink, AsyncSink):
+                    sink = AsyncSink(sink, queue_size, name=sinkName(sink))
+                self.sinks.append(sink)
+        except BaseException:
+            self.close(raise_errors=False)
+            raise
+
+    def __call__(self, data):
+        """Same as addWord(), so that the fan-out can be used as
+        ``word_cb``."""
+        self.addWord(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def addWord(self, data):
+        """Queues the record ``data`` to be written to each sink."""
+        for sink in self.sinks:
+            sink.addWord(data)
+
+    def forEach(self, method, raise_errors=True):
+        # Calls ``method`` on all the sinks, then raises the first error.
+        error = None
+        for sink in self.sinks:
+            try:
+                method(sink)
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None and raise_errors:
+            raise error
+
+    def flush(self):
+        """Waits until the queued records have been written to all the
+        sinks, and flushes them."""
+        self.forEach(AsyncSink.flush)
+
+    def close(self, raise_errors=True):
+        """Writes the queued records and closes all the sinks."""
+        self.forEach(AsyncSink.close, raise_errors)
+
+    def stats(self):
+        """Returns the stats() of the AsyncSink of each sink, by name."""
+        stats = {}
+        for i, sink in enumerate(self.sinks):
+            name = sink.name
+            if name in stats:
+                name = "{}-{}".format(name, i)
+            stats[name] = sink.stats()
+        return stats
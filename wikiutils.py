@@ -1,17 +1,23 @@
+import bisect
+import collections
+import functools
 import re
 import html
+import wiktlangs
 from definitions import *
 
 def remove_html_comments(text):
     """Removes HTML comments from the value."""
     assert isinstance(text, str)
     text = text.strip()
-    text = re.sub(r"(?s)<!--.*?-->", "", text)
-    return text
+    return sub_delimited(text, "<!--", "-->")
 
 
-def clean_value(title):
-    """Cleans a title or value into a normal string.  This should basically
+def clean_value_reference(title):
+    """Reference implementation of clean_value().  This is the original,
+    straightforward version that runs every substitution on every call;
+    clean_value() must return the same result for any input.  Cleans a
+    title or value into a normal string.  This should basically
     remove any Wikimedia formatting from it: HTML tags, templates, links,
     emphasis, etc.  This will also merge multiple whitespaces into one
     normal space and will remove any surrounding whitespace."""
@@ -75,37 +81,854 @@ def clean_value(title):
     return title
 
 
+# Characters that start some markup handled by clean_value().  None of
+# the substitutions can introduce one of these that was not already in the
+# value (except html.unescape(), which runs after all of them).
+clean_markup_re = re.compile(r"[{<\['&]")
+
+# Values matching this need no cleaning beyond what is checked here.
+clean_fast_re = re.compile(r"[{}<>\[\]'&\xa0’”]|[^\S ]|  | [.,;:!?)]|"
+                           r"^ | $")
+
+# Regexps for the substitutions of _clean_value().
+clean_arg_special_re = re.compile(r"[][|{}]")
+clean_named_arg_re = re.compile(r"\|[-_a-zA-Z0-9]+=[^}|]+")
+clean_link_sep_re = re.compile(r"[]|]")
+clean_url_close_re = re.compile(r"\]")
+clean_space_char_re = re.compile(r"\s")
+clean_quotes_re = re.compile(r"'+")
+clean_br_re = re.compile(r"(?s)<br/?>")
+clean_space_re = re.compile(r"\s+")
+clean_punct_re = re.compile(r" ([.,;:!?)])")
+
+
+# The regexps of clean_value_reference() take quadratic time on some
+# malformed values, and those built from arg_re exponential time, as the
+# alternatives nested in arg_re can match the same text in many ways (e.g.,
+# "[x]" is one link or three characters).  _clean_value() finds the same
+# matches with the functions below instead, which scan the value once.
+
+
+def sub_delimited(text, start, end, keep_inner=False, nonempty=False,
+                  exclusive=False):
+    """Replaces each ``start``...``end`` in ``text`` by what is between them
+    if ``keep_inner`` is True and by nothing otherwise, like re.sub()
+    with ``start.*?end``.  If ``nonempty`` is True, there must be
+    something between them.  If ``exclusive`` is True, what is between
+    them cannot contain the first character of ``end`` (as in
+    ``start[^e]+end``).  Unlike re.sub(), this takes linear time when
+    there are many ``start`` without an ``end``."""
+    parts = []
+    last = 0
+    # The first ``end`` (or its first character) at or after the previous
+    # inner position, which is still the first one for later starts.
+    close = -1
+    i = text.find(start)
+    while i >= 0:
+        inner = i + len(start)
+        if close < inner:
+            close = text.find(end[0] if exclusive else end, inner)
+            if close < 0:
+                break
+        if (close > inner or not nonempty) and text.startswith(end, close):
+            parts.append(text[last:i])
+            if keep_inner:
+                parts.append(text[inner:close])
+            last = close + len(end)
+            i = text.find(start, last)
+        else:
+            i = text.find(start, i + 1)
+    if last == 0:
+        return text
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+def sub_links(text):
+    """Replaces the links ``[[target|display]]`` and ``[[display]]`` in
+    ``text`` by their display text, like clean_value_reference()."""
+    seps = list(m.start() for m in clean_link_sep_re.finditer(text))
+    n = len(text)
+
+    def next_sep(pos):
+        # Returns the position of the first "]" or "|" at or after pos.
+        idx = bisect.bisect_left(seps, pos)
+        return seps[idx] if idx < len(seps) else n
+
+    parts = []
+    last = 0
+    i = text.find("[[")
+    while i >= 0:
+        inner = i + 2
+        r = next_sep(inner)
+        if r >= n:
+            break
+        end = -1
+        if r > inner and text[r] == "|":
+            t = next_sep(r + 1)
+            if t > r + 1 and text.startswith("]]", t):
+                display = text[r + 1:t]
+                end = t + 2
+        elif r > inner and text.startswith("]]", r):
+            display = text[inner:r]
+            end = r + 2
+        if end < 0:
+            i = text.find("[[", i + 1)
+            continue
+        parts.append(text[last:i])
+        parts.append(display)
+        last = end
+        i = text.find("[[", last)
+    if last == 0:
+        return text
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+def sub_url_displays(text):
+    """Replaces the external links with a display text ``[url display]`` in
+    ``text`` by the display text, like clean_value_reference()."""
+    n = len(text)
+    spaces = list(m.start() for m in clean_space_char_re.finditer(text))
+    runs = list(m.span() for m in clean_space_re.finditer(text))
+    run_starts = list(start for start, end in runs)
+    closes = list(m.start() for m in clean_url_close_re.finditer(text))
+
+    def next_pos(positions, pos):
+        # Returns the first of ``positions`` at or after pos, or n.
+        idx = bisect.bisect_left(positions, pos)
+        return positions[idx] if idx < len(positions) else n
+
+    # The URL ends at the first whitespace character after it where the
+    # rest matches, and cannot contain spaces.  This does not depend on
+    # where the link starts, so ``found`` keeps for each whitespace
+    # character the span of the display text it leads to, or None.
+    found = {}
+
+    def display(p):
+        chain = []
+        while p < n and p not in found:
+            chain.append(p)
+            end = runs[bisect.bisect_right(run_starts, p) - 1][1]
+            if end < n and text[end] != "]":
+                close = next_pos(closes, end + 1)
+                result = (end, close) if close < n else None
+                break
+            if end < n and end - p >= 2:
+                # The display text is the last whitespace character.
+                result = (end - 1, end)
+                break
+            if end >= n or text[p] == " ":
+                result = None
+                break
+            p = next_pos(spaces, p + 1)
+        else:
+            result = found.get(p)
+        for q in chain:
+            found[q] = result
+        return result
+
+    parts = []
+    last = 0
+    i = text.find("[")
+    while i >= 0:
+        result = None
+        if i + 1 < n and text[i + 1] != " ":
+            result = display(next_pos(spaces, i + 2))
+        if result is None:
+            i = text.find("[", i + 1)
+            continue
+        parts.append(text[last:i])
+        parts.append(text[result[0]:result[1]])
+        last = result[1] + 1
+        i = text.find("[", last)
+    if last == 0:
+        return text
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+def sub_emphasis(text):
+    """Replaces the emphasized text ``''...''`` (with any number of quotes)
+    in ``text`` by the text itself, like clean_value_reference()."""
+    parts = []
+    last = 0
+    n = len(text)
+    i = text.find("''")
+    while i >= 0:
+        inner = clean_quotes_re.match(text, i).end()
+        close = text.find("''", inner + 1) if inner < n else -1
+        if close < 0:
+            break
+        end = clean_quotes_re.match(text, close).end()
+        parts.append(text[last:i])
+        parts.append(text[inner:close])
+        last = end
+        i = text.find("''", last)
+    if last == 0:
+        return text
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+# For each position of a value, which states of the regexps built from arg_re
+# can lead to a match from there, as bits for the number of required arguments
+# left (1 for the last one, 2 for the one before it and 4 for the one before
+# that).  named tells whether the named arguments and the value of such an
+# argument can start at a position, and value whether its value can continue
+# from there.  Once the required arguments have been matched, the optional
+# ones are like the last required one, and between tells whether the rest of
+# the template can be matched from a position.  named_ends and item_ends are
+# the ends of the named argument and of the possible items of a value that
+# start at a position.  specials are the positions of the characters
+# "|{}[]"; other characters can only be part of a value.
+TemplateStates = collections.namedtuple("TemplateStates",
+                                        "named value between named_ends "
+                                        "item_ends specials")
+
+
+def template_states(text):
+    """Computes the TemplateStates of ``text``, from its end backwards."""
+    n = len(text)
+    named = bytearray(n + 1)
+    value = bytearray(n + 1)
+    between = bytearray(n + 1)
+    named_ends = {}
+    item_ends = {}
+    specials = list(m.start() for m in clean_arg_special_re.finditer(text))
+    next_brace = next_bracket = n
+    q = n
+    for p in reversed(specials):
+        if q > p + 1 and value[q]:
+            # The characters before q can only continue a value.
+            value[p + 1:q] = bytes((value[q],)) * (q - p - 1)
+        q = p
+        c = text[p]
+        if c == "|":
+            m = clean_named_arg_re.match(text, p)
+            e = m.end() if m else 0
+            named_ends[p] = e
+            bits = value[p + 1]
+            if e:
+                bits |= named[e]
+            named[p] = bits
+            between[p] = bits & 1
+            value[p] = between[p] | ((bits << 1) & 6)
+        elif c == "}":
+            next_brace = p
+            if text.startswith("}}", p):
+                between[p] = value[p] = 1
+        elif c == "]":
+            next_bracket = p
+            value[p] = value[p + 1]
+        else:
+            ends = ()
+            if c == "[":
+                ends = [p + 1]
+                if (text.startswith("[[", p) and p + 2 < next_bracket and
+                    text.startswith("]]", next_bracket)):
+                    ends.append(next_bracket + 2)
+                if p + 1 < next_bracket < n:
+                    ends.append(next_bracket + 1)
+            elif (text.startswith("{{", p) and
+                  text.startswith("}}", next_brace)):
+                ends = (next_brace + 2,)
+            bits = 0
+            for e in ends:
+                bits |= value[e]
+            if bits:
+                value[p] = bits
+                item_ends[p] = ends
+    return TemplateStates(named, value, between, named_ends, item_ends,
+                          specials)
+
+
+def walk_template(text, states, p, k):
+    """Follows the match that a regexp built from arg_re finds, from the
+    position ``p`` after the template name, with ``k`` required arguments.
+    The states there must allow a match.  Returns ``(span, end)``, where
+    ``span`` is the ``(start, end)`` of the value of the last required
+    argument (None if there are none) and ``end`` is the end of the
+    match."""
+    named, value, between, named_ends, item_ends, specials = states
+    n = len(text)
+    captured = None
+    bit = 1 << (k - 1) if k else 1
+    while k or named[p] & 1:
+        # The named arguments are taken as long as the rest can match.
+        e = named_ends[p]
+        while e and named[e] & bit:
+            p = e
+            e = named_ends[p]
+        p += 1
+        start = p
+        while True:
+            # The value, with each item taken as long as the rest can match.
+            idx = bisect.bisect_left(specials, p)
+            p = specials[idx] if idx < len(specials) else n
+            if text[p] == "]":
+                p += 1
+                continue
+            for e in item_ends.get(p, ()):
+                if value[e] & bit:
+                    p = e
+                    break
+            else:
+                break
+        if k == 1:
+            captured = (start, p)
+        if k > 1:
+            bit >>= 1
+        k = max(k - 1, 0)
+    return captured, p + 2
+
+
+def sub_templates(text, states, start, k, repl=("", ""), optional=False):
+    """Replaces the matches in ``text`` of a regexp built from arg_re, for
+    the templates found by the regexp ``start`` (which matches "{{" and
+    the name), with ``k`` required arguments.  The value of the last
+    required argument is inserted between the parts of ``repl``.  If
+    ``optional`` is True, the argument may also be missing, in which
+    case its value is empty.  ``states`` is a list holding the
+    TemplateStates of ``text``, or None if they have not been computed
+    yet; it is reset when ``text`` changes."""
+    parts = []
+    last = 0
+    m = start.search(text)
+    while m:
+        if states[0] is None:
+            states[0] = template_states(text)
+        p = m.end()
+        if k and states[0].named[p] & (1 << (k - 1)):
+            span, end = walk_template(text, states[0], p, k)
+            value = text[span[0]:span[1]]
+        elif (not k or optional) and states[0].between[p]:
+            span, end = walk_template(text, states[0], p, 0)
+            value = ""
+        else:
+            m = start.search(text, m.start() + 1)
+            continue
+        parts.append(text[last:m.start()])
+        parts.append(repl[0])
+        for x in repl[1:]:
+            parts.append(value)
+            parts.append(x)
+        last = end
+        m = start.search(text, last)
+    if last == 0:
+        return text
+    parts.append(text[last:])
+    states[0] = None
+    return "".join(parts)
+
+
+# (literal prefix, regexp finding the template, number of required arguments,
+# replacement parts) for each template in clean_replace_map.  The
+# replacements refer at most to the first argument (as \1), which is then
+# optional.
+clean_replace_res = list(
+    ("{{" + k, re.compile(re.escape("{{" + k)),
+     1 if "\\1" in v else 0, v.split("\\1"))
+    for k, v in clean_replace_map.items())
+# (regexp finding the template, number of required arguments) for the
+# templates replaced by their first, second or third argument, in the order
+# clean_value_reference() uses them.
+clean_arg_res = list(
+    (re.compile(r"\{\{(?:" + "|".join(re.escape(x) for x in tags) +
+                r")(?=\|)"), k)
+    for k, tags in ((3, clean_arg3_tags), (2, clean_arg2_tags),
+                    (1, clean_arg1_tags)))
+# The numbers of required arguments of the templates in clean_arg_res, by
+# name, in the same order.
+clean_arg_counts = {}
+for k, tags in ((3, clean_arg3_tags), (2, clean_arg2_tags),
+                (1, clean_arg1_tags)):
+    for x in tags:
+        clean_arg_counts.setdefault(x, []).append(k)
+
+# Regexps for sub_nested_templates().
+clean_brace_run_re = re.compile(r"\{+|\}+")
+clean_bracket_brace_re = re.compile(r"[][{}]")
+clean_named_brace_re = re.compile(r"\|[-_a-zA-Z0-9]+=[^}|]*\{")
+clean_name_chars_re = re.compile(r"[-_a-zA-Z0-9]*")
+
+# A template found by sub_nested_templates().  ``value`` is the span of the
+# value it is replaced by, or None if it is kept.  ``leaf`` tells whether it
+# contains no templates, and ``chain`` whether it is a leaf or ends with its
+# only template, which is a chain.  The other fields tell whether what is
+# left of it (its value or the template) contains an "=", a "[" that is not
+# closed, or a template replaced by the first of the several arguments its
+# name can be replaced by, which clean_value_reference() only does if no
+# enclosing template was replaced before it.
+NestedTemplate = collections.namedtuple("NestedTemplate",
+                                        "start end value leaf chain has_eq "
+                                        "has_open ambiguous")
+
+
+def sub_nested_templates(text):
+    """Replaces the templates of clean_arg_res in ``text`` by their
+    arguments in one pass, innermost first, with the same result as the
+    repeated substitutions of clean_value_reference(), which only remove
+    one level of nesting each time.  Returns None if ``text`` has
+    markup for which the order of the substitutions may matter:
+    unbalanced braces, braces in brackets or named arguments, templates
+    in the name of a template or (with an "=") of a named argument,
+    templates with several possible arguments or leaving a "[" open in
+    other templates, and templates containing other templates anywhere
+    but at the end of the argument that replaces a template (where the
+    regexps, which take the first "}}" as the end of a nested template,
+    still give the same result)."""
+    if clean_named_brace_re.search(text):
+        return None
+    # Braces between "[" and the next "]" may be part of a link.
+    opened = enclosed = False
+    for m in clean_bracket_brace_re.finditer(text):
+        c = text[m.start()]
+        if c == "[":
+            opened = True
+        elif c == "]":
+            if enclosed:
+                return None
+            opened = False
+        elif opened:
+            enclosed = True
+    # Stack of open templates: (start offset, list of NestedTemplate).
+    stack = []
+    deletions = []
+    for m in clean_brace_run_re.finditer(text):
+        start, end = m.span()
+        if (end - start) % 2:
+            return None
+        for pos in range(start, end, 2):
+            if text[pos] == "{":
+                stack.append((pos, []))
+                continue
+            if not stack:
+                return None
+            t_start, children = stack.pop()
+            t = nested_template(text, t_start, pos + 2, children, deletions)
+            if t is None:
+                return None
+            if stack:
+                stack[-1][1].append(t)
+    if stack:
+        return None
+    if not deletions:
+        return text
+    deletions.sort()
+    parts = []
+    last = 0
+    for start, end in deletions:
+        if start > last:
+            parts.append(text[last:start])
+        last = max(last, end)
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+def nested_template(text, start, end, children, deletions):
+    """Returns the NestedTemplate for ``text[start:end]``, whose templates
+    are ``children``, for sub_nested_templates(), and appends the spans
+    of text it removes to ``deletions``.  Returns None if the result
+    might not be the same as that of clean_value_reference()."""
+    leaf = not children
+    chain = leaf or (len(children) == 1 and
+                     children[0].end == end - 2 and children[0].chain)
+    has_open = any(child.has_open for child in children)
+    ambiguous = any(child.ambiguous for child in children)
+    kept = NestedTemplate(start, end, None, leaf, chain, False, has_open,
+                          ambiguous)
+    pipe = text.find("|", start + 2, children[0].start if children else end)
+    if pipe < 0:
+        return None if children else kept
+    counts = clean_arg_counts.get(text[start + 2:pipe])
+    if counts is None:
+        return kept
+    if has_open or ambiguous:
+        return None
+    # The template with each nested template as a single placeholder
+    # character, and the offsets of the pieces in both.
+    pieces = []
+    offsets = []
+    local = 0
+    last = start
+    for child in children:
+        if (child.end != end - 2 or not child.chain) and not child.leaf:
+            return None
+        pieces.append(text[last:child.start])
+        offsets.append((local, last, None))
+        local += child.start - last
+        pieces.append("\x00")
+        offsets.append((local, child.start, child))
+        local += 1
+        last = child.end
+    pieces.append(text[last:end])
+    offsets.append((local, last, None))
+    local_text = "".join(pieces)
+    # A template at the start of an argument can be replaced by the name
+    # of a named argument, which the regexps would not take as one.
+    name_pos = risky = eq = False
+    for (local, pos, child), piece in zip(offsets, pieces):
+        if child is not None:
+            risky = risky or name_pos
+            eq = eq or child.has_eq
+            continue
+        first = piece.find("|")
+        if first < 0:
+            eq = eq or "=" in piece
+            name_pos = name_pos and clean_name_chars_re.fullmatch(piece)
+            continue
+        if risky and (eq or "=" in piece[:first]):
+            return None
+        tail = piece[piece.rfind("|") + 1:]
+        risky = False
+        eq = "=" in tail
+        name_pos = clean_name_chars_re.fullmatch(tail)
+    if risky and eq:
+        return None
+    states = template_states(local_text)
+    p = pipe - start
+    for k in counts:
+        if states.named[p] & (1 << (k - 1)):
+            break
+    else:
+        return kept
+    span, match_end = walk_template(local_text, states, p, k)
+    if match_end != len(local_text):
+        return None
+    if not leaf and span[1] != len(local_text) - 2:
+        return None
+    ambiguous = k != counts[-1]
+    if span[0] == span[1]:
+        deletions.append((start, end))
+        return NestedTemplate(start, end, (start, start), leaf, chain, False,
+                              False, ambiguous)
+    # The offsets in ``text`` of the value.
+    value = []
+    starts = list(local for local, pos, child in offsets)
+    for i, local_end in ((span[0], False), (span[1] - 1, True)):
+        local, pos, child = offsets[bisect.bisect_right(starts, i) - 1]
+        if child is not None:
+            value.append(child.end if local_end else child.start)
+        else:
+            value.append(pos + i - local + local_end)
+    deletions.append((start, value[0]))
+    deletions.append((value[1], end))
+    # The values of the nested templates have no "[" left open, or this
+    # would have returned None.
+    local_value = local_text[span[0]:span[1]]
+    has_eq = "=" in local_value or any(
+        child.has_eq for local, pos, child in offsets
+        if child is not None and span[0] <= local < span[1])
+    has_open = local_value.rfind("[") > local_value.rfind("]")
+    return NestedTemplate(start, end, tuple(value), leaf, chain, has_eq,
+                          has_open, ambiguous)
+
+
+# Cache of clean_value() results, or None.  See set_clean_value_cache().
+clean_value_cache = None
+
+
+def set_clean_value_cache(maxsize):
+    """Makes clean_value() cache the results for up to ``maxsize`` distinct
+    values, evicting the least recently used ones.  Plain values, which
+    are returned as such, are not cached.  A ``maxsize`` of 0 turns the
+    cache off.  This also resets the statistics returned by
+    clean_value_cache_stats()."""
+    global clean_value_cache
+    assert isinstance(maxsize, int) and maxsize >= 0
+    clean_value_cache = None
+    if maxsize > 0:
+        clean_value_cache = functools.lru_cache(maxsize)(_clean_value)
+
+
+def clean_value_cache_stats():
+    """Returns a dictionary with the number of "hits", "misses" and
+    "evictions" of the clean_value() cache, its current "size" and its
+    "maxsize" (0 if there is no cache)."""
+    if clean_value_cache is None:
+        return {"hits": 0, "misses": 0, "evictions": 0, "size": 0,
+                "maxsize": 0}
+    info = clean_value_cache.cache_info()
+    return {"hits": info.hits, "misses": info.misses,
+            "evictions": info.misses - info.currsize,
+            "size": info.currsize, "maxsize": info.maxsize}
+
+
+def clean_value(title):
+    """Cleans a title or value into a normal string.  This should basically
+    remove any Wikimedia formatting from it: HTML tags, templates, links,
+    emphasis, etc.  This will also merge multiple whitespaces into one
+    normal space and will remove any surrounding whitespace.
+
+    This gives the same results as clean_value_reference(), but plain
+    values are returned as such, and the results for other values may
+    be cached (see set_clean_value_cache())."""
+    if not clean_fast_re.search(title):
+        return title
+    if clean_value_cache is not None:
+        return clean_value_cache(title)
+    return _clean_value(title)
+
+
+def _clean_value(title):
+    """Cleans a value that needs it for clean_value().  One scan of the
+    value finds out which kinds of markup it contains so that only the
+    (precompiled) substitutions that can match are run."""
+    markup = set(clean_markup_re.findall(title))
+    if "<" in markup:
+        # Remove HTML comments
+        title = sub_delimited(title, "<!--", "-->")
+    if "{" in markup:
+        # Replace tags for which we have replacements.
+        states = [None]
+        for prefix, start, k, repl in clean_replace_res:
+            if prefix in title:
+                title = sub_templates(title, states, start, k, repl,
+                                      optional=True)
+        # Replace tags by their arguments, in one pass if possible, or else
+        # repeating for nested templates.
+        nested = sub_nested_templates(title) if "{{" in title else title
+        if nested is not None:
+            title = nested
+        while nested is None and "{{" in title:
+            orig = title
+            for start, k in clean_arg_res:
+                title = sub_templates(title, states, start, k)
+            if title is orig:
+                break
+        # Remove any remaining templates.
+        if "{{" in title:
+            title = sub_delimited(title, "{{", "}}", nonempty=True,
+                                  exclusive=True)
+    if "<" in markup:
+        # Remove references, replace <br/> by comma space and remove any
+        # remaining HTML tags.
+        if "<ref>" in title:
+            title = sub_delimited(title, "<ref>", "</ref>")
+        if "<br" in title:
+            title = clean_br_re.sub(", ", title)
+        title = sub_delimited(title, "<", ">", nonempty=True)
+    if "[" in markup:
+        # Replace links by their display values, or by the URL.
+        if "[[" in title:
+            title = sub_links(title)
+        title = sub_url_displays(title)
+        title = sub_delimited(title, "[", "]", keep_inner=True,
+                              nonempty=True)
+    if "'" in markup and "''" in title:
+        # Replace various empases (quoted text) by its value.
+        title = sub_emphasis(title)
+    if "&" in markup:
+        # Replace HTML entities
+        title = html.unescape(title)
+    title = title.replace("\xa0", " ")  # nbsp
+    title = title.replace("’", "'")
+    title = title.replace("”", '"')
+    # Replace whitespace sequences by a single space, remove whitespace
+    # before periods and commas etc, and strip surrounding whitespace.
+    title = clean_space_re.sub(" ", title)
+    title = clean_punct_re.sub(r"\1", title)
+    return title.strip()
+
+
+def classify_heading_uncached(raw):
+    """Classifies the raw text ``raw`` of a section heading (the part between
+    the "=" signs).  Returns ``(title, is_language, kind)``, where
+    ``title`` is the cleaned heading, ``is_language`` tells whether it
+    is the name of a language, and ``kind`` is the normalized subsection
+    title: lowercase, without a trailing number (as in "Etymology 2"),
+    with common misspellings corrected, and "" for language headings."""
+    title = clean_value(clean_value(raw))
+    if title in wiktlangs.languages:
+        return (title, True, "")
+    kind = re.sub(r"\s+\d+(\.\d+)$", "", title.lower())
+    kind = sectitle_corrections.get(kind, kind)
+    return (title, False, kind)
+
+
+# Classifications of the raw headings seen so far, initially those of the
+# language names and parts of speech.  There are few distinct headings in
+# the whole dump, so they are normally all kept.
+heading_classes = {}
+heading_classes_max = 100000
+
+for x in list(wiktlangs.languages) + list(k.capitalize() for k in pos_map):
+    heading_classes[x] = classify_heading_uncached(x)
+
+
+def classify_heading(raw):
+    """Returns ``(title, is_language, kind)`` for the raw text of a section
+    heading, like classify_heading_uncached() but with a single dictionary
+    lookup for headings that have been seen before."""
+    cls = heading_classes.get(raw)
+    if cls is None:
+        cls = classify_heading_uncached(raw)
+        if len(heading_classes) < heading_classes_max:
+            heading_classes[raw] = cls
+    return cls
+
+
+# Regular expression for section headings.  The heading text is group 2.
+subsection_re = re.compile(r"(?s)(^|\n)==+([^=\n]+?)==+")
+
+
+def iter_subsections(text):
+    """Iterates lazily over the linear sequence of sections in ``text``,
+    which should not contain HTML comments (see remove_html_comments()).
+    This yields ``(heading, start, end)``, where heading is ``(title,
+    is_language, kind)`` as returned by classify_heading() (``("",
+    False, "")`` for the text before the first heading) and
+    ``text[start:end]`` is the text of the section after its
+    heading."""
+    heading = ("", False, "")
+    start = 0
+    for m in subsection_re.finditer(text):
+        if start > 0 or m.start() > 0:
+            yield heading, start, m.start()
+        heading = classify_heading(m.group(2))
+        start = m.end()
+    if start > 0 or len(text) > 0:
+        yield heading, start, len(text)
+
+
+def language_blocks(sections):
+    """Groups the ``(heading, start, end)`` sections returned by
+    iter_subsections() into blocks starting at each language heading.
+    Returns a list of ``(language, first, last)``, where
+    ``sections[first:last]`` are the sections of the block and
+    ``language`` is None for the sections before the first language
+    heading."""
+    blocks = []
+    language = None
+    first = 0
+    for i, ((title, is_language, kind), start, end) in enumerate(sections):
+        if is_language:
+            if i > first:
+                blocks.append((language, first, i))
+            language = title
+            first = i
+    if len(sections) > first:
+        blocks.append((language, first, len(sections)))
+    return blocks
+
+
 def split_subsections(text):
     """Split the text into a linear sequence of sections.  Note that we
     ignore the nesting structure of subtitles, since that seems to be
-    poorly enforced in Wiktionary.  This returns a list of (subtitle,
-    text).  The subtitle has been fully cleaned, and HTML comments
-    have been removed from the text."""
+    poorly enforced in Wiktionary.  This returns a list of (heading,
+    text), where heading is ``(title, is_language, kind)`` as returned
+    by classify_heading() (``("", False, "")`` for the text before the
+    first heading).  HTML comments have been removed from the text."""
     # Remove HTML comments from the whole page.  We want to do this before
     # analyzing subsections, as they could be commented out.
     text = remove_html_comments(text)
-    # Find start and end offsets and titles for all subsections
-    regexp = r"(?s)(^|\n)==+([^=\n]+?)==+"
-    offsets = list((m.start(), m.end(), clean_value(m.group(2)))
-                   for m in re.finditer(regexp, text))
-    # Add a dummy section at end of text.
-    offsets.append((len(text), len(text), ""))
-    # Create first subsection from text before the first subtitle
-    subsections = []
-    first = text[:offsets[0][0]]
-    if first:
-        subsections.append(("", first))
-    # Add all other subsections (except the dummy one)
-    for i in range(len(offsets) - 1):
-        titlestart, start, subtitle = offsets[i]
-        # Get end offset from the entry for the next subsection
-        end = offsets[i + 1][0]
-        # Clean the section title
-        subtitle = clean_value(subtitle)
-        # Add an entry for the subsection.
-        subsection = text[start: end]
-        subsections.append((subtitle, subsection))
-    return subsections
+    return list((heading, text[start:end])
+                for heading, start, end in iter_subsections(text))
+
+
+# A template found by scan_templates().  ``arguments`` is a list of
+# TemplateArgument.  These mimic the attributes of the corresponding
+# wikitextparser objects that we use.
+Template = collections.namedtuple("Template", "name arguments")
+TemplateArgument = collections.namedtuple("TemplateArgument", "name value")
+
+# Tokens that affect template nesting and argument splitting.
+scan_token_re = re.compile(r"\{\{|\}\}|\[\[|[{}|=\[\]]")
+
+# A link that cannot contain anything affecting the enclosing template.  The
+# pipes inside it do not separate template arguments.
+scan_link_re = re.compile(r"\[\[[^\n\[\]{}|<]*(\|[^\[\]{}<]*)?\]\]")
+
+# Characters that make a template name invalid for wikitextparser.
+scan_bad_name_re = re.compile(r"[\[\]{}<>\r\n]")
+
+# Tags whose contents hide templates from wikitextparser (extension tags that
+# are not parsed, and comments).
+scan_hiding_tag_re = re.compile(
+    r"(?i)<(!--|/?(ce|charinsert|chem|graph|hiero|languages|mapframe|"
+    r"maplink|math|nowiki|pagelist|pagequality|pages|pre|score|source|"
+    r"syntaxhighlight|templatedata|templatestyles|timeline|includeonly|"
+    r"noinclude|onlyinclude)\b)")
+
+
+def scan_templates(text, wanted):
+    """Finds the templates in ``text`` for which ``wanted(name)`` returns
+    True, where ``name`` is the stripped template name.  This is a
+    lightweight replacement for ``wikitextparser.parse(text).templates``
+    that only tracks template nesting and links, and returns Template
+    tuples in the same order (by start offset) with the same argument
+    names and values.  Templates nested in arguments are found too.
+    For anything it does not model (template parameters, unbalanced
+    braces, complex links, HTML inside templates, etc.), this returns
+    None, and the caller should use wikitextparser instead."""
+    if "{{" not in text:
+        return []
+    if "{{{" in text or scan_hiding_tag_re.search(text):
+        return None
+    found = []
+    # Stack of open templates: [start offset, pipe offsets, "=" offsets].
+    # The offsets are only recorded at the top level of each template.
+    stack = []
+    pos = 0
+    while True:
+        m = scan_token_re.search(text, pos)
+        if m is None:
+            break
+        tok = m.group()
+        pos = m.end()
+        if tok == "{{":
+            stack.append((m.start(), [], []))
+        elif tok == "}}":
+            if not stack:
+                return None
+            start, pipes, eqs = stack.pop()
+            end = m.start()
+            if "<" in text[start:end]:
+                return None
+            name_end = pipes[0] if pipes else end
+            name = text[start + 2:name_end].strip()
+            if not name or scan_bad_name_re.search(name):
+                return None
+            if wanted(name):
+                found.append((start, name_end, end, pipes, eqs))
+        elif not stack:
+            # Tokens outside templates do not matter.
+            continue
+        elif tok == "[[":
+            m = scan_link_re.match(text, m.start())
+            if m is None:
+                return None
+            pos = m.end()
+        elif tok == "|":
+            stack[-1][1].append(m.start())
+        elif tok == "=":
+            stack[-1][2].append(m.start())
+        else:
+            # Single braces and brackets inside templates.
+            return None
+    if stack:
+        return None
+    found.sort()
+    templates = []
+    for start, name_end, end, pipes, eqs in found:
+        arguments = []
+        num = 0
+        bounds = pipes + [end]
+        for i in range(len(pipes)):
+            arg_start = bounds[i] + 1
+            arg_end = bounds[i + 1]
+            for eq in eqs:
+                if arg_start <= eq < arg_end:
+                    arguments.append(TemplateArgument(text[arg_start:eq],
+                                                      text[eq + 1:arg_end]))
+                    break
+            else:
+                num += 1
+                arguments.append(TemplateArgument(str(num),
+                                                  text[arg_start:arg_end]))
+        templates.append(Template(text[start + 2:name_end], arguments))
+    return templates
 
 
 def data_append(data, key, value):